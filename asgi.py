@@ -0,0 +1,232 @@
+"""
+ASGI entry point serving the Shinobi API on an asyncio event loop.
+
+Event streams are served natively from an AsyncEventHub, so an idle
+EventSource costs a coroutine instead of a thread. All other requests are
+short-lived and are passed to the Flask application running in a bounded
+thread pool.
+
+Run with: SERVER=async python shinobi.py
+or with any ASGI server, e.g.: uvicorn asgi:application
+"""
+import asyncio
+import io
+import json
+import os
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import redis.asyncio
+from redis.exceptions import ConnectionError, TimeoutError
+
+import sharding
+from events import (AsyncEventHub, KEEPALIVE_FRAME, format_event,
+                    parse_last_event_id)
+from models import (SHARD_URLS, REDIS_OPTIONS, EVENT_BUFFER_SIZE,
+                    EVENT_KEEPALIVE)
+from shinobi import app
+
+WSGI_THREADS = int(os.getenv('WSGI_THREADS', 16))
+
+EVENTS_PATH = re.compile(r'^/games/(\d+)/events$')
+
+
+def build_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope['http_version']),
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1')
+        value = value.decode('latin-1')
+        if name == 'content-type':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'content-length':
+            key = 'HTTP_{}'.format(name.upper().replace('-', '_'))
+            if key in environ:
+                value = '{},{}'.format(environ[key], value)
+            environ[key] = value
+    return environ
+
+
+def call_wsgi(wsgi_app, environ):
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = headers
+
+    chunks = wsgi_app(environ, start_response)
+    try:
+        body = b''.join(chunks)
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    return response['status'], response['headers'], body
+
+
+class Application:
+    def __init__(self, wsgi_app, event_hub, threads=WSGI_THREADS,
+                 keepalive=EVENT_KEEPALIVE):
+        self.wsgi_app = wsgi_app
+        self.event_hub = event_hub
+        self.executor = ThreadPoolExecutor(threads)
+        self.keepalive = keepalive
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        match = EVENTS_PATH.match(scope['path'])
+        if match and scope['method'] == 'GET':
+            last_seq = None
+            for name, value in scope['headers']:
+                if name == b'last-event-id':
+                    last_seq = parse_last_event_id(value.decode('latin-1'))
+            await self.events(int(match.group(1)), receive, send, last_seq)
+        else:
+            await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.event_hub.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def events(self, gid, receive, send, last_seq=None):
+        # Subscribe before reading the history, so no event falls in between
+        try:
+            subscription = await self.event_hub.subscribe(gid)
+        except (ConnectionError, TimeoutError) as ex:
+            await send({
+                'type': 'http.response.start',
+                'status': 503,
+                'headers': [(b'content-type', b'application/json'),
+                            (b'retry-after', b'1')],
+            })
+            await send({
+                'type': 'http.response.body',
+                'body': json.dumps({'messages': [str(ex)]}).encode('utf-8'),
+            })
+            return
+
+        async def watch_disconnect():
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    subscription.close()
+                    return
+
+        watcher = asyncio.ensure_future(watch_disconnect())
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': [
+                    (b'content-type', b'text/event-stream; charset=utf-8'),
+                    (b'cache-control', b'no-cache'),
+                ],
+            })
+            history = []
+            if last_seq is not None:
+                try:
+                    history = await self.event_hub.history(gid, last_seq)
+                except (ConnectionError, TimeoutError):
+                    # Too late for a 503: end the stream, so the client
+                    # reconnects and reads the history again
+                    subscription.close()
+            for message in history:
+                last_seq = message[2]
+                await send({
+                    'type': 'http.response.body',
+                    'body': format_event(*message).encode('utf-8'),
+                    'more_body': True,
+                })
+            while not subscription.closed:
+                message = await subscription.pop(self.keepalive)
+                if message is None:
+                    frame = KEEPALIVE_FRAME
+                elif last_seq is not None and message[2] is not None \
+                        and message[2] <= last_seq:
+                    continue
+                else:
+                    frame = format_event(*message)
+                await send({
+                    'type': 'http.response.body',
+                    'body': frame.encode('utf-8'),
+                    'more_body': True,
+                })
+            if not watcher.done():
+                await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            watcher.cancel()
+            self.event_hub.unsubscribe(subscription)
+
+    async def wsgi(self, scope, receive, send):
+        body = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            body.append(message.get('body', b''))
+            more_body = message.get('more_body', False)
+        environ = build_environ(scope, b''.join(body))
+        loop = asyncio.get_event_loop()
+        status, headers, response_body = await loop.run_in_executor(
+            self.executor, call_wsgi, self.wsgi_app, environ)
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(name.lower().encode('latin-1'),
+                         value.encode('latin-1'))
+                        for name, value in headers],
+        })
+        await send({'type': 'http.response.body', 'body': response_body})
+
+
+def create_async_client(url, socket_timeout):
+    return redis.asyncio.StrictRedis.from_url(
+        url,
+        max_connections=REDIS_OPTIONS['max_connections'],
+        socket_timeout=socket_timeout,
+        socket_connect_timeout=REDIS_OPTIONS['connect_timeout'],
+        socket_keepalive=True,
+        health_check_interval=REDIS_OPTIONS['health_check_interval'],
+        decode_responses=True)
+
+
+def create_async_shards(socket_timeout):
+    return sharding.HashRing([create_async_client(url, socket_timeout)
+                              for url in SHARD_URLS], SHARD_URLS)
+
+
+async_shards = create_async_shards(REDIS_OPTIONS['socket_timeout'])
+# The pub/sub connections wait for messages without a timeout
+async_pubsub_shards = create_async_shards(None)
+
+application = Application(app, AsyncEventHub(
+    async_shards, max_buffer=EVENT_BUFFER_SIZE,
+    pubsub_shards=async_pubsub_shards))
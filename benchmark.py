@@ -0,0 +1,277 @@
+"""
+Benchmark of the REST API hot paths.
+
+Plays complete games through the Flask test client: creates and
+authenticates users, creates games, joins and starts them, makes every move
+and, after each move, polls the game like the web client does. Reports
+latency percentiles, Redis commands and round trips per request for every
+endpoint, and the overall throughput.
+
+Run against a local redis-server (REDIS_HOST, the default is localhost)::
+
+    python benchmark.py --games 20
+
+or against an in-process fake (requires the fakeredis package)::
+
+    python benchmark.py --fake
+
+The Redis database is not cleaned up, so don't point it at production data.
+"""
+import argparse
+import base64
+import binascii
+import collections
+import json
+import os
+import random
+import sys
+import time
+
+import redis
+
+
+class RedisCounter:
+    """
+    Counts Redis commands and round trips by wrapping the client classes.
+    """
+    def __init__(self):
+        self.commands = 0
+        self.round_trips = 0
+        self.enabled = True
+
+    def install(self):
+        counter = self
+        execute_command = redis.client.Redis.execute_command
+        execute_pipeline = redis.client.Pipeline.execute
+
+        def counted_execute_command(client, *args, **options):
+            if counter.enabled:
+                counter.commands += 1
+                counter.round_trips += 1
+            return execute_command(client, *args, **options)
+
+        def counted_execute_pipeline(pipeline, *args, **kwargs):
+            if counter.enabled:
+                counter.commands += len(pipeline.command_stack)
+                counter.round_trips += 1
+            return execute_pipeline(pipeline, *args, **kwargs)
+
+        redis.client.Redis.execute_command = counted_execute_command
+        redis.client.Pipeline.execute = counted_execute_pipeline
+
+    def reset(self):
+        self.commands = 0
+        self.round_trips = 0
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.commands = collections.defaultdict(list)
+        self.round_trips = collections.defaultdict(list)
+
+    def add(self, endpoint, latency, commands, round_trips):
+        self.latencies[endpoint].append(latency)
+        self.commands[endpoint].append(commands)
+        self.round_trips[endpoint].append(round_trips)
+
+    def report(self):
+        rows = []
+        for endpoint in sorted(self.latencies):
+            latencies = sorted(self.latencies[endpoint])
+            count = len(latencies)
+            rows.append({
+                'endpoint': endpoint,
+                'requests': count,
+                'p50_ms': 1000 * percentile(latencies, 50),
+                'p90_ms': 1000 * percentile(latencies, 90),
+                'p99_ms': 1000 * percentile(latencies, 99),
+                'max_ms': 1000 * latencies[-1],
+                'commands': sum(self.commands[endpoint]) / count,
+                'round_trips': sum(self.round_trips[endpoint]) / count,
+            })
+        return rows
+
+
+def percentile(values, percent):
+    index = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+    return values[index]
+
+
+class Benchmark:
+    def __init__(self, app, counter, rng):
+        self.app = app
+        self.client = app.test_client()
+        self.counter = counter
+        self.rng = rng
+        self.stats = Stats()
+        self.adapter = app.url_map.bind('localhost')
+        # Responses to GET requests by (path, username), revalidated with
+        # If-None-Match like a browser does
+        self.cache = {}
+
+    def request(self, method, path, username=None, data=None,
+                expected=(200,)):
+        headers = {}
+        if username is not None:
+            credentials = '{}:{}'.format(username, username).encode('utf-8')
+            token = base64.b64encode(credentials).decode('ascii')
+            headers['Authorization'] = 'Basic {}'.format(token)
+        cached = None
+        if method == 'GET':
+            cached = self.cache.get((path, username))
+            if cached is not None:
+                headers['If-None-Match'] = cached[0]
+        body = None
+        if data is not None:
+            headers['Content-Type'] = 'application/json'
+            body = json.dumps(data)
+        endpoint, _ = self.adapter.match(path.split('?')[0], method)
+        self.counter.reset()
+        start = time.perf_counter()
+        response = self.client.open(path, method=method, headers=headers,
+                                    data=body)
+        latency = time.perf_counter() - start
+        self.stats.add('{} {}'.format(method, endpoint), latency,
+                       self.counter.commands, self.counter.round_trips)
+        if response.status_code == 304 and cached is not None:
+            return cached[1]
+        if response.status_code not in expected:
+            raise RuntimeError('{} {} returned {}: {}'.format(
+                method, path, response.status_code, response.data))
+        if response.data and response.mimetype == 'application/json':
+            result = json.loads(response.data.decode('utf-8'))
+            etag = response.headers.get('ETag')
+            if method == 'GET' and etag:
+                self.cache[(path, username)] = (etag, result)
+            return result
+
+    def play_game(self, usernames):
+        owner = usernames[0]
+        game = self.request('POST', '/games', owner, {'name': 'benchmark'},
+                            expected=(201,))
+        gid = game['gid']
+        pids = {}
+        for username in usernames:
+            player = self.request('POST', '/games/{}/players'.format(gid),
+                                  username, expected=(201,))
+            pids[player['pid']] = username
+        game = self.request('GET', '/games/{}'.format(gid))
+        game['state'] = 'started'
+        self.request('PUT', '/games/{}'.format(gid), owner, game,
+                     expected=(204,))
+
+        moves = 0
+        while True:
+            game = self.request('GET', '/games/{}'.format(gid))
+            if game['state'] == 'ended':
+                return moves
+            pid = game['currentPlayer']
+            move = self.choose_move(gid, pid)
+            self.request('POST', '/games/{}/players/{}/moves'.format(gid, pid),
+                         pids[pid], move)
+            moves += 1
+            for username_pid, username in pids.items():
+                self.poll(gid, username_pid, username)
+
+    def poll(self, gid, pid, username):
+        self.request('GET', '/games/{}'.format(gid), username)
+        self.request('GET', '/games/{}/players'.format(gid), username)
+        self.request('GET', '/games/{}/players/{}/hand'.format(gid, pid),
+                     username)
+
+    def choose_move(self, gid, pid):
+        # Picking the move is the client's job, so it isn't measured
+        import bot
+        from models import Game
+        self.counter.enabled = False
+        try:
+            state = Game(gid).get_snapshot().to_engine()
+            return bot.choose_move(state, pid, self.rng)
+        finally:
+            self.counter.enabled = True
+
+    def run(self, games, players):
+        # Unique usernames, so the benchmark can run again on the same data
+        prefix = 'bench-{}'.format(binascii.hexlify(os.urandom(4)).decode())
+        start = time.perf_counter()
+        usernames = []
+        for i in range(players):
+            username = '{}-{}'.format(prefix, i)
+            self.request('POST', '/users', data={'username': username,
+                                                 'password': username},
+                         expected=(201,))
+            usernames.append(username)
+        moves = 0
+        for i in range(games):
+            self.rng.shuffle(usernames)
+            moves += self.play_game(usernames)
+        self.request('GET', '/games?limit=50')
+        self.request('GET', '/users')
+        self.request('GET', '/leaderboard')
+        elapsed = time.perf_counter() - start
+        requests = sum(len(values) for values in self.stats.latencies.values())
+        return {
+            'games': games,
+            'moves': moves,
+            'requests': requests,
+            'seconds': elapsed,
+            'requests_per_second': requests / elapsed,
+            'endpoints': self.stats.report(),
+        }
+
+
+def print_report(result, out=sys.stdout):
+    header = '{:<28} {:>8} {:>8} {:>8} {:>8} {:>8} {:>9} {:>11}'
+    row = '{:<28} {:>8} {:>8.2f} {:>8.2f} {:>8.2f} {:>8.2f} {:>9.1f} {:>11.1f}'
+    print(header.format('endpoint', 'requests', 'p50 ms', 'p90 ms', 'p99 ms',
+                        'max ms', 'commands', 'round trips'), file=out)
+    for endpoint in result['endpoints']:
+        print(row.format(endpoint['endpoint'], endpoint['requests'],
+                         endpoint['p50_ms'], endpoint['p90_ms'],
+                         endpoint['p99_ms'], endpoint['max_ms'],
+                         endpoint['commands'], endpoint['round_trips']),
+              file=out)
+    print(file=out)
+    print('{games} games, {moves} moves, {requests} requests in '
+          '{seconds:.2f}s ({requests_per_second:.0f} requests/s)'
+          .format(**result), file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+                                     epilog='See the module docstring.')
+    parser.add_argument('--games', type=int, default=10,
+                        help='number of games to play (default: 10)')
+    parser.add_argument('--players', type=int, default=4, choices=range(3, 6),
+                        help='players per game (default: 4)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed (default: 0)')
+    parser.add_argument('--fake', action='store_true',
+                        help='use an in-process fake Redis (fakeredis)')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args()
+
+    if args.fake:
+        import connections
+        import fakeredis
+        server = fakeredis.FakeServer()
+        connections.create_client = \
+            lambda url, **options: fakeredis.FakeStrictRedis(
+                server=server, decode_responses=True)
+    counter = RedisCounter()
+    counter.install()
+
+    # Imported only now, so the app uses the fake client if requested
+    from shinobi import app
+    benchmark = Benchmark(app, counter, random.Random(args.seed))
+    result = benchmark.run(args.games, args.players)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
+
+
+if __name__ == '__main__':
+    main()
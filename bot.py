@@ -0,0 +1,75 @@
+"""
+A computer player.
+
+The bot only uses information a human player would have: its own hand and
+color and the province counts. It picks the orders of a move one at a time,
+each one maximizing the change of a simple score: cards of its own color
+anywhere count for it, cards of other colors count slightly against it.
+"""
+import random
+
+from engine import COLORS, MoveValidator
+
+
+OWN_COLOR_WEIGHT = 3
+OTHER_COLOR_WEIGHT = -0.25
+OWN_PROVINCE_BONUS = 0.5
+
+
+def order_value(validator, color, order):
+    if order is None:
+        return 0
+    changes = []
+    if order['type'] == 'deploy':
+        changes.append((order['to'], order['color'], 1))
+    elif order['type'] in ('ninja', 'attack'):
+        changes.append((order['to'], order['color'], -1))
+    elif order['type'] == 'transfer':
+        changes.append((order['from'], order['color'], -1))
+        changes.append((order['to'], order['color'], 1))
+    value = 0
+    for pid, card_color, amount in changes:
+        if card_color == color:
+            value += OWN_COLOR_WEIGHT * amount
+            if pid == validator.pid:
+                value += OWN_PROVINCE_BONUS * amount
+        else:
+            value += OTHER_COLOR_WEIGHT * amount
+    return value
+
+
+def pick(validator, color, orders, rng):
+    best_orders = []
+    best_value = None
+    for order in orders:
+        value = order_value(validator, color, order)
+        if best_value is None or value > best_value:
+            best_orders, best_value = [order], value
+        elif value == best_value:
+            best_orders.append(order)
+    if best_orders:
+        return rng.choice(best_orders)
+
+
+def choose_move(state, pid, rng=random):
+    """
+    Returns a legal move for player ``pid``, or None if there is none.
+    """
+    player = state.get_player(pid)
+    color = COLORS[player.color]
+    validator = MoveValidator(state, pid)
+
+    # Try first orders from the best one, in case the best one leaves no
+    # legal second order
+    first_orders = list(validator.first_orders())
+    rng.shuffle(first_orders)
+    first_orders.sort(key=lambda order: -order_value(validator, color, order))
+    for first in first_orders:
+        after_first = validator.copy()
+        after_first.validate_first(first)
+        second = pick(after_first, color, after_first.second_orders(), rng)
+        if second is None:
+            continue
+        after_first.validate_second(second)
+        third = pick(after_first, color, after_first.third_orders(), rng)
+        return {'first': first, 'second': second, 'third': third}
@@ -0,0 +1,90 @@
+import collections
+import json
+import threading
+import time
+
+
+class LRUCache:
+    """
+    A thread-safe, size-bounded cache evicting the least recently used keys.
+
+    If ``ttl`` is given, entries also expire ``ttl`` seconds after being set.
+    """
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires is not None and expires <= time.monotonic():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def delete_matching(self, predicate):
+        with self.lock:
+            for key in [key for key in self.entries if predicate(key)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class VersionedCache:
+    """
+    Caches JSON-serializable dicts that have their version in ``'seq'``,
+    in a process-local LRUCache in front of Redis, so the processes share
+    the work of computing them.
+
+    ``client`` and ``key`` are functions returning the Redis client and key
+    for an id. Values are only returned for the version asked for, so an
+    outdated copy is never used even if writers haven't deleted it yet.
+    """
+    def __init__(self, client, key, max_size, ttl):
+        self.client = client
+        self.key = key
+        self.ttl = ttl
+        self.local = LRUCache(max_size)
+
+    def get(self, id, version, compute):
+        """
+        Returns the value of ``id`` at ``version``, or if it isn't cached
+        the value returned by ``compute``, which may be newer, or None.
+        """
+        if version is not None:
+            value = self.local.get(id)
+            if value is not None and value['seq'] == version:
+                return value
+            data = self.client(id).get(self.key(id))
+            if data is not None:
+                value = json.loads(data)
+                if value['seq'] == version:
+                    self.local.set(id, value)
+                    return value
+        value = compute()
+        if value is not None:
+            self.client(id).set(self.key(id), json.dumps(value), ex=self.ttl)
+            self.local.set(id, value)
+        return value
@@ -0,0 +1,168 @@
+"""
+Redis clients that fail instead of hanging when Redis is unavailable.
+
+Clients get a blocking connection pool, so a burst of requests waits a
+bounded time for a free connection instead of opening more and more
+connections, and socket timeouts, so a request fails when the server stops
+answering instead of blocking its thread forever. A circuit breaker makes
+commands fail immediately after repeated connection failures, until Redis is
+reachable again.
+"""
+import math
+import threading
+import time
+
+import redis
+from redis.backoff import ExponentialBackoff, NoBackoff
+from redis.exceptions import ConnectionError, TimeoutError
+from redis.retry import Retry
+
+
+class ConnectRetryMixin:
+    """
+    Retries connecting up to ``connect_retries`` times with exponential
+    backoff, and never retries a command, whatever the redis-py version
+    would do by default.
+    """
+    def __init__(self, connect_retries=2, **kwargs):
+        kwargs['retry'] = Retry(NoBackoff(), 0)
+        super().__init__(**kwargs)
+        # Waits 0.05, 0.1, 0.2, ... seconds, at most 1, between attempts
+        self.connect_retry = Retry(ExponentialBackoff(cap=1, base=0.05),
+                                   connect_retries)
+
+    def connect(self):
+        if self._sock:
+            return
+        self.connect_retry.call_with_retry(super().connect, self.disconnect)
+
+
+class RetryConnection(ConnectRetryMixin, redis.Connection):
+    pass
+
+
+class RetrySSLConnection(ConnectRetryMixin, redis.SSLConnection):
+    pass
+
+
+class RetryUnixDomainSocketConnection(ConnectRetryMixin,
+                                      redis.UnixDomainSocketConnection):
+    pass
+
+
+RETRY_CONNECTION_CLASSES = {
+    redis.Connection: RetryConnection,
+    redis.SSLConnection: RetrySSLConnection,
+    redis.UnixDomainSocketConnection: RetryUnixDomainSocketConnection,
+}
+
+
+def create_client(url, max_connections=50, pool_timeout=5, socket_timeout=5,
+                  connect_timeout=2, health_check_interval=30,
+                  connect_retries=2):
+    """
+    Returns a client for the Redis server at ``url`` (``redis://host:port/db``
+    or ``unix:///path/to/socket``).
+
+    Waits up to ``pool_timeout`` seconds for a free connection once
+    ``max_connections`` are in use. A ``socket_timeout`` of None waits for
+    replies forever, which pub/sub connections need. Only connecting is
+    retried, as commands aren't idempotent.
+    """
+    pool = redis.BlockingConnectionPool.from_url(
+        url,
+        max_connections=max_connections,
+        timeout=pool_timeout,
+        socket_timeout=socket_timeout,
+        socket_connect_timeout=connect_timeout,
+        socket_keepalive=True,
+        health_check_interval=health_check_interval,
+        connect_retries=connect_retries,
+        decode_responses=True)
+    # The scheme of the URL chooses the connection class
+    pool.connection_class = RETRY_CONNECTION_CLASSES[pool.connection_class]
+    return redis.StrictRedis(connection_pool=pool)
+
+
+class CircuitOpenError(ConnectionError):
+    def __init__(self, retry_after):
+        super().__init__('Redis is unavailable')
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Fails the commands of protected clients with CircuitOpenError for
+    ``reset_timeout`` seconds after ``threshold`` consecutive connection
+    errors or timeouts. After that one command is let through, and the
+    circuit closes again if it succeeds.
+    """
+    def __init__(self, threshold=5, reset_timeout=10):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            elapsed = time.monotonic() - self.opened_at
+            if elapsed < self.reset_timeout:
+                raise CircuitOpenError(
+                    math.ceil(self.reset_timeout - elapsed))
+            # Let this call probe the server, failing the others meanwhile
+            self.opened_at = time.monotonic()
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+    def call(self, func, *args, **kwargs):
+        self.before_call()
+        try:
+            result = func(*args, **kwargs)
+        except (ConnectionError, TimeoutError):
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+    def protect(self, client):
+        """
+        Routes the commands of ``client`` and its pipelines through the
+        circuit breaker.
+        """
+        execute_command = client.execute_command
+        pipeline = client.pipeline
+
+        def protected_execute_command(*args, **options):
+            return self.call(execute_command, *args, **options)
+
+        def protected_pipeline(*args, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+            execute = pipe.execute
+            immediate_execute_command = pipe.immediate_execute_command
+
+            def protected_execute(*args, **kwargs):
+                return self.call(execute, *args, **kwargs)
+
+            def protected_immediate_execute_command(*args, **options):
+                return self.call(immediate_execute_command, *args, **options)
+
+            pipe.execute = protected_execute
+            pipe.immediate_execute_command = \
+                protected_immediate_execute_command
+            return pipe
+
+        client.execute_command = protected_execute_command
+        client.pipeline = protected_pipeline
+        return client
@@ -0,0 +1,490 @@
+"""
+The rules of Shinobi, independent of any storage.
+
+Cards are stored as small integer codes: the index of the color in COLORS,
+or NINJA_CODE for a ninja card. A GameState can be created from any source
+(Redis, a JSON dump, a simulation) and mutated with start() and apply_move().
+"""
+import array
+import random
+
+
+COLORS = ('yellow', 'red', 'purple', 'green', 'blue')
+NINJA = 'ninja'
+CARDS = COLORS + (NINJA,)
+NINJA_CODE = len(COLORS)
+CARD_CODES = {card: code for code, card in enumerate(CARDS)}
+
+HAND_SIZE = 4
+# Number of cards of each of CARDS in a new deck
+DECK_COUNTS = (11,) * len(COLORS) + (3,)
+MIN_PLAYERS = 3
+MAX_PLAYERS = 5
+
+
+def new_deck(rng=random, counts=DECK_COUNTS):
+    deck = [card for card, count in enumerate(counts) for _ in range(count)]
+    rng.shuffle(deck)
+    return array.array('b', deck)
+
+
+def encode_cards(cards):
+    return ''.join(str(card) for card in cards)
+
+
+def decode_cards(text):
+    return [int(card) for card in text]
+
+
+def best(scores):
+    max_score = max([score for player, score in scores])
+    return [player for player, score in scores if score == max_score]
+
+
+class PlayerState:
+    __slots__ = ('pid', 'name', 'color', 'hand', 'cards')
+
+    def __init__(self, pid, name=None, color=None, hand=(), cards=None):
+        self.pid = pid
+        self.name = name if name is not None else str(pid)
+        self.color = color
+        self.hand = array.array('b', hand)
+        self.cards = array.array('h', cards or [0] * len(COLORS))
+
+    @staticmethod
+    def from_names(pid, name, color, hand, cards):
+        return PlayerState(
+            pid, name,
+            CARD_CODES[color] if color else None,
+            [CARD_CODES[card] for card in hand],
+            [cards.get(color, 0) for color in COLORS],
+        )
+
+    def copy(self):
+        return PlayerState(self.pid, self.name, self.color,
+                           self.hand, self.cards)
+
+    def get_color_name(self):
+        if self.color is not None:
+            return COLORS[self.color]
+
+    def get_hand_names(self):
+        return [CARDS[card] for card in self.hand]
+
+    def get_cards_dict(self):
+        return dict(zip(COLORS, self.cards))
+
+
+class GameState:
+    __slots__ = ('state', 'players', 'deck', 'current_pid', 'last_pid',
+                 'winner_pids')
+
+    def __init__(self, players, state='setup', deck=(), current_pid=None,
+                 last_pid=None, winner_pids=()):
+        self.state = state
+        self.players = list(players)
+        self.deck = array.array('b', deck)
+        self.current_pid = current_pid
+        self.last_pid = last_pid
+        self.winner_pids = list(winner_pids)
+
+    def copy(self):
+        return GameState([player.copy() for player in self.players],
+                         self.state, self.deck, self.current_pid,
+                         self.last_pid, self.winner_pids)
+
+    def dump(self):
+        """
+        Returns the whole state as compact JSON-serializable data.
+        """
+        return {
+            'state': self.state,
+            'deck': encode_cards(self.deck),
+            'current': self.current_pid,
+            'last': self.last_pid,
+            'winners': list(self.winner_pids),
+            'players': [[player.pid, player.name, player.color,
+                         encode_cards(player.hand), list(player.cards)]
+                        for player in self.players],
+        }
+
+    @staticmethod
+    def load(data):
+        players = [PlayerState(pid, name, color, decode_cards(hand), cards)
+                   for pid, name, color, hand, cards in data['players']]
+        return GameState(players, data['state'], decode_cards(data['deck']),
+                         data['current'], data['last'], data['winners'])
+
+    def get_pids(self):
+        return [player.pid for player in self.players]
+
+    def get_player(self, pid):
+        for player in self.players:
+            if player.pid == pid:
+                return player
+
+    def start(self, rng=random, deck_counts=DECK_COUNTS):
+        self.deck = new_deck(rng, deck_counts)
+        colors = list(range(len(COLORS)))
+        rng.shuffle(colors)
+        for player in self.players:
+            player.color = colors.pop()
+            self.draw_cards(player)
+        self.current_pid = rng.choice(self.players).pid
+        self.state = 'started'
+
+    def draw_cards(self, player):
+        count = min(HAND_SIZE - len(player.hand), len(self.deck))
+        if count > 0:
+            player.hand.extend(self.deck[:count])
+            del self.deck[:count]
+        return max(count, 0)
+
+    def next_pid(self, pid):
+        pids = self.get_pids()
+        return pids[(pids.index(pid) + 1) % len(pids)]
+
+    def validate_move(self, pid, move):
+        """
+        Validates a move of player ``pid``. A move of None passes the turn,
+        which is only allowed if the player has no legal move.
+        """
+        if move is None:
+            if next(self.legal_moves(pid), None) is not None:
+                return False, ['You must move if you can']
+            return True, []
+        return MoveValidator(self, pid).validate(move)
+
+    def legal_moves(self, pid):
+        return MoveValidator(self, pid).legal_moves()
+
+    def apply_move(self, pid, move):
+        """
+        Applies a valid move of player ``pid``, or passes the turn if
+        ``move`` is None, and returns a delta describing the changes: the
+        orders, the cards played from the hand, the changes of province
+        counts, the number of cards drawn and the next player or the winners.
+        """
+        player = self.get_player(pid)
+        orders = []
+        if move is not None:
+            orders = [move['first'], move['second'], move['third']]
+        delta = {
+            'player': pid,
+            'orders': orders,
+            'played': [],
+            'cards': [],
+            'drawn': 0,
+            'deck_size': 0,
+            'last_player': None,
+            'next_player': None,
+            'winners': None,
+        }
+
+        def change(to_pid, color, amount):
+            self.get_player(to_pid).cards[CARD_CODES[color]] += amount
+            delta['cards'].append([to_pid, color, amount])
+
+        def play(card):
+            player.hand.remove(CARD_CODES[card])
+            delta['played'].append(card)
+
+        for order in orders:
+            if not order:
+                continue
+            if order['type'] == 'deploy':
+                play(order['color'])
+                change(order['to'], order['color'], 1)
+            elif order['type'] == 'ninja':
+                play(NINJA)
+                change(order['to'], order['color'], -1)
+            elif order['type'] == 'transfer':
+                change(order['from'], order['color'], -1)
+                change(order['to'], order['color'], 1)
+            elif order['type'] == 'attack':
+                change(order['to'], order['color'], -1)
+
+        delta['drawn'] = self.draw_cards(player)
+        delta['deck_size'] = len(self.deck)
+        last_pid = self.last_pid
+        if not last_pid and not self.deck:
+            self.last_pid = pid
+            delta['last_player'] = pid
+        if pid == last_pid:
+            self.end()
+            delta['winners'] = list(self.winner_pids)
+        else:
+            self.current_pid = self.next_pid(pid)
+            delta['next_player'] = self.current_pid
+        return delta
+
+    def end(self):
+        self.winner_pids = self.find_winners()
+        self.state = 'ended'
+
+    def find_winners(self):
+        color_counts = [0] * len(COLORS)
+        for player in self.players:
+            for color, count in enumerate(player.cards):
+                color_counts[color] += count
+        scores = [(player, color_counts[player.color])
+                  for player in self.players]
+        winners = best(scores)
+        if len(winners) > 1:
+            winners = best([(player, player.cards[player.color])
+                            for player in winners])
+        return [player.pid for player in winners]
+
+    def describe_order(self, order):
+        if not order:
+            return None
+        color = order['color']
+        if order['type'] == 'transfer':
+            from_name = self.get_player(order['from']).name
+            to_name = self.get_player(order['to']).name
+            return 'transfered {} from {} to {}' \
+                   .format(color, from_name, to_name)
+        to_name = self.get_player(order['to']).name
+        if order['type'] == 'deploy':
+            return 'deployed {} to {}'.format(color, to_name)
+        elif order['type'] == 'ninja':
+            return "killed {} in {}'s province".format(color, to_name)
+        elif order['type'] == 'attack':
+            return "attacked {} in {}'s province".format(color, to_name)
+
+
+class MoveValidator:
+    """
+    Checks the orders of a move one by one against a scratch copy of the
+    player's hand and the province counts.
+    """
+    __slots__ = ('game', 'pid', 'hand', 'cards', 'dirty')
+
+    def __init__(self, game, pid, hand=None, cards=None, dirty=None):
+        self.game = game
+        self.pid = pid
+        if hand is None:
+            hand = game.get_player(pid).hand
+        if cards is None:
+            cards = {player.pid: player.cards for player in game.players}
+        self.hand = list(hand)
+        self.cards = {pid: list(counts) for pid, counts in cards.items()}
+        self.dirty = set(dirty or ())
+
+    def copy(self):
+        return MoveValidator(self.game, self.pid, self.hand, self.cards,
+                             self.dirty)
+
+    def validate(self, move):
+        all_orders = 'first' in move and 'second' in move and 'third' in move
+        if not all_orders:
+            return False, ['Incomplete move']
+        results = [
+            self.validate_first(move['first']),
+            self.validate_second(move['second']),
+            self.validate_third(move['third']),
+        ]
+        oks, messages = zip(*results)
+        return all(oks), list(messages)
+
+    def check_order(self, order, *pid_fields):
+        if order.get('color') not in CARD_CODES:
+            return 'Unknown color {}'.format(order.get('color'))
+        for field in pid_fields:
+            if order.get(field) not in self.cards:
+                return 'No such player: {}'.format(order.get(field))
+
+    def name(self, pid):
+        return self.game.get_player(pid).name
+
+    def validate_first(self, order):
+        if not order or 'type' not in order:
+            return False, 'No type for first order'
+        if order['type'] == 'deploy':
+            return self.validate_first_deploy(order)
+        if order['type'] == 'ninja':
+            return self.validate_ninja(order)
+        return False, 'Wrong type for first order'
+
+    def validate_second(self, order):
+        if not order or 'type' not in order:
+            return False, 'No type for second order'
+        if order['type'] == 'deploy':
+            return self.validate_second_deploy(order)
+        if order['type'] == 'transfer':
+            return self.validate_transfer(order)
+        return False, 'Wrong type for second order'
+
+    def validate_third(self, order):
+        if order is None:
+            return self.validate_no_attack()
+        if 'type' not in order:
+            return False, 'No type for third order'
+        if order['type'] == 'attack':
+            return self.validate_attack(order)
+        return False, 'Wrong type for third order'
+
+    def validate_deploy(self, order):
+        error = self.check_order(order, 'to')
+        if error:
+            return error
+        color = order['color']
+        if color == NINJA:
+            return 'You cannot deploy a ninja card'
+        if CARD_CODES[color] not in self.hand:
+            return 'You do not have a {} card to deploy'.format(color)
+
+    def validate_first_deploy(self, order):
+        error = self.validate_deploy(order)
+        if error:
+            return False, error
+        to_pid = order['to']
+        color = CARD_CODES[order['color']]
+        if to_pid == self.pid:
+            return False, 'You cannot deploy to your own ' \
+                          'province in the first order'
+        self.hand.remove(color)
+        self.cards[to_pid][color] += 1
+        self.dirty.add((to_pid, color))
+        return True, ''
+
+    def validate_second_deploy(self, order):
+        error = self.validate_deploy(order)
+        if error:
+            return False, error
+        to_pid = order['to']
+        color = CARD_CODES[order['color']]
+        if to_pid != self.pid:
+            return False, "You cannot deploy to an enemy's " \
+                          "province in the second order"
+        self.hand.remove(color)
+        self.cards[to_pid][color] += 1
+        return True, ''
+
+    def validate_ninja(self, order):
+        error = self.check_order(order, 'to')
+        if error:
+            return False, error
+        to_pid = order['to']
+        color = CARD_CODES[order['color']]
+        if NINJA_CODE not in self.hand:
+            return False, 'You do not have a ninja card'
+        if color == NINJA_CODE or self.cards[to_pid][color] <= 0:
+            return False, '{} does not have a {} card' \
+                          .format(self.name(to_pid), order['color'])
+        self.hand.remove(NINJA_CODE)
+        self.cards[to_pid][color] -= 1
+        return True, ''
+
+    def validate_transfer(self, order):
+        error = self.check_order(order, 'from', 'to')
+        if error:
+            return False, error
+        from_pid = order['from']
+        to_pid = order['to']
+        color = CARD_CODES[order['color']]
+        if from_pid == self.pid:
+            return False, 'You cannot transfer from your own province'
+        if color == NINJA_CODE or self.cards[from_pid][color] <= 0:
+            return False, '{} does not have a {} card' \
+                          .format(self.name(from_pid), order['color'])
+        self.cards[from_pid][color] -= 1
+        self.cards[to_pid][color] += 1
+        return True, ''
+
+    def validate_attack(self, order):
+        error = self.check_order(order, 'to')
+        if error:
+            return False, error
+        to_pid = order['to']
+        color = CARD_CODES[order['color']]
+        if (to_pid != self.pid and color != NINJA_CODE and
+                self.cards[to_pid][color] > 0 and
+                self.can_attack(to_pid, color)):
+            return True, ''
+        else:
+            return False, 'You cannot attack {} {}' \
+                          .format(self.name(to_pid), order['color'])
+
+    def validate_no_attack(self):
+        if all(not self.can_attack(pid, color)
+               for pid, color in self.enemy_stacks()):
+            return True, ''
+        else:
+            return False, 'You must attack if you can'
+
+    def enemy_stacks(self):
+        for pid, cards in self.cards.items():
+            if pid == self.pid:
+                continue
+            for color, count in enumerate(cards):
+                if count > 0:
+                    yield (pid, color)
+
+    def can_attack(self, enemy_pid, enemy_color):
+        if (enemy_pid, enemy_color) in self.dirty:
+            return False
+        enemy_count = self.cards[enemy_pid][enemy_color]
+        return any(count > enemy_count and color != enemy_color
+                   for color, count in enumerate(self.cards[self.pid]))
+
+    def legal_moves(self):
+        """
+        Generates every legal move, as (first, second, third) combinations
+        of orders that validate() accepts.
+        """
+        for first in self.first_orders():
+            after_first = self.copy()
+            after_first.validate_first(first)
+            for second in after_first.second_orders():
+                after_second = after_first.copy()
+                after_second.validate_second(second)
+                for third in after_second.third_orders():
+                    yield {'first': first, 'second': second, 'third': third}
+
+    def first_orders(self):
+        for card in sorted(set(self.hand)):
+            if card == NINJA_CODE:
+                for pid, color in self.stacks():
+                    yield {'type': 'ninja', 'to': pid, 'color': COLORS[color]}
+            else:
+                for pid in self.cards:
+                    if pid != self.pid:
+                        yield {'type': 'deploy', 'to': pid,
+                               'color': COLORS[card]}
+
+    def second_orders(self):
+        for card in sorted(set(self.hand)):
+            if card != NINJA_CODE:
+                yield {'type': 'deploy', 'to': self.pid,
+                       'color': COLORS[card]}
+        # A transfer within a province changes nothing, but it is legal
+        for from_pid, color in self.enemy_stacks():
+            for to_pid in self.cards:
+                yield {'type': 'transfer', 'from': from_pid,
+                       'to': to_pid, 'color': COLORS[color]}
+
+    def third_orders(self):
+        # Instead of calling can_attack for every stack, compare each stack
+        # with the two biggest stacks of the player's province at once
+        my_cards = self.cards[self.pid]
+        biggest = max(range(len(COLORS)), key=my_cards.__getitem__)
+        second = max(count for color, count in enumerate(my_cards)
+                     if color != biggest)
+        can_attack = False
+        for pid, color in self.enemy_stacks():
+            if (pid, color) in self.dirty:
+                continue
+            count = self.cards[pid][color]
+            if second > count or (color != biggest and
+                                  my_cards[biggest] > count):
+                can_attack = True
+                yield {'type': 'attack', 'to': pid, 'color': COLORS[color]}
+        if not can_attack:
+            yield None
+
+    def stacks(self):
+        for pid, cards in self.cards.items():
+            for color, count in enumerate(cards):
+                if count > 0:
+                    yield (pid, color)
@@ -0,0 +1,299 @@
+import asyncio
+import collections
+import json
+import threading
+import time
+
+from redis.exceptions import ConnectionError, TimeoutError
+
+import sharding
+
+
+KEEPALIVE_FRAME = ':\n\n'
+
+
+def format_event(event, data, seq=None):
+    if seq is None:
+        return 'event: {}\ndata: {}\n\n'.format(event, data)
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(seq, event, data)
+
+
+def event_seq(data):
+    try:
+        return int(json.loads(data)['seq'])
+    except (ValueError, TypeError, KeyError):
+        return None
+
+
+def parse_last_event_id(value):
+    """
+    Returns the seq of a Last-Event-ID header value, or None if it's invalid.
+    """
+    try:
+        seq = int(value)
+    except (ValueError, TypeError):
+        return None
+    return seq if seq >= 0 else None
+
+
+class Subscription:
+    def __init__(self, gid, max_buffer):
+        self.gid = gid
+        self.max_buffer = max_buffer
+        self.buffer = collections.deque()
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def push(self, event, data, seq=None):
+        with self.condition:
+            if self.closed:
+                return False
+            if len(self.buffer) >= self.max_buffer:
+                # Slow consumer: drop it instead of buffering without bound.
+                # The client's EventSource will reconnect on its own and
+                # resume from the last event it got.
+                self.closed = True
+            else:
+                self.buffer.append((event, data, seq))
+            self.condition.notify()
+            return not self.closed
+
+    def pop(self, timeout):
+        with self.condition:
+            if not self.buffer and not self.closed:
+                self.condition.wait(timeout)
+            if self.buffer:
+                return self.buffer.popleft()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+
+class AsyncSubscription:
+    def __init__(self, gid, max_buffer):
+        self.gid = gid
+        self.max_buffer = max_buffer
+        self.buffer = collections.deque()
+        self.ready = asyncio.Event()
+        self.closed = False
+
+    def push(self, event, data, seq=None):
+        if self.closed:
+            return False
+        if len(self.buffer) >= self.max_buffer:
+            self.closed = True
+        else:
+            self.buffer.append((event, data, seq))
+        self.ready.set()
+        return not self.closed
+
+    async def pop(self, timeout):
+        if not self.buffer and not self.closed:
+            self.ready.clear()
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        if self.buffer:
+            return self.buffer.popleft()
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+
+
+class EventHub:
+    """
+    Fans out game events to all SSE clients of this process.
+
+    Keeps one pattern subscription to every game channel on each shard (a
+    ``sharding.HashRing`` of clients) and dispatches the messages to
+    in-process subscriptions by gid, so the number of Redis connections
+    doesn't grow with the number of clients. Past events are read from the
+    game's event stream with ``history``. The subscriptions can use separate
+    clients ``pubsub_shards``, e.g. ones without a socket timeout.
+
+    ``subscribe`` returns once the pattern subscription of the game's shard
+    is active, so any event published after it reaches the subscription and
+    reading the history afterwards misses nothing. When the connection to a
+    shard drops, the subscriptions to its games are closed, so their clients
+    reconnect and get the events they missed from the history.
+    """
+    pattern = 'games:*:*_channel'
+    subscription_class = Subscription
+
+    def __init__(self, shards, max_buffer=100, reconnect_delay=1,
+                 pubsub_shards=None, subscribe_timeout=5):
+        self.shards = shards
+        self.pubsub_shards = pubsub_shards or shards
+        self.max_buffer = max_buffer
+        self.reconnect_delay = reconnect_delay
+        self.subscribe_timeout = subscribe_timeout
+        self.subscriptions = collections.defaultdict(set)
+        self.lock = threading.Lock()
+        # The listener of each shard and the event it sets while its pattern
+        # subscription is active, by the shard's index in the ring
+        self.threads = {}
+        self.subscribed = {}
+
+    def start(self):
+        with self.lock:
+            for i, client in enumerate(self.pubsub_shards.nodes):
+                thread = self.threads.get(i)
+                if thread is None or not thread.is_alive():
+                    self.subscribed[i] = threading.Event()
+                    thread = threading.Thread(target=self.run,
+                                              args=(i, client))
+                    thread.daemon = True
+                    thread.start()
+                    self.threads[i] = thread
+
+    def run(self, index, client):
+        while True:
+            try:
+                pubsub = client.pubsub()
+                pubsub.psubscribe(self.pattern)
+                for message in pubsub.listen():
+                    if message['type'] == 'pmessage':
+                        self.dispatch(message['channel'], message['data'])
+                    elif message['type'] == 'psubscribe':
+                        self.subscribed[index].set()
+            except (ConnectionError, TimeoutError):
+                self.disconnect(index)
+                time.sleep(self.reconnect_delay)
+
+    def disconnect(self, index):
+        """
+        Closes the subscriptions to the games of shard ``index``, whose
+        pattern subscription was lost.
+        """
+        # Events published until the pattern is subscribed again are lost,
+        # so new subscriptions wait for it and the current ones are closed
+        with self.lock:
+            self.subscribed[index].clear()
+            subscriptions = [subscription
+                             for gid in self.subscriptions
+                             if self.pubsub_shards.index(gid) == index
+                             for subscription in self.subscriptions[gid]]
+        for subscription in subscriptions:
+            self.unsubscribe(subscription)
+
+    def dispatch(self, channel, data):
+        gid = sharding.key_gid(channel)
+        if gid is None:
+            return
+        event = channel.rsplit(':', 1)[1][:-len('_channel')]
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(gid, ()))
+        if not subscriptions:
+            return
+        seq = event_seq(data)
+        for subscription in subscriptions:
+            if not subscription.push(event, data, seq):
+                self.unsubscribe(subscription)
+
+    def history(self, gid, after):
+        """
+        Returns the stored events of game ``gid`` following event ``after``.
+
+        If the first of them was already trimmed from the stream, returns a
+        single ``reset`` event with the seq of the last one instead, telling
+        the client to fetch the game again.
+        """
+        entries = self.shards.get(gid).xrange(
+            sharding.game_key(gid, ':events'), '0-{}'.format(after + 1), '+')
+        return self.entries_to_events(entries, after)
+
+    @staticmethod
+    def entries_to_events(entries, after):
+        # Stream entry ids are 0-<seq>, and every seq has an entry
+        events = [(fields['event'], fields['data'],
+                   int(entry_id.split('-')[1]))
+                  for entry_id, fields in entries]
+        if events and events[0][2] != after + 1:
+            seq = events[-1][2]
+            return [('reset', json.dumps({'seq': seq}), seq)]
+        return events
+
+    def subscribe(self, gid):
+        """
+        Returns a new subscription to the events of game ``gid``. Raises
+        TimeoutError if the shard of the game cannot be subscribed to.
+        """
+        self.start()
+        subscribed = self.subscribed[self.pubsub_shards.index(gid)]
+        if not subscribed.wait(self.subscribe_timeout):
+            raise TimeoutError(
+                'Cannot subscribe to the events of game {}'.format(gid))
+        return self.add_subscription(gid)
+
+    def add_subscription(self, gid):
+        subscription = self.subscription_class(gid, self.max_buffer)
+        with self.lock:
+            if self.subscribed[self.pubsub_shards.index(gid)].is_set():
+                self.subscriptions[gid].add(subscription)
+            else:
+                # The shard disconnected after subscribe() waited for it
+                subscription.close()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscription.close()
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.gid)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.subscriptions[subscription.gid]
+
+
+class AsyncEventHub(EventHub):
+    """
+    EventHub for an asyncio event loop, used with asyncio Redis clients.
+    """
+    subscription_class = AsyncSubscription
+
+    def __init__(self, shards, max_buffer=100, reconnect_delay=1,
+                 pubsub_shards=None, subscribe_timeout=5):
+        super().__init__(shards, max_buffer, reconnect_delay, pubsub_shards,
+                         subscribe_timeout)
+        self.tasks = {}
+
+    def start(self):
+        for i, client in enumerate(self.pubsub_shards.nodes):
+            task = self.tasks.get(i)
+            if task is None or task.done():
+                # Created here, in the event loop that waits for it
+                self.subscribed[i] = asyncio.Event()
+                self.tasks[i] = asyncio.ensure_future(self.run(i, client))
+
+    async def subscribe(self, gid):
+        self.start()
+        subscribed = self.subscribed[self.pubsub_shards.index(gid)]
+        try:
+            await asyncio.wait_for(subscribed.wait(), self.subscribe_timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(
+                'Cannot subscribe to the events of game {}'.format(gid))
+        return self.add_subscription(gid)
+
+    async def history(self, gid, after):
+        entries = await self.shards.get(gid).xrange(
+            sharding.game_key(gid, ':events'), '0-{}'.format(after + 1), '+')
+        return self.entries_to_events(entries, after)
+
+    async def run(self, index, client):
+        while True:
+            try:
+                pubsub = client.pubsub()
+                await pubsub.psubscribe(self.pattern)
+                async for message in pubsub.listen():
+                    if message['type'] == 'pmessage':
+                        self.dispatch(message['channel'], message['data'])
+                    elif message['type'] == 'psubscribe':
+                        self.subscribed[index].set()
+            except (ConnectionError, TimeoutError):
+                self.disconnect(index)
+                await asyncio.sleep(self.reconnect_delay)
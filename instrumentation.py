@@ -0,0 +1,291 @@
+"""
+Redis command instrumentation.
+
+Hooks into a Redis client to record every command it sends: the command
+name, the normalized key pattern (e.g. ``games:{gid}:players:{pid}:cards``),
+the round trip latency, and the totals for the current Flask request. The
+numbers are exported in the Prometheus text format and, in debug mode, as
+response headers.
+"""
+import collections
+import threading
+import time
+
+from flask import request
+
+
+# Segments following these names are identifiers, not part of the pattern.
+# Game and player ids are numbers, usernames can be anything.
+KEY_PARAMETERS = {
+    'games': ('{gid}', True),
+    'players': ('{pid}', True),
+    'users': ('{username}', False),
+}
+
+# Segments following these names are identifiers that take the rest of the
+# key, as they may contain colons, e.g. the idempotency keys of requests.
+KEY_SUFFIX_PARAMETERS = {
+    'requests': '{key}',
+}
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1)
+COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+SCRIPT_COMMANDS = ('EVAL', 'EVALSHA')
+KEYLESS_COMMANDS = ('DBSIZE', 'FLUSHALL', 'FLUSHDB', 'INFO', 'PING',
+                    'SCAN', 'SCRIPT LOAD', 'TIME')
+
+
+def normalize_key(key):
+    parts = key.split(':')
+    for i in range(1, len(parts)):
+        if parts[i - 1] in KEY_SUFFIX_PARAMETERS:
+            parts[i:] = [KEY_SUFFIX_PARAMETERS[parts[i - 1]]]
+            break
+        parameter, numeric = KEY_PARAMETERS.get(parts[i - 1], (None, False))
+        # Game ids are hash tags, e.g. games:{42}
+        value = parts[i]
+        if len(value) > 2 and value[0] == '{' and value[-1] == '}':
+            value = value[1:-1]
+        if parameter is not None and (value.isdigit() or not numeric):
+            parts[i] = parameter
+        elif value.isdigit():
+            parts[i] = '{id}'
+    return ':'.join(parts)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield name + '_bucket', labels + (('le', repr(bound)),), cumulative
+        yield name + '_bucket', labels + (('le', '+Inf'),), self.count
+        yield name + '_sum', labels, self.sum
+        yield name + '_count', labels, self.count
+
+
+class Metrics:
+    """
+    A thread-safe registry of counters and histograms with labels.
+    """
+    def __init__(self):
+        self.descriptions = collections.OrderedDict()
+        self.values = collections.defaultdict(dict)
+        self.lock = threading.Lock()
+
+    def counter(self, name, description):
+        self.descriptions[name] = ('counter', description, None)
+
+    def histogram(self, name, description, buckets):
+        self.descriptions[name] = ('histogram', description, buckets)
+
+    def inc(self, name, labels, amount=1):
+        with self.lock:
+            values = self.values[name]
+            values[labels] = values.get(labels, 0) + amount
+
+    def observe(self, name, labels, value):
+        with self.lock:
+            values = self.values[name]
+            histogram = values.get(labels)
+            if histogram is None:
+                histogram = values[labels] = \
+                    Histogram(self.descriptions[name][2])
+            histogram.observe(value)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, (kind, description, _) in self.descriptions.items():
+                lines.append('# HELP {} {}'.format(name, description))
+                lines.append('# TYPE {} {}'.format(name, kind))
+                for labels, value in sorted(self.values[name].items()):
+                    if kind == 'histogram':
+                        samples = value.samples(name, labels)
+                    else:
+                        samples = [(name, labels, value)]
+                    for sample_name, sample_labels, sample_value in samples:
+                        lines.append('{}{} {}'.format(
+                            sample_name, format_labels(sample_labels),
+                            sample_value))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels))
+
+
+class RequestStats:
+    def __init__(self):
+        self.commands = 0
+        self.round_trips = 0
+        self.time = 0
+        self.breakdown = collections.Counter()
+
+    def summary(self):
+        return ', '.join('{} x{}'.format(' '.join(filter(None, description)),
+                                         count)
+                         for description, count
+                         in self.breakdown.most_common())
+
+
+class Instrumentation:
+    """
+    Records the Redis commands of instrumented clients.
+
+    Commands sent while a Flask request is handled are also added to the
+    stats of that request, if the app was set up with ``init_app``.
+    """
+    def __init__(self):
+        self.metrics = Metrics()
+        self.metrics.counter('redis_commands_total',
+                             'Redis commands sent, by command and key pattern')
+        self.metrics.histogram('redis_round_trip_seconds',
+                               'Latency of Redis round trips',
+                               LATENCY_BUCKETS)
+        self.metrics.histogram('http_request_duration_seconds',
+                               'Latency of HTTP requests', LATENCY_BUCKETS)
+        self.metrics.histogram('http_request_redis_commands',
+                               'Redis commands sent per HTTP request',
+                               COUNT_BUCKETS)
+        self.metrics.histogram('http_request_redis_round_trips',
+                               'Redis round trips per HTTP request',
+                               COUNT_BUCKETS)
+        self.script_names = {}
+        self.local = threading.local()
+
+    def name_script(self, script, name):
+        self.script_names[script.sha] = name
+
+    def instrument(self, client):
+        """
+        Hooks into ``client`` and the pipelines it creates.
+        """
+        execute_command = client.execute_command
+        pipeline = client.pipeline
+
+        def instrumented_execute_command(*args, **options):
+            start = time.perf_counter()
+            try:
+                return execute_command(*args, **options)
+            finally:
+                self.record([args], time.perf_counter() - start)
+
+        def instrumented_pipeline(*args, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+            execute = pipe.execute
+            immediate_execute_command = pipe.immediate_execute_command
+
+            def instrumented_execute(*args, **kwargs):
+                commands = [command for command, _ in pipe.command_stack]
+                start = time.perf_counter()
+                try:
+                    return execute(*args, **kwargs)
+                finally:
+                    if commands:
+                        self.record(commands, time.perf_counter() - start,
+                                    pipeline=True)
+
+            def instrumented_immediate_execute_command(*args, **options):
+                start = time.perf_counter()
+                try:
+                    return immediate_execute_command(*args, **options)
+                finally:
+                    self.record([args], time.perf_counter() - start)
+
+            pipe.execute = instrumented_execute
+            pipe.immediate_execute_command = \
+                instrumented_immediate_execute_command
+            return pipe
+
+        client.execute_command = instrumented_execute_command
+        client.pipeline = instrumented_pipeline
+        return client
+
+    def describe(self, args):
+        command = str(args[0]).upper()
+        key_index = 1
+        if command in KEYLESS_COMMANDS:
+            return command, ''
+        if command in SCRIPT_COMMANDS:
+            if len(args) > 1 and args[1] in self.script_names:
+                command = '{} {}'.format(command, self.script_names[args[1]])
+            if len(args) < 3 or int(args[2]) < 1:
+                return command, ''
+            key_index = 3
+        if len(args) <= key_index:
+            return command, ''
+        key = args[key_index]
+        if isinstance(key, bytes):
+            key = key.decode('utf-8', 'replace')
+        return command, normalize_key(str(key))
+
+    def record(self, commands, duration, pipeline=False):
+        descriptions = [self.describe(args) for args in commands]
+        round_trip = 'PIPELINE' if pipeline else descriptions[0][0]
+        for description in descriptions:
+            self.metrics.inc('redis_commands_total',
+                             (('command', description[0]),
+                              ('key', description[1])))
+        self.metrics.observe('redis_round_trip_seconds',
+                             (('command', round_trip),), duration)
+        stats = getattr(self.local, 'stats', None)
+        if stats is not None:
+            stats.commands += len(descriptions)
+            stats.round_trips += 1
+            stats.time += duration
+            stats.breakdown.update(descriptions)
+
+    def init_app(self, app):
+        """
+        Collects the Redis stats of every request to ``app``.
+        """
+        @app.before_request
+        def start_request():
+            self.local.stats = RequestStats()
+            self.local.start = time.perf_counter()
+
+        @app.after_request
+        def finish_request(response):
+            stats = getattr(self.local, 'stats', None)
+            if stats is None:
+                return response
+            self.local.stats = None
+            duration = time.perf_counter() - self.local.start
+            labels = (('view', request.endpoint or 'none'),
+                      ('method', request.method))
+            self.metrics.observe('http_request_duration_seconds', labels,
+                                 duration)
+            self.metrics.observe('http_request_redis_commands', labels,
+                                 stats.commands)
+            self.metrics.observe('http_request_redis_round_trips', labels,
+                                 stats.round_trips)
+            if app.debug:
+                response.headers['X-Redis-Commands'] = str(stats.commands)
+                response.headers['X-Redis-Round-Trips'] = \
+                    str(stats.round_trips)
+                response.headers['X-Redis-Time'] = \
+                    '{:.3f}ms'.format(1000 * stats.time)
+                response.headers['X-Redis-Breakdown'] = stats.summary()
+            return response
@@ -0,0 +1,358 @@
+"""
+Storage layouts of the players, cards and deck of a game.
+
+The game hash (name, owner, state, turn, seq) and the move log and events are
+the same in every layout. The rest is stored either in separate keys for
+every list and hash (KeysLayout, described in docs/redis.rst) or packed into
+fields of the game hash (PackedLayout), which keeps a game in one small hash
+that Redis stores compactly.
+
+Both layouts read a game into the same data as load_game.lua returns, so
+they can be converted into each other with ``migrate``. Layouts are created
+with a function returning the Redis client for the keys of a game.
+"""
+import json
+
+import engine
+import sharding
+
+
+class KeysLayout:
+    name = 'keys'
+
+    def __init__(self, client, load_script):
+        self.client = client
+        self.load_game_script = load_script('load_game')
+
+    def game_key(self, gid, suffix=''):
+        return sharding.game_key(gid, suffix)
+
+    def player_key(self, gid, pid, suffix=''):
+        return sharding.game_key(gid, ':players:{}{}'.format(pid, suffix))
+
+    def new_pid(self, gid):
+        return self.client(gid).incr(self.game_key(gid, ':players:next'))
+
+    def get_next_pid(self, gid):
+        next_pid = self.client(gid).get(self.game_key(gid, ':players:next'))
+        return int(next_pid or 0)
+
+    def add_player(self, pipe, gid, pid, username, bot=False):
+        pipe.hset(self.player_key(gid, pid), 'user', username)
+        if bot:
+            pipe.hset(self.player_key(gid, pid), 'bot', 1)
+        pipe.rpush(self.game_key(gid, ':players'), pid)
+
+    def remove_player(self, pipe, gid, pid):
+        pipe.lrem(self.game_key(gid, ':players'), 0, pid)
+        pipe.delete(self.player_key(gid, pid),
+                    self.player_key(gid, pid, ':cards'),
+                    self.player_key(gid, pid, ':hand'))
+
+    def get_pids(self, gid):
+        pids = self.client(gid).lrange(self.game_key(gid, ':players'),
+                                       0, -1)
+        return [int(pid) for pid in pids]
+
+    def get_winner_pids(self, gid):
+        pids = self.client(gid).lrange(self.game_key(gid, ':winners'),
+                                       0, -1)
+        return [int(pid) for pid in pids]
+
+    def get_player_field(self, gid, pid, field):
+        return self.client(gid).hget(self.player_key(gid, pid), field)
+
+    def set_player_field(self, gid, pid, field, value):
+        self.client(gid).hset(self.player_key(gid, pid), field, value)
+
+    def get_hand(self, gid, pid):
+        return self.client(gid).lrange(self.player_key(gid, pid, ':hand'),
+                                       0, -1)
+
+    def get_cards(self, gid, pid):
+        cards = self.client(gid).hgetall(
+            self.player_key(gid, pid, ':cards'))
+        return {card: int(count) for card, count in cards.items()}
+
+    def load(self, gid):
+        data = json.loads(self.load_game_script(keys=[self.game_key(gid)],
+                                                client=self.client(gid)))
+        # cjson encodes empty tables as either {} or [], hence the `or`s
+        data['game'] = data['game'] or {}
+        data['deck'] = data['deck'] or []
+        data['winners'] = data['winners'] or []
+        for player_data in data['players'] or []:
+            player_data['data'] = player_data['data'] or {}
+            player_data['hand'] = player_data['hand'] or []
+            player_data['cards'] = player_data['cards'] or {}
+        data['players'] = data['players'] or []
+        return data
+
+    def write_state(self, pipe, gid, state):
+        """
+        Queues the commands storing the engine state ``state`` on ``pipe``.
+        """
+        pipe.delete(self.game_key(gid, ':deck'),
+                    self.game_key(gid, ':winners'))
+        if state.deck:
+            deck = [engine.CARDS[card] for card in state.deck]
+            pipe.rpush(self.game_key(gid, ':deck'), *deck)
+        for player in state.players:
+            pipe.hset(self.player_key(gid, player.pid), 'color',
+                      player.get_color_name())
+            pipe.delete(self.player_key(gid, player.pid, ':hand'))
+            if player.hand:
+                pipe.rpush(self.player_key(gid, player.pid, ':hand'),
+                           *player.get_hand_names())
+            pipe.hset(self.player_key(gid, player.pid, ':cards'),
+                      mapping=player.get_cards_dict())
+        if state.winner_pids:
+            pipe.rpush(self.game_key(gid, ':winners'), *state.winner_pids)
+
+    def move_fields(self, state, delta):
+        # execute_move.lua applies the delta to the separate keys itself
+        return None
+
+    def write_game(self, pipe, gid, data, next_pid):
+        """
+        Queues the commands storing ``data`` (as returned by ``load``).
+        """
+        if next_pid:
+            pipe.set(self.game_key(gid, ':players:next'), next_pid)
+        if data['deck']:
+            pipe.rpush(self.game_key(gid, ':deck'), *data['deck'])
+        if data['winners']:
+            pipe.rpush(self.game_key(gid, ':winners'), *data['winners'])
+        for player_data in data['players']:
+            pid = player_data['pid']
+            pipe.rpush(self.game_key(gid, ':players'), pid)
+            if player_data['data']:
+                pipe.hset(self.player_key(gid, pid),
+                          mapping=player_data['data'])
+            if player_data['hand']:
+                pipe.rpush(self.player_key(gid, pid, ':hand'),
+                           *player_data['hand'])
+            if player_data['cards']:
+                pipe.hset(self.player_key(gid, pid, ':cards'),
+                          mapping=player_data['cards'])
+
+    def delete_game(self, pipe, gid, pids):
+        pipe.delete(*self.data_keys(gid, pids))
+
+    def data_keys(self, gid, pids):
+        keys = [self.game_key(gid, suffix)
+                for suffix in (':deck', ':winners', ':players',
+                               ':players:next')]
+        for pid in pids:
+            keys.extend(self.player_key(gid, pid, suffix)
+                        for suffix in ('', ':hand', ':cards'))
+        return keys
+
+
+class PackedLayout:
+    """
+    Stores everything in the game hash, in these fields::
+
+        next_pid (last pid given to a player)
+        deck (card codes, e.g. 0325)
+        winners (comma separated pids)
+        p{pid}.user, p{pid}.bot, p{pid}.color (like the player hash)
+        p{pid}.hand (card codes)
+        p{pid}.cards (number of cards of each color in engine.COLORS order,
+                      one base 36 digit each, e.g. 20103)
+
+    Players are in join order because pids are given out in increasing order.
+    """
+    name = 'packed'
+
+    def __init__(self, client, load_script):
+        self.client = client
+
+    def game_key(self, gid):
+        return sharding.game_key(gid)
+
+    def new_pid(self, gid):
+        return self.client(gid).hincrby(self.game_key(gid), 'next_pid', 1)
+
+    def get_next_pid(self, gid):
+        return int(self.client(gid).hget(self.game_key(gid), 'next_pid') or 0)
+
+    def add_player(self, pipe, gid, pid, username, bot=False):
+        fields = {'p{}.user'.format(pid): username}
+        if bot:
+            fields['p{}.bot'.format(pid)] = 1
+        pipe.hset(self.game_key(gid), mapping=fields)
+
+    def remove_player(self, pipe, gid, pid):
+        pipe.hdel(self.game_key(gid), *self.player_fields(pid))
+
+    def player_fields(self, pid):
+        return ['p{}.{}'.format(pid, field)
+                for field in ('user', 'bot', 'color', 'hand', 'cards')]
+
+    def get_pids(self, gid):
+        fields = self.client(gid).hkeys(self.game_key(gid))
+        return self.pids_from_fields(fields)
+
+    @staticmethod
+    def pids_from_fields(fields):
+        return sorted(int(field[1:-len('.user')]) for field in fields
+                      if field.startswith('p') and field.endswith('.user'))
+
+    def get_winner_pids(self, gid):
+        winners = self.client(gid).hget(self.game_key(gid), 'winners')
+        return self.decode_pids(winners)
+
+    def get_player_field(self, gid, pid, field):
+        return self.client(gid).hget(self.game_key(gid),
+                                     'p{}.{}'.format(pid, field))
+
+    def set_player_field(self, gid, pid, field, value):
+        self.client(gid).hset(self.game_key(gid),
+                              'p{}.{}'.format(pid, field), value)
+
+    def get_hand(self, gid, pid):
+        hand = self.client(gid).hget(self.game_key(gid),
+                                     'p{}.hand'.format(pid))
+        return self.decode_names(hand)
+
+    def get_cards(self, gid, pid):
+        cards = self.client(gid).hget(self.game_key(gid),
+                                      'p{}.cards'.format(pid))
+        return self.decode_counts(cards)
+
+    def load(self, gid):
+        game_hash = self.client(gid).hgetall(self.game_key(gid))
+        return self.data_from_hash(game_hash)
+
+    def data_from_hash(self, game_hash):
+        players = []
+        for pid in self.pids_from_fields(game_hash):
+            field = 'p{}.'.format(pid)
+            player_hash = {name: game_hash[field + name]
+                           for name in ('user', 'bot', 'color')
+                           if field + name in game_hash}
+            players.append({
+                'pid': pid,
+                'data': player_hash,
+                'hand': self.decode_names(game_hash.get(field + 'hand')),
+                'cards': self.decode_counts(game_hash.get(field + 'cards')),
+            })
+        return {
+            'game': {field: value for field, value in game_hash.items()
+                     if field not in PACKED_GAME_FIELDS
+                     and not (field.startswith('p') and '.' in field)},
+            'deck': self.decode_names(game_hash.get('deck')),
+            'winners': self.decode_pids(game_hash.get('winners')),
+            'players': players,
+        }
+
+    @staticmethod
+    def encode_counts(counts):
+        return ''.join(_BASE36[count] for count in counts)
+
+    @staticmethod
+    def decode_counts(text):
+        if not text:
+            return {}
+        return {color: int(count, 36)
+                for color, count in zip(engine.COLORS, text)}
+
+    @staticmethod
+    def encode_names(names):
+        return engine.encode_cards(engine.CARD_CODES[name] for name in names)
+
+    @staticmethod
+    def decode_names(text):
+        return [engine.CARDS[card] for card in engine.decode_cards(text or '')]
+
+    @staticmethod
+    def decode_pids(text):
+        return [int(pid) for pid in text.split(',')] if text else []
+
+    def player_state_fields(self, player):
+        return {
+            'p{}.hand'.format(player.pid): engine.encode_cards(player.hand),
+            'p{}.cards'.format(player.pid): self.encode_counts(player.cards),
+        }
+
+    def write_state(self, pipe, gid, state):
+        fields = {
+            'deck': engine.encode_cards(state.deck),
+            'winners': ','.join(str(pid) for pid in state.winner_pids),
+        }
+        for player in state.players:
+            fields.update(self.player_state_fields(player))
+            fields['p{}.color'.format(player.pid)] = player.get_color_name()
+        pipe.hset(self.game_key(gid), mapping=fields)
+
+    def move_fields(self, state, delta):
+        """
+        Returns the fields changed by a move, for execute_move.lua to set.
+        """
+        fields = {'deck': engine.encode_cards(state.deck)}
+        pids = {delta['player']}
+        pids.update(pid for pid, color, amount in delta['cards'])
+        for pid in pids:
+            fields.update(self.player_state_fields(state.get_player(pid)))
+        if delta['winners']:
+            fields['winners'] = ','.join(str(pid) for pid in delta['winners'])
+        return fields
+
+    def write_game(self, pipe, gid, data, next_pid):
+        fields = {}
+        if next_pid:
+            fields['next_pid'] = next_pid
+        if data['deck']:
+            fields['deck'] = self.encode_names(data['deck'])
+        if data['winners']:
+            fields['winners'] = ','.join(str(pid) for pid in data['winners'])
+        for player_data in data['players']:
+            field = 'p{}.'.format(player_data['pid'])
+            for name, value in player_data['data'].items():
+                fields[field + name] = value
+            fields[field + 'hand'] = self.encode_names(player_data['hand'])
+            if player_data['cards']:
+                fields[field + 'cards'] = self.encode_counts(
+                    int(player_data['cards'].get(color, 0))
+                    for color in engine.COLORS)
+        if fields:
+            pipe.hset(self.game_key(gid), mapping=fields)
+
+    def delete_game(self, pipe, gid, pids):
+        fields = ['next_pid', 'deck', 'winners']
+        for pid in pids:
+            fields.extend(self.player_fields(pid))
+        pipe.hdel(self.game_key(gid), *fields)
+
+    def data_keys(self, gid, pids):
+        return [self.game_key(gid)]
+
+
+_BASE36 = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+PACKED_GAME_FIELDS = ('next_pid', 'deck', 'winners')
+
+LAYOUTS = {layout.name: layout for layout in (KeysLayout, PackedLayout)}
+
+
+def migrate(gid, source, target):
+    """
+    Moves the players, cards and deck of game ``gid`` from layout ``source``
+    to layout ``target`` in one transaction, retried if the game changes
+    meanwhile. Returns False if the game doesn't exist.
+    """
+    def move_game(pipe):
+        data = source.load(gid)
+        if not data['game']:
+            return False
+        next_pid = source.get_next_pid(gid)
+        pids = [player_data['pid'] for player_data in data['players']]
+        pipe.multi()
+        source.delete_game(pipe, gid, pids)
+        target.write_game(pipe, gid, data, next_pid)
+        return True
+
+    # Every change to a game increments the seq field of its hash
+    return source.client(gid).transaction(move_game, source.game_key(gid),
+                                          value_from_callable=True)
@@ -0,0 +1,9 @@
+-- Removes and returns the members of sorted set KEYS[1] scored up to ARGV[1],
+-- at most ARGV[2] of them, so that each one is claimed by a single worker.
+
+local members = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1],
+                           'LIMIT', 0, ARGV[2])
+if #members > 0 then
+    redis.call('ZREM', KEYS[1], unpack(members))
+end
+return members
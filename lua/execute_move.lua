@@ -0,0 +1,122 @@
+-- Stores the results of moves in game KEYS[1] atomically.
+--
+-- ARGV[1] is a JSON list of moves applied in order, each an object with the
+-- player's pid, the delta computed by engine.GameState.apply_move (the
+-- cards played from the hand, the changes of province counts, the number of
+-- cards to draw from the deck and either the next player or the winners)
+-- and the move's entry in the game's move log.
+-- ARGV[2] is the name of the public event of the moves and ARGV[3] its data
+-- (a JSON object), published with the next sequence number and added to the
+-- event stream capped at about ARGV[4] events, like in publish_event.lua,
+-- which also deletes the cached views of the game.
+-- ARGV[5] is a snapshot entry with the state after the moves, added to the
+-- log when ARGV[6] moves have been logged since the last snapshot and at the
+-- end of the game.
+-- ARGV[7] is the deadline of the next turn (a Unix time), or empty if turns
+-- don't time out.
+-- ARGV[8] is the number of moves played in the game (the turn field) when
+-- the engine validated the moves.
+--
+-- Only the first move is checked against the stored game: the engine
+-- validated the others against the state the previous ones left. The moves
+-- are rejected if any move was played since they were validated, so the
+-- same move sent twice is only played once.
+--
+-- Only the keys of the game are touched, so they can be on a shard. The
+-- winners' scores are recorded on the main server by record_end.lua.
+--
+-- In the packed layout (see layouts.py) the deltas also have the new values
+-- of the changed fields of the game hash, which are set instead.
+
+local game = KEYS[1]
+local moves = cjson.decode(ARGV[1])
+
+local function present(value)
+    return value ~= nil and value ~= cjson.null
+end
+
+local function player_key(p, suffix)
+    return game .. ':players:' .. p .. (suffix or '')
+end
+
+if redis.call('HGET', game, 'state') ~= 'started' then
+    return redis.error_reply('The game is not in progress')
+end
+if redis.call('HGET', game, 'current_player') ~= tostring(moves[1].pid) then
+    return redis.error_reply('It is not your turn')
+end
+if tonumber(redis.call('HGET', game, 'turn') or 0) ~= tonumber(ARGV[8]) then
+    return redis.error_reply('The game has changed since the move was sent')
+end
+
+local log = game .. ':log'
+local length = 0
+local ended = false
+
+for _, move in ipairs(moves) do
+    local pid = move.pid
+    local delta = move.delta
+    local packed = present(delta.fields)
+
+    if packed then
+        for field, value in pairs(delta.fields) do
+            redis.call('HSET', game, field, value)
+        end
+    else
+        local hand = player_key(pid, ':hand')
+        for _, card in ipairs(delta.played) do
+            redis.call('LREM', hand, 1, card)
+        end
+        for _, change in ipairs(delta.cards) do
+            redis.call('HINCRBY', player_key(change[1], ':cards'), change[2],
+                       change[3])
+        end
+
+        local deck = game .. ':deck'
+        for i = 1, delta.drawn do
+            local card = redis.call('LPOP', deck)
+            if card then
+                redis.call('RPUSH', hand, card)
+            end
+        end
+    end
+
+    if present(delta.last_player) then
+        redis.call('HSET', game, 'last_player', delta.last_player)
+    end
+
+    if present(delta.winners) then
+        if not packed then
+            for _, p in ipairs(delta.winners) do
+                redis.call('RPUSH', game .. ':winners', p)
+            end
+        end
+        redis.call('HSET', game, 'state', 'ended')
+        ended = true
+    else
+        redis.call('HSET', game, 'current_player', delta.next_player)
+    end
+
+    length = redis.call('RPUSH', log, move.entry)
+end
+
+redis.call('HINCRBY', game, 'turn', #moves)
+
+if ended or ARGV[7] == '' then
+    redis.call('HDEL', game, 'turn_deadline')
+else
+    redis.call('HSET', game, 'turn_deadline', ARGV[7])
+end
+
+local snapshot = tonumber(redis.call('HGET', game, 'log_snapshot') or 0)
+if ended or length - 1 - snapshot >= tonumber(ARGV[6]) then
+    redis.call('RPUSH', log, ARGV[5])
+    redis.call('HSET', game, 'log_snapshot', length)
+end
+
+local seq = redis.call('HINCRBY', game, 'seq', 1)
+redis.call('DEL', game .. ':view')
+local data = '{"seq":' .. seq .. ',' .. string.sub(ARGV[3], 2)
+redis.call('XADD', game .. ':events', 'MAXLEN', '~', ARGV[4], '0-' .. seq,
+           'event', ARGV[2], 'data', data)
+redis.call('PUBLISH', game .. ':' .. ARGV[2] .. '_channel', data)
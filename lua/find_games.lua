@@ -0,0 +1,11 @@
+-- Returns the gids in all of the game indexes KEYS[2], KEYS[3], ... (sorted
+-- sets of gids scored by gid), from index ARGV[1] to ARGV[2] in gid order.
+--
+-- KEYS[1] is a temporary key for the intersection, deleted before returning.
+
+local result = KEYS[1]
+
+redis.call('ZINTERSTORE', result, #KEYS - 1, unpack(KEYS, 2, #KEYS))
+local gids = redis.call('ZRANGE', result, ARGV[1], ARGV[2])
+redis.call('DEL', result)
+return gids
@@ -0,0 +1,33 @@
+-- Reads the whole state of game KEYS[1] in a single round trip.
+--
+-- Returns a JSON object with the game hash, the deck, the winners and,
+-- for every player in join order, the player hash, hand and province cards.
+
+local game = KEYS[1]
+
+local function hash(key)
+    local flat = redis.call('HGETALL', key)
+    local result = {}
+    for i = 1, #flat, 2 do
+        result[flat[i]] = flat[i + 1]
+    end
+    return result
+end
+
+local players = {}
+for i, pid in ipairs(redis.call('LRANGE', game .. ':players', 0, -1)) do
+    local key = game .. ':players:' .. pid
+    players[i] = {
+        pid = tonumber(pid),
+        data = hash(key),
+        hand = redis.call('LRANGE', key .. ':hand', 0, -1),
+        cards = hash(key .. ':cards'),
+    }
+end
+
+return cjson.encode({
+    game = hash(game),
+    deck = redis.call('LRANGE', game .. ':deck', 0, -1),
+    winners = redis.call('LRANGE', game .. ':winners', 0, -1),
+    players = players,
+})
@@ -0,0 +1,24 @@
+-- Publishes event ARGV[1] of game KEYS[1] with data ARGV[2], a JSON object,
+-- and appends it to the game's event stream, capped at about ARGV[3] events.
+--
+-- Every event of a game gets the next number of the game's sequence (the
+-- seq field of the game hash), added to the data as the "seq" attribute.
+-- The number is spliced into the JSON text instead of decoding and
+-- encoding it again, because cjson can't tell empty arrays from objects.
+-- The stream entry id is 0-<seq>, so clients can resume after any event.
+-- The cached views of the game (see cache.VersionedCache) are deleted, as
+-- they are of the previous version.
+
+local game = KEYS[1]
+local seq = redis.call('HINCRBY', game, 'seq', 1)
+redis.call('DEL', game .. ':view')
+local data = ARGV[2]
+if data == '{}' then
+    data = '{"seq":' .. seq .. '}'
+else
+    data = '{"seq":' .. seq .. ',' .. string.sub(data, 2)
+end
+redis.call('XADD', game .. ':events', 'MAXLEN', '~', ARGV[3], '0-' .. seq,
+           'event', ARGV[1], 'data', data)
+redis.call('PUBLISH', game .. ':' .. ARGV[1] .. '_channel', data)
+return seq
@@ -0,0 +1,20 @@
+-- Records the end of game ARGV[1] on the main server: increments the scores
+-- of its winners, the users ARGV[2], ARGV[3], ..., moves it to the ended
+-- index and drops its turn deadline. Returns 0 without changing anything if
+-- the end of the game was already recorded, so it can be retried.
+
+local gid = ARGV[1]
+
+if redis.call('SADD', 'scored_games', gid) == 0 then
+    return 0
+end
+
+for i = 2, #ARGV do
+    redis.call('HINCRBY', 'users:' .. ARGV[i], 'score', 1)
+    redis.call('ZINCRBY', 'leaderboard', 1, ARGV[i])
+end
+
+redis.call('ZREM', 'games:state:started', gid)
+redis.call('ZREM', 'turn_deadlines', gid)
+redis.call('ZADD', 'games:state:ended', gid, gid)
+return 1
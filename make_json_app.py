@@ -4,7 +4,14 @@ from flask import Flask, jsonify
 from werkzeug.exceptions import default_exceptions
 from werkzeug.exceptions import HTTPException
 
-__all__ = ['make_json_app']
+__all__ = ['make_json_app', 'make_json_error']
+
+def make_json_error(ex):
+    response = jsonify({'messages': [str(ex)]})
+    response.status_code = (ex.code
+                            if isinstance(ex, HTTPException)
+                            else 500)
+    return response
 
 def make_json_app(import_name, **kwargs):
     """
@@ -16,13 +23,6 @@ def make_json_app(import_name, **kwargs):
 
     { "messages": ["405: Method Not Allowed"] }
     """
-    def make_json_error(ex):
-        response = jsonify({'messages': [str(ex)]})
-        response.status_code = (ex.code
-                                if isinstance(ex, HTTPException)
-                                else 500)
-        return response
-
     app = Flask(import_name, **kwargs)
 
     for code in default_exceptions.keys():
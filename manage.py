@@ -0,0 +1,290 @@
+import argparse
+import collections
+import gzip
+import time
+
+from redis.exceptions import ResponseError
+
+import layouts
+import models
+import movelog
+import sharding
+from models import Game, User
+
+
+# The game id under which copies of games are written to measure them
+REPORT_GID = 'storage-report'
+
+
+def rebuild_leaderboard(args):
+    count = User.rebuild_leaderboard()
+    print('Rebuilt leaderboard with {} users'.format(count))
+
+
+def rebuild_game_index(args):
+    count = Game.rebuild_indexes()
+    print('Rebuilt the indexes of {} games'.format(count))
+
+
+def export_games(args):
+    count = 0
+    with gzip.open(args.output, 'wt') as f:
+        for game in map(Game, Game.get_gids() + Game.get_archived_gids()):
+            game_data = game.get_export_data()
+            if not game_data or game_data['state'] != 'ended':
+                continue
+            f.write(movelog.encode(game_data))
+            f.write('\n')
+            count += 1
+    print('Exported {} games to {}'.format(count, args.output))
+
+
+def archive_games(args):
+    while True:
+        count = Game.archive_ended(args.ttl)
+        print('Archived {} games'.format(count))
+        if not args.interval:
+            return
+        time.sleep(args.interval)
+
+
+def play_timeouts(args):
+    while True:
+        count = Game.play_timeouts(args.limit)
+        if count or not args.interval:
+            print('Played {} timed out turns'.format(count))
+        if not args.interval:
+            return
+        # A full batch may leave more due turns
+        if count < args.limit:
+            time.sleep(args.interval)
+
+
+def delete_orphans(args):
+    count = Game.delete_orphans()
+    print('Deleted {} keys of deleted games'.format(count))
+
+
+def verify_game(args):
+    problems = movelog.verify(Game(args.gid).get_log())
+    for problem in problems:
+        print(problem)
+    if problems:
+        raise SystemExit(1)
+    print('The move log of game {} is consistent'.format(args.gid))
+
+
+def restore_game(args):
+    state = Game(args.gid).restore()
+    if state is None:
+        raise SystemExit('Game {} has no move log'.format(args.gid))
+    print('Restored game {} from its move log'.format(args.gid))
+
+
+def migrate_storage(args):
+    source = layouts.LAYOUTS[args.source](models.game_redis,
+                                          models.load_script)
+    target = layouts.LAYOUTS[args.target](models.game_redis,
+                                          models.load_script)
+    count = 0
+    # Archived games too, their state is kept until it expires
+    for gid in Game.get_gids() + Game.get_archived_gids():
+        if layouts.migrate(gid, source, target):
+            count += 1
+    print('Migrated {} games from the {} to the {} layout'.format(
+        count, source.name, target.name))
+
+
+def game_key_name(key):
+    """
+    Returns the gid of a game key and its current name, which is different
+    for keys named before gids became hash tags, e.g. games:42:deck.
+    """
+    gid = sharding.key_gid(key)
+    if gid is not None:
+        return gid, key
+    parts = key.split(':', 2)
+    if len(parts) > 1 and parts[1].isdigit():
+        suffix = ':' + parts[2] if len(parts) > 2 else ''
+        return int(parts[1]), sharding.game_key(parts[1], suffix)
+    return None, key
+
+
+def rebalance_shards(args):
+    servers = collections.OrderedDict([(models.REDIS_URL, models.redis)])
+    for url, client in zip(models.shards.names, models.shards.nodes):
+        servers.setdefault(url, client)
+    for url in args.source:
+        if url not in servers:
+            servers[url] = models.connect(url)
+    count = 0
+    for url, client in servers.items():
+        for key in list(client.scan_iter('games:*', count=1000)):
+            gid, name = game_key_name(key)
+            if gid is None:
+                continue
+            target_url = models.shards.names[models.shards.index(gid)]
+            if target_url == url:
+                if name == key:
+                    continue
+                client.rename(key, name)
+            else:
+                dump = client.dump(key)
+                if dump is None:
+                    continue
+                ttl = client.pttl(key)
+                servers[target_url].restore(name, max(ttl, 0), dump,
+                                            replace=True)
+                client.delete(key)
+            count += 1
+    print('Moved {} keys'.format(count))
+
+
+def memory_usage(client, key):
+    try:
+        return client.memory_usage(key) or 0
+    except ResponseError:
+        # MEMORY USAGE needs Redis 4, the serialized size is close enough
+        return len(client.dump(key) or b'')
+
+
+def game_size(layout, data, next_pid):
+    """
+    Returns the bytes used by a game stored in ``layout``, measured on a
+    temporary copy.
+    """
+    pids = [player_data['pid'] for player_data in data['players']]
+    keys = [layout.game_key(REPORT_GID)] + layout.data_keys(REPORT_GID, pids)
+    client = layout.client(REPORT_GID)
+    pipe = client.pipeline()
+    pipe.delete(*keys)
+    pipe.hset(layout.game_key(REPORT_GID), mapping=data['game'])
+    layout.write_game(pipe, REPORT_GID, data, next_pid)
+    pipe.execute()
+    try:
+        return sum(memory_usage(client, key) for key in set(keys))
+    finally:
+        client.delete(*keys)
+
+
+def storage_report(args):
+    storage = {name: Layout(models.game_redis, models.load_script)
+               for name, Layout in layouts.LAYOUTS.items()}
+    sizes = {name: 0 for name in storage}
+    count = 0
+    for gid in Game.get_gids(0, args.limit):
+        data = models.layout.load(gid)
+        if not data['game']:
+            continue
+        next_pid = models.layout.get_next_pid(gid)
+        for name, layout in storage.items():
+            sizes[name] += game_size(layout, data, next_pid)
+        count += 1
+    if not count:
+        print('No games to measure')
+        return
+    print('Bytes per game ({} games, without move logs and events):'.format(
+        count))
+    for name in sorted(sizes):
+        print('{:>8} {:>10.0f}{}'.format(
+            name, sizes[name] / count,
+            ' (current)' if name == models.layout.name else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Shinobi maintenance tasks')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    subparser = subparsers.add_parser(
+        'rebuild-leaderboard',
+        help='rebuild the leaderboard sorted set from user scores')
+    subparser.set_defaults(func=rebuild_leaderboard)
+
+    subparser = subparsers.add_parser(
+        'rebuild-game-index',
+        help='rebuild the state, owner and player indexes of the lobby')
+    subparser.set_defaults(func=rebuild_game_index)
+
+    subparser = subparsers.add_parser(
+        'export-games',
+        help='export ended games with their move logs to a gzipped file '
+             'with one JSON object per line')
+    subparser.add_argument('output', help='output file, e.g. games.ndjson.gz')
+    subparser.set_defaults(func=export_games)
+
+    subparser = subparsers.add_parser(
+        'archive-games',
+        help='move ended games from the lobby to the archive and let their '
+             'state and move log expire')
+    subparser.add_argument('--ttl', type=int, default=models.ARCHIVE_TTL,
+                           help='seconds to keep the state and move log of '
+                                'archived games (default: ARCHIVE_TTL)')
+    subparser.add_argument('--interval', type=int,
+                           help='keep running, archiving every INTERVAL '
+                                'seconds')
+    subparser.set_defaults(func=archive_games)
+
+    subparser = subparsers.add_parser(
+        'play-timeouts',
+        help='play the first legal move for the players whose turn took '
+             'longer than TURN_TIMEOUT seconds')
+    subparser.add_argument('--limit', type=int, default=100,
+                           help='games handled per batch (default: 100)')
+    subparser.add_argument('--interval', type=float,
+                           help='keep running, checking every INTERVAL '
+                                'seconds')
+    subparser.set_defaults(func=play_timeouts)
+
+    subparser = subparsers.add_parser(
+        'delete-orphans',
+        help='delete keys left behind by deleted games')
+    subparser.set_defaults(func=delete_orphans)
+
+    subparser = subparsers.add_parser(
+        'verify-game',
+        help='replay the move log of a game and check its snapshots')
+    subparser.add_argument('gid', type=int)
+    subparser.set_defaults(func=verify_game)
+
+    subparser = subparsers.add_parser(
+        'restore-game',
+        help='overwrite the state of a game with the state replayed from '
+             'its move log')
+    subparser.add_argument('gid', type=int)
+    subparser.set_defaults(func=restore_game)
+
+    subparser = subparsers.add_parser(
+        'migrate-storage',
+        help='move the players, cards and deck of all games to another '
+             'storage layout (see layouts.py), then restart the server with '
+             'STORAGE set to it')
+    subparser.add_argument('target', choices=sorted(layouts.LAYOUTS))
+    subparser.add_argument('--from', dest='source', default=models.STORAGE,
+                           choices=sorted(layouts.LAYOUTS),
+                           help='current layout (default: STORAGE)')
+    subparser.set_defaults(func=migrate_storage)
+
+    subparser = subparsers.add_parser(
+        'rebalance-shards',
+        help='move the keys of games to the shards they belong to after '
+             'changing REDIS_SHARDS, and rename keys without hash tags')
+    subparser.add_argument('--from', dest='source', default='',
+                           type=lambda urls: [u for u in urls.split(',') if u],
+                           help='previous REDIS_SHARDS, to move the games '
+                                'of removed shards')
+    subparser.set_defaults(func=rebalance_shards)
+
+    subparser = subparsers.add_parser(
+        'storage-report',
+        help='compare the memory used per game by the storage layouts')
+    subparser.add_argument('--limit', type=int, default=100,
+                           help='number of games to measure (default: 100)')
+    subparser.set_defaults(func=storage_report)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
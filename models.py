@@ -1,198 +1,826 @@
 import os
-import random
 import collections
-import itertools
+import time
+import hashlib
+import hmac
 import json
-import redis
+import logging
+from redis.exceptions import (ConnectionError, ResponseError, TimeoutError,
+                              WatchError)
 from werkzeug.security import generate_password_hash, check_password_hash
 
+import bot
+import connections
+import engine
+import layouts
+import movelog
+import sharding
+from cache import LRUCache, VersionedCache
+from events import EventHub, KEEPALIVE_FRAME, format_event
+from instrumentation import Instrumentation
+
 
 REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
+REDIS_URL = os.getenv('REDIS_URL', 'redis://{}:6379/0'.format(REDIS_HOST))
+REDIS_REPLICA_URL = os.getenv('REDIS_REPLICA_URL')
+REDIS_SHARDS = [url for url in os.getenv('REDIS_SHARDS', '').split(',')
+                if url]
+REDIS_OPTIONS = {
+    'max_connections': int(os.getenv('REDIS_MAX_CONNECTIONS', 50)),
+    'pool_timeout': float(os.getenv('REDIS_POOL_TIMEOUT', 5)),
+    'socket_timeout': float(os.getenv('REDIS_SOCKET_TIMEOUT', 5)),
+    'connect_timeout': float(os.getenv('REDIS_CONNECT_TIMEOUT', 2)),
+    'health_check_interval': int(os.getenv('REDIS_HEALTH_CHECK_INTERVAL', 30)),
+    'connect_retries': int(os.getenv('REDIS_CONNECT_RETRIES', 2)),
+}
+CIRCUIT_THRESHOLD = int(os.getenv('CIRCUIT_THRESHOLD', 5))
+CIRCUIT_RESET_TIMEOUT = int(os.getenv('CIRCUIT_RESET_TIMEOUT', 10))
+EVENT_BUFFER_SIZE = int(os.getenv('EVENT_BUFFER_SIZE', 100))
+EVENT_KEEPALIVE = int(os.getenv('EVENT_KEEPALIVE', 15))
+EVENT_HISTORY_SIZE = int(os.getenv('EVENT_HISTORY_SIZE', 200))
+AUTH_CACHE_SIZE = int(os.getenv('AUTH_CACHE_SIZE', 10000))
+AUTH_CACHE_TTL = int(os.getenv('AUTH_CACHE_TTL', 300))
+VIEW_CACHE_SIZE = int(os.getenv('VIEW_CACHE_SIZE', 1000))
+VIEW_CACHE_TTL = int(os.getenv('VIEW_CACHE_TTL', 3600))
+STORAGE = os.getenv('STORAGE', 'keys')
+ARCHIVE_TTL = int(os.getenv('ARCHIVE_TTL', 86400))
+# Seconds a player has for a turn, 0 for no limit
+TURN_TIMEOUT = int(os.getenv('TURN_TIMEOUT', 300))
+TRANSACTION_RETRIES = int(os.getenv('TRANSACTION_RETRIES', 5))
+IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', 86400))
+# Seconds a request with an idempotency key holds it before a retry may run,
+# a few times gunicorn's 30 second worker timeout
+IDEMPOTENCY_LEASE = int(os.getenv('IDEMPOTENCY_LEASE', 90))
+
+LUA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lua')
+
+log = logging.getLogger(__name__)
+
+instrumentation = Instrumentation()
+
+
+def connect(url):
+    client = connections.create_client(url, **REDIS_OPTIONS)
+    instrumentation.instrument(client)
+    connections.CircuitBreaker(CIRCUIT_THRESHOLD,
+                               CIRCUIT_RESET_TIMEOUT).protect(client)
+    return client
+
+
+redis = connect(REDIS_URL)
+
+# Read-only views may read from a replica, which can lag a little behind
+replica = connect(REDIS_REPLICA_URL) if REDIS_REPLICA_URL else redis
+
+# The keys of games are on the shards, or else on the main server
+SHARD_URLS = REDIS_SHARDS or [REDIS_URL]
+if REDIS_SHARDS:
+    shards = sharding.HashRing([connect(url) for url in REDIS_SHARDS],
+                               REDIS_SHARDS)
+else:
+    shards = sharding.HashRing([redis], SHARD_URLS)
+
+# The event hub's pub/sub connections wait for messages without a timeout
+pubsub_shards = sharding.HashRing(
+    [connections.create_client(url, **dict(REDIS_OPTIONS,
+                                           socket_timeout=None))
+     for url in SHARD_URLS],
+    SHARD_URLS)
+
+
+def game_redis(gid):
+    return shards.get(gid)
+
+
+def turn_deadline():
+    if TURN_TIMEOUT:
+        return int(time.time()) + TURN_TIMEOUT
+
+
+def load_script(name):
+    with open(os.path.join(LUA_DIR, '{}.lua'.format(name))) as f:
+        script = redis.register_script(f.read())
+    instrumentation.name_script(script, name)
+    return script
+
+
+execute_move_script = load_script('execute_move')
+find_games_script = load_script('find_games')
+publish_event_script = load_script('publish_event')
+record_end_script = load_script('record_end')
+claim_deadlines_script = load_script('claim_deadlines')
+
+# Where the players, cards and deck of games are stored (see layouts.py)
+layout = layouts.LAYOUTS[STORAGE](game_redis, load_script)
+
+event_hub = EventHub(shards, max_buffer=EVENT_BUFFER_SIZE,
+                     pubsub_shards=pubsub_shards)
+
+# Rendered public views of games (see Game.get_views), on the games' shards.
+# The scripts publishing events delete them as every change bumps the seq.
+view_cache = VersionedCache(game_redis,
+                            lambda gid: sharding.game_key(gid, ':view'),
+                            VIEW_CACHE_SIZE, VIEW_CACHE_TTL)
+
+# Maps (username, password digest) to the password hash the password was
+# verified against, so check_password can skip the slow KDF for known
+# credentials. The digest is keyed with a per-process secret, so the cache
+# never holds plain or cheaply reversible passwords.
+credential_cache = LRUCache(AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)
+credential_cache_secret = os.urandom(32)
+
+
+def password_digest(password):
+    return hmac.new(credential_cache_secret, password.encode('utf-8'),
+                    hashlib.sha256).digest()
+
 
-redis = redis.StrictRedis(host=REDIS_HOST, decode_responses=True)
+# The fields of the game hash in the public game data. The packed layout
+# keeps a lot more in the hash, so they are read with HMGET.
+GAME_FIELDS = ('name', 'state', 'owner')
 
+GAME_STATES = ('setup', 'started', 'ended')
 
-def best(scores):
-    max_score = max([score for player, score in scores])
-    return [player for player, score in scores if score == max_score]
+
+class ConflictError(Exception):
+    """
+    A game kept changing while a transaction tried to update it.
+    """
 
 
 class Game:
     def __init__(self, gid):
         self.gid = gid
 
+    @property
+    def redis(self):
+        """
+        The client of the Redis server with the keys of the game.
+        """
+        return game_redis(self.gid)
+
     def key(self, suffix=''):
-        return 'games:{}{}'.format(self.gid, suffix)
+        return sharding.game_key(self.gid, suffix)
+
+    @staticmethod
+    def state_key(state):
+        return 'games:state:{}'.format(state)
 
     @staticmethod
-    def get_gids():
-        gids = redis.lrange('games', 0, -1)
+    def get_gids(offset=0, limit=None, state=None, owner=None, player=None,
+                 client=None):
+        """
+        Returns the gids of the games in the lobby in creation order, only
+        those with the given state, owner and player (username) if set.
+        """
+        client = client or redis
+        end = -1 if limit is None else offset + limit - 1
+        indexes = []
+        if state is not None:
+            indexes.append(Game.state_key(state))
+        if owner is not None:
+            indexes.append(User(owner).key(':owned_games'))
+        if player is not None:
+            indexes.append(User(player).key(':games'))
+        if not indexes:
+            gids = client.lrange('games', offset, end)
+        elif len(indexes) == 1:
+            gids = client.zrange(indexes[0], offset, end)
+        else:
+            # The script writes a temporary key, so it can't run on a replica
+            gids = find_games_script(keys=['games:query'] + indexes,
+                                     args=[offset, end])
         return [int(gid) for gid in gids]
 
     @staticmethod
-    def get_all():
-        return [Game(gid) for gid in Game.get_gids()]
+    def get_archived_gids():
+        return [int(gid) for gid in redis.zrange('archived_games', 0, -1)]
+
+    @staticmethod
+    def get_all(offset=0, limit=None, **filters):
+        return [Game(gid) for gid in Game.get_gids(offset, limit, **filters)]
+
+    @staticmethod
+    def get_data_many(games):
+        # One pipeline for each shard
+        pipes = collections.OrderedDict()
+        for game in games:
+            if game.redis not in pipes:
+                pipes[game.redis] = game.redis.pipeline(transaction=False)
+            pipes[game.redis].hmget(game.key(), GAME_FIELDS)
+        results = {client: iter(pipe.execute())
+                   for client, pipe in pipes.items()}
+        hashes = [dict(zip(GAME_FIELDS, next(results[game.redis])))
+                  for game in games]
+        return [game.data_from_hash(game_hash)
+                for game, game_hash in zip(games, hashes)
+                if game_hash['owner']]
 
     @staticmethod
     def create(owner, name):
         gid = redis.incr('games:next')
         redis.rpush('games', gid)
         game = Game(gid)
-        redis.hset(game.key(), 'owner', owner.username)
-        redis.hset(game.key(), 'name', name)
-        redis.hset(game.key(), 'state', 'setup')
+        game.redis.hset(game.key(), mapping={
+            'owner': owner.username,
+            'name': name,
+            'state': 'setup',
+            'seq': 0,
+        })
+        pipe = redis.pipeline()
+        game.index_state(pipe, 'setup')
+        pipe.zadd(owner.key(':owned_games'), {gid: gid})
+        pipe.execute()
         return Game(gid)
 
+    def index_state(self, pipe, state):
+        """
+        Queues the commands moving the game to the index of ``state``.
+        """
+        for other_state in GAME_STATES:
+            if other_state != state:
+                pipe.zrem(self.state_key(other_state), self.gid)
+        pipe.zadd(self.state_key(state), {self.gid: self.gid})
+
+    def unindex(self, pipe, snapshot):
+        """
+        Queues the commands removing the game from the lobby and its indexes.
+        """
+        pipe.lrem('games', 0, self.gid)
+        pipe.zrem('turn_deadlines', self.gid)
+        for state in GAME_STATES:
+            pipe.zrem(self.state_key(state), self.gid)
+        pipe.zrem(User(snapshot.owner).key(':owned_games'), self.gid)
+        for player in snapshot.players:
+            if not player.bot:
+                pipe.zrem(User(player.username).key(':games'), self.gid)
+        pipe.srem('scored_games', self.gid)
+
+    def record_end(self, snapshot, winner_pids):
+        """
+        Scores the winners of the ended game and moves it to the ended index
+        on the main server, unless that was done already.
+        """
+        # Bots don't have user accounts to keep a score in
+        usernames = [snapshot.get_player(pid).username for pid in winner_pids
+                     if not snapshot.get_player(pid).bot]
+        return record_end_script(args=[self.gid] + usernames) == 1
+
+    @staticmethod
+    def rebuild_indexes():
+        """
+        Rebuilds the state, owner and player indexes of the games in the
+        lobby, records ended games whose end wasn't recorded because the
+        process died and restarts the current turn's timeout of started
+        games. Returns the number of games.
+        """
+        snapshots = [game.get_snapshot() for game in Game.get_all()]
+        pipe = redis.pipeline()
+        pipe.delete(*[Game.state_key(state) for state in GAME_STATES])
+        for user in User.get_all():
+            pipe.delete(user.key(':games'), user.key(':owned_games'))
+        for snapshot in filter(None, snapshots):
+            game = Game(snapshot.gid)
+            game.index_state(pipe, snapshot.state)
+            pipe.zadd(User(snapshot.owner).key(':owned_games'),
+                      {game.gid: game.gid})
+            for player in snapshot.players:
+                if not player.bot:
+                    pipe.zadd(User(player.username).key(':games'),
+                              {game.gid: game.gid})
+        pipe.execute()
+        for snapshot in filter(None, snapshots):
+            game = Game(snapshot.gid)
+            if snapshot.state == 'ended':
+                game.record_end(snapshot, snapshot.winner_pids)
+            elif snapshot.state == 'started':
+                # The current turn starts over
+                deadline = turn_deadline()
+                game_pipe = game.redis.pipeline()
+                game.set_deadline(game_pipe, deadline)
+                game_pipe.execute()
+                game.update_index(snapshot.state, deadline)
+        return len(snapshots)
+
     def exists(self):
         return self.get_name() is not None
 
+    def transaction(self, func):
+        """
+        Calls ``func(pipe)`` with a pipeline of the game's shard watching the
+        game hash, executes the pipeline and returns what func returned.
+        func reads the game, then calls ``pipe.multi()`` and queues its
+        changes. Every change of a game bumps the seq in the game hash, so
+        if the game changed before the pipeline executed, func is called
+        again, up to TRANSACTION_RETRIES times, and then ConflictError is
+        raised.
+        """
+        with self.redis.pipeline() as pipe:
+            for _ in range(TRANSACTION_RETRIES):
+                try:
+                    pipe.watch(self.key())
+                    result = func(pipe)
+                    pipe.execute()
+                    return result
+                except WatchError:
+                    pipe.reset()
+        raise ConflictError('Game {} is changing too often, try again'
+                            .format(self.gid))
+
+    def get_keys(self, pids):
+        """
+        Returns all keys of the game, given the pids of its players.
+        """
+        keys = [self.key(), self.key(':log'), self.key(':events'),
+                self.key(':view')]
+        keys.extend(key for key in layout.data_keys(self.gid, pids)
+                    if key not in keys)
+        return keys
+
     def delete(self):
-        redis.lrem('games', 0, self.gid)
-        redis.delete(self.key())
+        # Keys of players joining meanwhile are left to delete_orphans
+        snapshot = self.get_snapshot()
+        pipe = redis.pipeline()
+        if snapshot:
+            self.unindex(pipe, snapshot)
+            self.redis.delete(*self.get_keys(snapshot.get_pids()))
+        else:
+            pipe.lrem('games', 0, self.gid)
+        pipe.execute()
+
+    @staticmethod
+    def archive_key(gid):
+        return 'archived_games:{}'.format(gid)
+
+    def archive(self, ttl=ARCHIVE_TTL):
+        """
+        Moves an ended game from the games list to the archive: stores a
+        summary of it in archived_games:{gid} and lets its keys expire in
+        ``ttl`` seconds. Returns False if the game hasn't ended.
+        """
+        snapshot = self.get_snapshot()
+        if not snapshot or snapshot.state != 'ended':
+            return False
+        archived = int(time.time())
+        archive_data = snapshot.get_summary()
+        archive_data['seq'] = snapshot.seq
+        archive_data['archived'] = archived
+        # The keys expire before the game leaves the index, as delete_orphans
+        # deletes the keys of unindexed games that don't expire
+        pipe = self.redis.pipeline()
+        for key in self.get_keys(snapshot.get_pids()):
+            pipe.expire(key, ttl)
+        pipe.execute()
+        pipe = redis.pipeline()
+        pipe.set(self.archive_key(self.gid), json.dumps(archive_data))
+        pipe.zadd('archived_games', {self.gid: archived})
+        self.unindex(pipe, snapshot)
+        pipe.execute()
+        return True
+
+    def get_archive(self):
+        archive_data = redis.get(self.archive_key(self.gid))
+        if archive_data is not None:
+            return json.loads(archive_data)
+
+    @staticmethod
+    def archive_ended(ttl=ARCHIVE_TTL, batch_size=100):
+        """
+        Archives all ended games in the games list. Returns their number.
+        """
+        count = 0
+        offset = 0
+        while True:
+            games = Game.get_all(offset, batch_size, state='ended')
+            if not games:
+                return count
+            archived = sum(1 for game in games if game.archive(ttl))
+            count += archived
+            # Archived games were removed from the index
+            offset += len(games) - archived
+
+    @staticmethod
+    def delete_orphans():
+        """
+        Deletes the keys of games that are neither in the games list nor
+        expiring, i.e. leftovers of deleted games. Returns their number.
+        """
+        # Scanning first, a game created meanwhile is already in the list
+        # when its keys are found
+        keys = collections.defaultdict(list)
+        for client in shards.nodes:
+            for key in client.scan_iter('games:{*', count=1000):
+                gid = sharding.key_gid(key)
+                if gid is not None:
+                    keys[client].append((gid, key))
+        active = set(Game.get_gids())
+        count = 0
+        for client, game_keys in keys.items():
+            orphans = [key for gid, key in game_keys if gid not in active]
+            pipe = client.pipeline(transaction=False)
+            for key in orphans:
+                pipe.ttl(key)
+            orphans = [key for key, ttl in zip(orphans, pipe.execute())
+                       if ttl == -1]
+            for i in range(0, len(orphans), 1000):
+                client.delete(*orphans[i:i + 1000])
+            count += len(orphans)
+        return count
 
     def get_name(self):
-        return redis.hget(self.key(), 'name')
+        return self.redis.hget(self.key(), 'name')
 
     def set_name(self, name):
-        redis.hset(game.key(), 'name', name)
+        self.redis.hset(self.key(), 'name', name)
+        self.publish('game', {'name': name})
 
     def get_owner_username(self):
-        return redis.hget(self.key(), 'owner')
+        return self.redis.hget(self.key(), 'owner')
 
     def get_owner(self):
         return User(self.get_owner_username())
 
     def get_state(self):
-        return redis.hget(self.key(), 'state')
+        return self.redis.hget(self.key(), 'state')
 
     def set_state(self, state):
-        redis.hset(self.key(), 'state', state)
-        redis.publish(self.key(':state_channel'), state)
+        pipe = self.redis.pipeline()
+        pipe.hset(self.key(), 'state', state)
+        self.publish('state', {'state': state}, client=pipe)
+        pipe.execute()
+        self.update_index(state)
+
+    def update_index(self, state, deadline=None):
+        pipe = redis.pipeline()
+        self.index_state(pipe, state)
+        self.schedule_turn(pipe, deadline if state == 'started' else None)
+        pipe.execute()
+
+    def set_deadline(self, pipe, deadline):
+        """
+        Queues the commands storing the deadline of the current turn in the
+        game hash, which tells the timeout worker whether it is still due.
+        """
+        if deadline:
+            pipe.hset(self.key(), 'turn_deadline', deadline)
+        else:
+            pipe.hdel(self.key(), 'turn_deadline')
+
+    def schedule_turn(self, pipe, deadline):
+        """
+        Queues the commands scheduling the timeout of the current turn on
+        the main server, or unscheduling it if ``deadline`` is None.
+        """
+        if deadline:
+            pipe.zadd('turn_deadlines', {self.gid: deadline})
+        else:
+            pipe.zrem('turn_deadlines', self.gid)
+
+    def publish(self, event, data, client=None):
+        return publish_event_script(keys=[self.key()],
+                                    args=[event, json.dumps(data),
+                                          EVENT_HISTORY_SIZE],
+                                    client=client if client is not None
+                                    else self.redis)
+
+    def get_version(self):
+        # Every change of a game publishes an event, so the sequence number
+        # of the last event is also the version of the game
+        seq = self.redis.hget(self.key(), 'seq')
+        if seq is not None:
+            return int(seq)
 
     def get_last_pid(self):
-        pid = redis.hget(self.key(), 'last_player')
+        pid = self.redis.hget(self.key(), 'last_player')
         if pid:
             return int(pid)
 
-    def set_last_pid(self, pid):
-        redis.hset(self.key(), 'last_player', pid)
-
     def get_current_pid(self):
-        pid = redis.hget(self.key(), 'current_player')
+        pid = self.redis.hget(self.key(), 'current_player')
         return int(pid)
 
-    def set_current_pid(self, pid):
-        redis.hset(self.key(), 'current_player', pid)
-
     def get_pids(self):
-        pids = redis.lrange(self.key(':players'), 0, -1)
-        return [int(pid) for pid in pids]
+        return layout.get_pids(self.gid)
 
     def get_players(self):
         return [Player(self.gid, pid) for pid in self.get_pids()]
 
     def get_winner_pids(self):
-        pids = redis.lrange(self.key(':winners'), 0, -1)
-        return [int(pid) for pid in pids]
-
-    def set_winner_pids(self, pids):
-        for pid in pids:
-            redis.rpush(self.key(':winners'), pid)
-
-    def deck_empty(self):
-        deck_length = int(redis.llen(self.key(':deck')))
-        return deck_length == 0
-
-    def create_player(self, user):
-        pid = redis.incr(self.key(':players:next'))
-        player = Player(self.gid, pid)
-        player.set_username(user.username)
-        redis.rpush(self.key(':players'), pid)
-        event_data = json.dumps({'action': 'join', 'player': pid})
-        redis.publish(self.key(':players_channel'), event_data)
-        return player
+        return layout.get_winner_pids(self.gid)
+
+    def join(self, username, bot=False):
+        """
+        Adds a player for user ``username``, or a bot if ``bot``, unless the
+        game is full, the user plays in it already or the bot would join
+        after the start. Returns the player, or None and the messages.
+        """
+        # Packed games count pids in the game hash, which mustn't change
+        # during the transaction
+        pid = layout.new_pid(self.gid)
+        if bot:
+            username = 'Bot {}'.format(pid)
+
+        def join(pipe):
+            snapshot = self.get_snapshot()
+            if not snapshot:
+                return ['No such game']
+            if len(snapshot.players) >= engine.MAX_PLAYERS:
+                return ['There cannot be more than {} players in a game'
+                        .format(engine.MAX_PLAYERS)]
+            if bot and snapshot.state != 'setup':
+                return ['Bots can only join before the game starts']
+            if not bot and any(player.username == username
+                               for player in snapshot.players):
+                return ['You are already in this game']
+            pipe.multi()
+            layout.add_player(pipe, self.gid, pid, username, bot)
+            self.publish('players', {'action': 'join', 'player': pid,
+                                     'username': username, 'bot': bot},
+                         client=pipe)
+            return []
+
+        errors = self.transaction(join)
+        if errors:
+            return None, errors
+        if not bot:
+            redis.zadd(User(username).key(':games'), {self.gid: self.gid})
+        return Player(self.gid, pid), []
 
     def get_data(self):
+        values = self.redis.hmget(self.key(), GAME_FIELDS)
+        return self.data_from_hash(dict(zip(GAME_FIELDS, values)))
+
+    def get_snapshot(self):
+        return GameSnapshot.load(self.gid)
+
+    def get_views(self, version):
+        """
+        Returns the public data of the game and its players at ``version``
+        (see GameSnapshot.get_views), or a newer version if that isn't
+        cached, or None if the game doesn't exist.
+        """
+        def render():
+            snapshot = self.get_snapshot()
+            return snapshot.get_views() if snapshot else None
+        return view_cache.get(self.gid, version, render)
+
+    def data_from_hash(self, game_hash):
         return {
             'gid': self.gid,
-            'name': self.get_name(),
-            'state': self.get_state(),
-            'owner': self.get_owner_username(),
+            'name': game_hash.get('name'),
+            'state': game_hash.get('state'),
+            'owner': game_hash.get('owner'),
         }
 
     def start(self):
-        self.init_deck()
-        colors = ['yellow', 'red', 'purple', 'green', 'blue']
-        random.shuffle(colors)
-        players = self.get_players()
-        for player in players:
-            player.set_color(colors.pop())
-            player.draw_cards()
-        current_player = random.choice(players)
-        self.set_current_pid(current_player.pid)
-        self.set_state('started')
-
-    def next_player(self):
-        current_pid = self.get_current_pid()
-        pids = self.get_pids()
-        current_index = pids.index(current_pid)
-        next_index = (current_index + 1) % len(pids)
-        next_pid = pids[next_index]
-        self.set_current_pid(next_pid)
-        redis.publish(self.key(':current_player_channel'), next_pid)
-
-    def end(self):
-        winners = self.find_winners()
-        for player in winners:
-            player.get_user().increment_score()
-        winner_pids = [player.pid for player in winners]
-        self.set_winner_pids(winner_pids)
-        self.set_state('ended')
-
-    def find_winners(self):
-        players = self.get_players()
-        color_counts = collections.Counter()
-        for player in players:
-            for color, count in player.get_cards().items():
-                color_counts[color] += count
-
-        player_colors = [player.get_color() for player in players]
-        for color in color_counts:
-            if color not in player_colors:
-                color_counts[color] = 0
-
-        winning_colors = best(color_counts.items())
-        colors_to_players = {player.get_color(): player for player in players}
-        winners = [colors_to_players[color] for color in winning_colors]
-
-        if len(winners) == 1:
-            return winners
+        """
+        Deals the cards and starts the game, unless it isn't in setup or
+        doesn't have enough players. Returns the messages why it didn't
+        start, if any.
+        """
+        deadline = turn_deadline()
+
+        def start(pipe):
+            snapshot = self.get_snapshot()
+            if not snapshot or snapshot.state != 'setup':
+                return ['Game must be in setup state']
+            if len(snapshot.players) < engine.MIN_PLAYERS:
+                return ['Game must have at least {} players'
+                        .format(engine.MIN_PLAYERS)]
+            state = snapshot.to_engine()
+            state.start()
+            pipe.multi()
+            self.write_state(pipe, state)
+            pipe.delete(self.key(':log'))
+            pipe.rpush(self.key(':log'),
+                       movelog.encode(movelog.snapshot_entry(state)))
+            pipe.hset(self.key(), 'log_snapshot', 0)
+            self.set_deadline(pipe, deadline)
+            self.publish('state', {'state': 'started',
+                                   'currentPlayer': state.current_pid,
+                                   'deckSize': len(state.deck)}, client=pipe)
+            return []
+
+        errors = self.transaction(start)
+        if not errors:
+            self.update_index('started', deadline)
+        return errors
+
+    def write_state(self, pipe, state):
+        """
+        Queues the commands storing the engine state ``state`` on ``pipe``.
+        """
+        layout.write_state(pipe, self.gid, state)
+        if state.last_pid:
+            pipe.hset(self.key(), 'last_player', state.last_pid)
         else:
-            def score2(player):
-                return player.cards.get(player.get_color(), 0)
-            winners2 = [(score2(player), player) for player in winners]
-            return best(winners2)
-
-    def init_deck(self):
-        deck = 11 * ['yellow', 'red', 'purple', 'green', 'blue'] + 3 * ['ninja']
-        random.shuffle(deck)
-        for card in deck:
-            redis.rpush(self.key(':deck'), card)
-
-    def event_stream(self):
-        event_names = {
-            self.key(':current_player_channel'): 'current_player',
-            self.key(':state_channel'): 'state',
-            self.key(':players_channel'): 'players',
-        }
-        p = redis.pubsub()
-        p.subscribe(event_names)
-        for message in p.listen():
-            if message['type'] == 'message':
-                data = message['data']
-                channel = message['channel']
-                event = event_names[channel]
-                yield 'event: {}\ndata: {}\n\n'.format(event, data)
+            pipe.hdel(self.key(), 'last_player')
+        if state.current_pid:
+            pipe.hset(self.key(), 'current_player', state.current_pid)
+        pipe.hset(self.key(), 'state', state.state)
+
+    def get_log(self, start=0):
+        entries = self.redis.lrange(self.key(':log'), start, -1)
+        return [movelog.decode(entry) for entry in entries]
+
+    def replay(self):
+        """
+        Rebuilds the engine state of a started game from its move log,
+        starting at the last snapshot.
+        """
+        start = self.redis.hget(self.key(), 'log_snapshot')
+        if start is None:
+            return None
+        return movelog.replay(self.get_log(int(start)))
+
+    def get_export_data(self):
+        snapshot = self.get_snapshot()
+        if not snapshot:
+            return None
+        game_data = snapshot.get_summary()
+        game_data['log'] = self.get_log()
+        return game_data
+
+    def restore(self):
+        """
+        Overwrites the state of the game with the state replayed from its
+        move log. Returns the restored state.
+        """
+        state = self.replay()
+        if state is None:
+            return None
+        pipe = self.redis.pipeline()
+        self.write_state(pipe, state)
+        # Moves validated against the overwritten state are rejected
+        pipe.hincrby(self.key(), 'turn', 1)
+        deadline = turn_deadline() if state.state == 'started' else None
+        self.set_deadline(pipe, deadline)
+        self.publish('state', {'state': state.state}, client=pipe)
+        pipe.execute()
+        self.update_index(state.state, deadline)
+        return state
+
+    def play_bots(self):
+        """
+        Plays the turns of the bots up to the next human player's turn, all
+        stored at once.
+        """
+        snapshot = self.get_snapshot()
+        if not snapshot or snapshot.state != 'started':
+            return
+        state = snapshot.to_engine()
+        moves = []
+        while state.state == 'started':
+            player = snapshot.get_player(state.current_pid)
+            if not player.bot:
+                break
+            # A bot without a legal move passes, like a timed out player
+            move = bot.choose_move(state, player.pid)
+            moves.append((player.pid, move))
+            state.apply_move(player.pid, move)
+        if moves:
+            # Fails if someone else played a turn in the meantime
+            self.execute_moves(moves, snapshot)
+
+    def execute_moves(self, moves, snapshot=None):
+        """
+        Validates ``moves``, a list of (pid, move), in order against the
+        snapshot and applies all of them, publishing one event, or none.
+        They are rejected if another move was played since the snapshot,
+        so a move sent twice is only played once.
+
+        Returns whether they were applied and the messages of each move
+        with its pid. If a move is invalid, the results end with it.
+        """
+        if snapshot is None:
+            snapshot = self.get_snapshot()
+        state = snapshot.to_engine()
+        results = []
+        script_moves = []
+        events = []
+        for pid, move in moves:
+            if state.state != 'started':
+                valid, messages = False, ['The game has ended']
+            elif state.current_pid != pid:
+                valid, messages = False, ['It is not your turn']
+            else:
+                valid, messages = state.validate_move(pid, move)
+            if not valid:
+                results.append({'player': pid, 'messages': messages})
+                return False, results
+            if move is None:
+                messages = ['passed, having no legal move']
+            else:
+                orders = [move['first'], move['second'], move['third']]
+                messages = [state.describe_order(order) for order in orders]
+            delta = state.apply_move(pid, move)
+            events.append(Player.move_event_data(state, delta, messages))
+            fields = layout.move_fields(state, delta)
+            if fields is not None:
+                delta['fields'] = fields
+            script_moves.append({
+                'pid': pid,
+                'delta': delta,
+                'entry': movelog.encode(movelog.move_entry(pid, move)),
+            })
+            results.append({'player': pid, 'messages': messages})
+        deadline = turn_deadline() if state.state == 'started' else None
+        if len(events) == 1:
+            event, event_data = 'move', events[0]
+        else:
+            event, event_data = 'moves', {'moves': events}
+        try:
+            execute_move_script(keys=[self.key()],
+                                args=[json.dumps(script_moves), event,
+                                      json.dumps(event_data),
+                                      EVENT_HISTORY_SIZE,
+                                      movelog.encode(
+                                          movelog.snapshot_entry(state)),
+                                      movelog.SNAPSHOT_INTERVAL,
+                                      deadline or '', snapshot.turn],
+                                client=self.redis)
+        except ResponseError as e:
+            return False, [{'player': moves[0][0], 'messages': [str(e)]}]
+        if state.state == 'ended':
+            self.record_end(snapshot, state.winner_pids)
+        elif deadline:
+            pipe = redis.pipeline()
+            self.schedule_turn(pipe, deadline)
+            pipe.execute()
+        return True, results
+
+    @staticmethod
+    def play_timeouts(limit=100):
+        """
+        Plays a move for every player whose turn timed out, up to ``limit``
+        games. Returns the number of moves played.
+        """
+        now = int(time.time())
+        gids = claim_deadlines_script(keys=['turn_deadlines'],
+                                      args=[now, limit])
+        played = 0
+        failed = {}
+        for gid in gids:
+            try:
+                played += Game(int(gid)).play_timeout(now)
+            except Exception:
+                log.exception('Cannot play the timed out turn of game %s',
+                              gid)
+                failed[gid] = now
+        if failed:
+            # Claimed games are due again, so the next poll retries them
+            redis.zadd('turn_deadlines', failed)
+        return played
+
+    def play_timeout(self, now):
+        """
+        Plays the first legal move for the current player if the turn's
+        deadline has passed, or passes if there is none, and then the bots'
+        turns. Returns whether a move was played.
+        """
+        snapshot = self.get_snapshot()
+        if not snapshot or snapshot.state != 'started':
+            return False
+        deadline = self.redis.hget(self.key(), 'turn_deadline')
+        if deadline is None or int(deadline) > now:
+            # The turn changed in the meantime, and the new one is scheduled
+            return False
+        pid = snapshot.current_pid
+        move = next(snapshot.to_engine().legal_moves(pid), None)
+        ok, results = self.execute_moves([(pid, move)], snapshot)
+        if ok:
+            self.play_bots()
+        return ok
+
+    def event_stream(self, last_seq=None):
+        # Subscribe before reading the history, so no event falls in between.
+        # This waits until the hub's pattern subscription is active.
+        subscription = event_hub.subscribe(self.gid)
+        try:
+            history = []
+            if last_seq is not None:
+                try:
+                    history = event_hub.history(self.gid, last_seq)
+                except (ConnectionError, TimeoutError):
+                    # The response has started: end it, so the client
+                    # reconnects and reads the history again
+                    return
+            for message in history:
+                last_seq = message[2]
+                yield format_event(*message)
+            while not subscription.closed:
+                message = subscription.pop(EVENT_KEEPALIVE)
+                if message is None:
+                    # Comment line, lets us notice clients that went away
+                    yield KEEPALIVE_FRAME
+                elif last_seq is not None and message[2] is not None \
+                        and message[2] <= last_seq:
+                    # Already sent from the history
+                    continue
+                else:
+                    yield format_event(*message)
+        finally:
+            event_hub.unsubscribe(subscription)
 
 
 class Player:
@@ -200,250 +828,224 @@ class Player:
         self.gid = gid
         self.pid = pid
 
-    def key(self, suffix=''):
-        return 'games:{}:players:{}{}'.format(self.gid, self.pid, suffix)
-
     def get_username(self):
-        return redis.hget(self.key(), 'user')
+        return layout.get_player_field(self.gid, self.pid, 'user')
 
     def set_username(self, username):
-        redis.hset(self.key(), 'user', username)
+        layout.set_player_field(self.gid, self.pid, 'user', username)
 
     def get_user(self):
         return User(self.get_username())
 
+    def get_controller(self):
+        """
+        Returns the user who plays for the player: its own user, or the
+        owner of the game for a bot, whose username isn't a user's.
+        """
+        if self.is_bot():
+            return Game(self.gid).get_owner()
+        return self.get_user()
+
     def get_cards(self):
-        cards = redis.hgetall(self.key(':cards'))
-        for card, count in cards.items():
-            cards[card] = int(count)
-        return cards
+        return layout.get_cards(self.gid, self.pid)
 
     def get_hand(self):
-        return redis.lrange(self.key(':hand'), 0, -1)
+        return layout.get_hand(self.gid, self.pid)
 
     def get_data(self):
         return {
             'gid': self.gid,
             'pid': self.pid,
             'username': self.get_username(),
+            'bot': self.is_bot(),
             'cards': self.get_cards()
         }
 
+    def is_bot(self):
+        return layout.get_player_field(self.gid, self.pid, 'bot') == '1'
+
     def exists(self):
         return self.get_username() is not None
 
     def delete(self):
+        """
+        Removes the player from the game. Returns False if there is no such
+        player, e.g. because the request was repeated.
+        """
         game = Game(self.gid)
-        redis.lrem(game.key(':players'), 0, self.pid)
-        redis.delete(self.key(':cards'))
-        redis.delete(self.key(':hand'))
-        event_data = json.dumps({'action': 'leave', 'player': self.pid})
-        redis.publish(game.key(':players_channel'), event_data)
-
-    def validate_move(self, move):
-        self.validation_setup()
-        all_orders = 'first' in move and 'second' in move and 'third' in move
-        if not all_orders:
-            return False, ['Incomplete move']
-        results = [
-            self.validate_first(move['first']),
-            self.validate_second(move['second']),
-            self.validate_third(move['third']),
-        ]
-        oks, messages = zip(*results)
-        return all(oks), list(itertools.chain(messages))
-
-    def validation_setup(self):
-        self.dirty = set()
-        self.tmp_hand = self.get_hand()
-        self.tmp_cards = {}
-        for player in Game(self.gid).get_players():
-            dd = collections.defaultdict(int, player.get_cards())
-            self.tmp_cards[player.pid] = dd
-
-    def validate_first(self, order):
-        if 'type' not in order:
-            return False, 'No type for first order'
-        if order['type'] == 'deploy':
-            return self.validate_first_deploy(order)
-        if order['type'] == 'ninja':
-            return self.validate_ninja(order)
-        return False, 'Wrong type for first order'
-
-    def validate_second(self, order):
-        if 'type' not in order:
-            return False, 'No type for second order'
-        if order['type'] == 'deploy':
-            return self.validate_second_deploy(order)
-        if order['type'] == 'transfer':
-            return self.validate_transfer(order)
-        return False, 'Wrong type for second order'
-
-    def validate_third(self, order):
-        if order is None:
-            return self.validate_no_attack()
-        if 'type' not in order:
-            return False, 'No type for third order'
-        if order['type'] == 'attack':
-            return self.validate_attack(order)
-        return False, 'Wrong type for third order'
-
-    def validate_first_deploy(self, order):
-        to_pid = order['to']
-        color = order['color']
-        if color not in self.tmp_hand:
-            return False, 'You do not have a {} card to deploy' \
-                          .format(color)
-        if to_pid == self.pid:
-            return False, 'You cannot deploy to your own ' \
-                          'province in the first order'
-        self.tmp_hand.remove(color)
-        self.tmp_cards[to_pid][color] += 1
-        self.dirty.add((to_pid, color))
-        return True, ''
-
-    def validate_second_deploy(self, order):
-        to_pid = order['to']
-        color = order['color']
-        if color not in self.tmp_hand:
-            return False, 'You do not have a {} card to deploy' \
-                          .format(color)
-        if to_pid != self.pid:
-            return False, "You cannot deploy to an enemy's" \
-                          "province in the second order"
-        self.tmp_hand.remove(color)
-        self.tmp_cards[to_pid][color] += 1
-        return True, ''
-
-    def validate_ninja(self, order):
-        to_pid = order['to']
-        color = order['color']
-        if 'ninja' not in self.tmp_hand:
-            return False, 'You do not have a ninja card'
-        if color not in self.tmp_cards[to_pid]:
-            to_username = Player(self.gid, to_pid).get_username()
-            return False, '{} does not have a {} card' \
-                          .format(to_username, color)
-        self.tmp_hand.remove('ninja')
-        self.tmp_cards[to_pid][color] -= 1
-        return True, ''
-
-    def validate_transfer(self, order):
-        from_pid = order['from']
-        to_pid = order['to']
-        color = order['color']
-        if from_pid == self.pid:
-            return False, 'You cannot transfer from your own province'
-        if self.tmp_cards[from_pid][color] == 0:
-            from_username = Player(self.gid, from_pid).get_username()
-            return False, '{} does not have a {} card' \
-                          .format(from_username, color)
-        self.tmp_cards[from_pid][color] -= 1
-        self.tmp_cards[to_pid][color] += 1
-        return True, ''
-
-    def validate_attack(self, order):
-        to_pid = order['to']
-        color = order['color']
-        if self.can_attack(to_pid, color):
-            return True, ''
-        else:
-            to_username = Player(self.gid, to_pid).get_username()
-            return False, 'You cannot attack {} {}' \
-                          .format(to_username, color)
-
-    def validate_no_attack(self):
-        if all(not self.can_attack(pid, color)
-               for pid, color in self.enemy_stacks()):
-            return True, ''
-        else:
-            return False, 'You must attack if you can'
-
-    def enemy_stacks(self):
-        enemies = Game(self.gid).get_pids()
-        enemies.remove(self.pid)
-        for pid in enemies:
-            for color, count in self.tmp_cards[pid].items():
-                if count > 0:
-                    yield (pid, color)
-
-    def can_attack(self, enemy_pid, enemy_color):
-        if (enemy_pid, enemy_color) in self.dirty:
+
+        def delete(pipe):
+            username = self.get_username()
+            if username is None:
+                return None
+            bot = self.is_bot()
+            pipe.multi()
+            layout.remove_player(pipe, self.gid, self.pid)
+            game.publish('players', {'action': 'leave', 'player': self.pid},
+                         client=pipe)
+            return username, bot
+
+        removed = game.transaction(delete)
+        if removed is None:
             return False
-        enemy_count = self.tmp_cards[enemy_pid][enemy_color]
-        my_cards = self.tmp_cards[self.pid]
-        return any(color for color, count in my_cards.items()
-                   if count > enemy_count and color != enemy_color)
-
-    def execute_move(self, move):
-        orders = (move['first'], move['second'], move['third'])
-        messages = []
-        for order in orders:
-            messages.append(self.execute_order(order))
-        self.draw_cards()
-        game = Game(self.gid)
-        last_pid = game.get_last_pid()
-        if not last_pid and game.deck_empty():
-            game.set_last_pid(self.pid)
-        if self.pid == last_pid:
-            game.end()
+        username, bot = removed
+        if not bot:
+            redis.zrem(User(username).key(':games'), self.gid)
+        return True
+
+    def validate_move(self, move, snapshot=None):
+        if snapshot is None:
+            snapshot = Game(self.gid).get_snapshot()
+        return snapshot.to_engine().validate_move(self.pid, move)
+
+    def execute_move(self, move, snapshot=None):
+        ok, results = Game(self.gid).execute_moves([(self.pid, move)],
+                                                   snapshot)
+        return ok, results[0]['messages']
+
+    @staticmethod
+    def move_event_data(state, delta, messages):
+        # Everything a spectator needs to update its copy of the game
+        event_data = {
+            'player': delta['player'],
+            'orders': delta['orders'],
+            'messages': messages,
+            'cards': [{'player': pid, 'color': color, 'amount': amount}
+                      for pid, color, amount in delta['cards']],
+            'deckSize': delta['deck_size'],
+            'lastPlayer': state.last_pid,
+            'state': state.state,
+        }
+        if state.state == 'ended':
+            event_data['winners'] = list(state.winner_pids)
+            event_data['colors'] = {player.pid: player.get_color_name()
+                                    for player in state.players}
         else:
-            game.next_player()
-        return messages
-
-    def execute_order(self, order):
-        if order:
-            if order['type'] == 'deploy':
-                return self.deploy(order['color'], order['to'])
-            elif order['type'] == 'ninja':
-                return self.ninja(order['color'], order['to'])
-            elif order['type'] == 'transfer':
-                return self.transfer(order['color'], order['from'], order['to'])
-            elif order['type'] == 'attack':
-                return self.attack(order['color'], order['to'])
-
-    def deploy(self, color, to_pid):
-        to_player = Player(self.gid, to_pid)
-        redis.lrem(self.key(':hand'), 1, color)
-        redis.hincrby(to_player.key(':cards'), color, 1)
-        to_username = to_player.get_username()
-        return 'deployed {} to {}'.format(color, to_username)
-
-    def ninja(self, color, to_pid):
-        to_player = Player(self.gid, to_pid)
-        redis.lrem(self.key(':hand'), 1, 'ninja')
-        redis.hincrby(to_player.key(':cards'), color, -1)
-        to_username = to_player.get_username()
-        return "killed {} in {}'s province".format(color, to_username)
-
-    def transfer(self, color, from_pid, to_pid):
-        from_player = Player(self.gid, from_pid)
-        to_player = Player(self.gid, to_pid)
-        redis.hincrby(from_player.key(':cards'), color, -1)
-        redis.hincrby(to_player.key(':cards'), color, 1)
-        from_username = from_player.get_username()
-        to_username = to_player.get_username()
-        return 'transfered {} from {} to {}' \
-               .format(color, from_username, to_username)
-
-    def attack(self, color, to_pid):
-        to_player = Player(self.gid, to_pid)
-        redis.hincrby(to_player.key(':cards'), color, -1)
-        to_username = to_player.get_username()
-        return "attacked {} in {}'s province".format(color, to_username)
+            event_data['currentPlayer'] = state.current_pid
+        return event_data
 
     def get_color(self):
-        return redis.hget(self.key(), 'color')
+        return layout.get_player_field(self.gid, self.pid, 'color')
+
+
+class GameSnapshot(collections.namedtuple('GameSnapshot', [
+        'gid', 'name', 'state', 'owner', 'current_pid', 'last_pid',
+        'winner_pids', 'deck', 'players', 'seq', 'turn'])):
+    __slots__ = ()
+
+    @staticmethod
+    def load(gid):
+        data = layout.load(gid)
+        game_hash = data['game']
+        if not game_hash:
+            return None
+        current_pid = game_hash.get('current_player')
+        last_pid = game_hash.get('last_player')
+        players = [PlayerSnapshot.from_data(gid, player_data)
+                   for player_data in data['players']]
+        return GameSnapshot(
+            gid=gid,
+            name=game_hash.get('name'),
+            state=game_hash.get('state'),
+            owner=game_hash.get('owner'),
+            current_pid=int(current_pid) if current_pid else None,
+            last_pid=int(last_pid) if last_pid else None,
+            winner_pids=tuple(int(pid) for pid in data['winners']),
+            deck=tuple(data['deck']),
+            players=tuple(players),
+            seq=int(game_hash.get('seq', 0)),
+            turn=int(game_hash.get('turn', 0)),
+        )
+
+    def get_pids(self):
+        return [player.pid for player in self.players]
+
+    def get_player(self, pid):
+        for player in self.players:
+            if player.pid == pid:
+                return player
+
+    def to_engine(self):
+        players = [engine.PlayerState.from_names(player.pid, player.username,
+                                                 player.color, player.hand,
+                                                 player.cards)
+                   for player in self.players]
+        deck = [engine.CARD_CODES[card] for card in self.deck]
+        return engine.GameState(players, self.state, deck, self.current_pid,
+                                self.last_pid, self.winner_pids)
+
+    def get_data(self):
+        return {
+            'gid': self.gid,
+            'name': self.name,
+            'state': self.state,
+            'owner': self.owner,
+        }
+
+    def get_views(self):
+        """
+        Returns the data of the game and of its players that every user
+        sees, with the colors of the players, which only their own user
+        sees before the game ends.
+        """
+        game_data = self.get_data()
+        game_data['seq'] = self.seq
+        if self.last_pid:
+            game_data['lastPlayer'] = self.last_pid
+        if self.state == 'started':
+            game_data['currentPlayer'] = self.current_pid
+        if self.state == 'ended':
+            game_data['winners'] = list(self.winner_pids)
+        players_data = [player.get_data() for player in self.players]
+        if self.state == 'ended':
+            for player, player_data in zip(self.players, players_data):
+                player_data['color'] = player.color
+        return {
+            'seq': self.seq,
+            'game': game_data,
+            'players': players_data,
+            'colors': [player.color for player in self.players],
+        }
 
-    def set_color(self, color):
-        redis.hset(self.key(), 'color', color)
+    def get_summary(self):
+        """
+        Returns the game data with the winners and every player's color and
+        province cards.
+        """
+        game_data = self.get_data()
+        game_data['players'] = [dict(player.get_data(), color=player.color)
+                                for player in self.players]
+        game_data['winners'] = list(self.winner_pids)
+        return game_data
 
-    def draw_cards(self):
-        hand_length = redis.llen(self.key(':hand'))
-        for i in range(4 - hand_length):
-            card = redis.lpop('games:{}:deck'.format(self.gid))
-            if card:
-                redis.rpush(self.key(':hand'), card)
+
+class PlayerSnapshot(collections.namedtuple('PlayerSnapshot', [
+        'gid', 'pid', 'username', 'bot', 'color', 'hand', 'cards'])):
+    __slots__ = ()
+
+    @staticmethod
+    def from_data(gid, player_data):
+        player_hash = player_data['data']
+        cards = {card: int(count)
+                 for card, count in player_data['cards'].items()}
+        return PlayerSnapshot(
+            gid=gid,
+            pid=player_data['pid'],
+            username=player_hash.get('user'),
+            bot=player_hash.get('bot') == '1',
+            color=player_hash.get('color'),
+            hand=tuple(player_data['hand']),
+            cards=cards,
+        )
+
+    def get_data(self):
+        return {
+            'gid': self.gid,
+            'pid': self.pid,
+            'username': self.username,
+            'bot': self.bot,
+            'cards': dict(self.cards),
+        }
 
 
 class User:
@@ -462,6 +1064,7 @@ class User:
             return False
         redis.hset('users:{}'.format(username), 'score', 0)
         redis.rpush('users', username)
+        redis.zadd('leaderboard', {username: 0})
         return user
 
     @staticmethod
@@ -472,28 +1075,121 @@ class User:
     def get_all():
         return [User(username) for username in User.get_usernames()]
 
+    @staticmethod
+    def scan_data(cursor=0, count=50, client=None):
+        cursor, entries = (client or redis).zscan('leaderboard', cursor,
+                                                  count=count)
+        users_data = [{'username': username, 'score': int(score)}
+                      for username, score in entries]
+        return cursor, users_data
+
+    @staticmethod
+    def get_leaderboard(offset=0, limit=10, client=None):
+        client = client or redis
+        entries = client.zrevrange('leaderboard', offset, offset + limit - 1,
+                                   withscores=True)
+        # Users with equal scores share a rank
+        leaderboard = []
+        for i, (username, score) in enumerate(entries):
+            if i == 0:
+                rank = User.count_better_than(score, client) + 1
+            elif score != entries[i - 1][1]:
+                rank = offset + i + 1
+            leaderboard.append({'username': username, 'score': int(score),
+                                'rank': rank})
+        return leaderboard
+
+    @staticmethod
+    def count_better_than(score, client=None):
+        return (client or redis).zcount('leaderboard', '({}'.format(score),
+                                        '+inf')
+
+    @staticmethod
+    def rebuild_leaderboard():
+        usernames = User.get_usernames()
+        pipe = redis.pipeline(transaction=False)
+        for username in usernames:
+            pipe.hget(User(username).key(), 'score')
+        scores = pipe.execute()
+        pipe = redis.pipeline()
+        pipe.delete('leaderboard')
+        for username, score in zip(usernames, scores):
+            pipe.zadd('leaderboard', {username: int(score or 0)})
+        pipe.execute()
+        return len(usernames)
+
     def exists(self):
         return redis.hget(self.key(), 'password_hash') is not None
 
     def delete(self):
-        redis.delete(self.key())
+        redis.delete(self.key(), self.key(':games'), self.key(':owned_games'))
         redis.lrem('users', 0, self.username)
+        redis.zrem('leaderboard', self.username)
+        self.forget_credentials()
 
     def check_password(self, password):
         pw_hash = redis.hget(self.key(), 'password_hash')
         if not pw_hash:
             return False
-        return check_password_hash(pw_hash, password)
+        # The cached hash must match the stored one, so a password changed
+        # by another process invalidates the entry as well
+        cache_key = (self.username, password_digest(password))
+        if credential_cache.get(cache_key) == pw_hash:
+            return True
+        if not check_password_hash(pw_hash, password):
+            return False
+        credential_cache.set(cache_key, pw_hash)
+        return True
 
     def set_password(self, password):
         pw_hash = generate_password_hash(password)
+        self.forget_credentials()
         return redis.hset(self.key(), 'password_hash', pw_hash)
 
+    def forget_credentials(self):
+        credential_cache.delete_matching(lambda key: key[0] == self.username)
+
     def get_score(self):
         return int(redis.hget(self.key(), 'score'))
 
     def increment_score(self, amount=1):
-        redis.hincrby(self.key(), 'score', amount)
+        pipe = redis.pipeline()
+        pipe.hincrby(self.key(), 'score', amount)
+        pipe.zincrby('leaderboard', amount, self.username)
+        pipe.execute()
+
+    def request_key(self, key):
+        return self.key(':requests:{}'.format(key))
+
+    def begin_request(self, key, request_id):
+        """
+        Claims the idempotency key ``key`` for a request of the user, e.g.
+        ``POST /games``. Returns None if the key is new, or else what is
+        stored for it: the request id and, once the request was handled,
+        its response. The claim expires after IDEMPOTENCY_LEASE seconds, so
+        a request that died without a response can be retried.
+        """
+        pending = json.dumps({'request': request_id})
+        if redis.set(self.request_key(key), pending, nx=True,
+                     ex=IDEMPOTENCY_LEASE):
+            return None
+        stored = redis.get(self.request_key(key))
+        return json.loads(stored or pending)
+
+    def finish_request(self, key, request_id, response_data):
+        stored = dict(response_data, request=request_id)
+        redis.set(self.request_key(key), json.dumps(stored),
+                  ex=IDEMPOTENCY_TTL)
+
+    def abandon_request(self, key):
+        redis.delete(self.request_key(key))
+
+    def get_leaderboard_data(self):
+        score = redis.zscore('leaderboard', self.username)
+        if score is None:
+            return None
+        rank = User.count_better_than(score) + 1
+        return {'username': self.username, 'score': int(score), 'rank': rank}
 
     def get_data(self):
         return {'username': self.username, 'score': self.get_score()}
@@ -0,0 +1,73 @@
+"""
+The move log of a game, from which the game can be audited and rebuilt.
+
+The log is a list of compact JSON entries. Snapshot entries hold a whole
+GameState: the first one is taken when the game starts, so it has the
+shuffled deck and the dealt hands. Move entries hold a move, as it was
+validated and applied. A snapshot is added every SNAPSHOT_INTERVAL moves and
+at the end of the game, so replaying from the last snapshot stays cheap.
+"""
+import json
+
+from engine import GameState
+
+
+SNAPSHOT_INTERVAL = 10
+
+
+def encode(entry):
+    return json.dumps(entry, separators=(',', ':'), sort_keys=True)
+
+
+def decode(entry):
+    return json.loads(entry)
+
+
+def snapshot_entry(state):
+    return {'snapshot': state.dump()}
+
+
+def move_entry(pid, move):
+    return {'pid': pid, 'move': move}
+
+
+def replay(entries):
+    """
+    Returns the GameState after ``entries``, which must start with a
+    snapshot.
+    """
+    state = None
+    for entry in entries:
+        if 'snapshot' in entry:
+            state = GameState.load(entry['snapshot'])
+        elif state is None:
+            raise ValueError('The log must start with a snapshot')
+        else:
+            state.apply_move(entry['pid'], entry['move'])
+    return state
+
+
+def verify(entries):
+    """
+    Replays all of ``entries`` and checks that every snapshot matches the
+    state rebuilt from the moves before it. Returns a list of problems.
+    """
+    problems = []
+    state = None
+    for index, entry in enumerate(entries):
+        if 'snapshot' in entry:
+            if state is not None and state.dump() != entry['snapshot']:
+                problems.append('Snapshot {} differs from the replayed moves'
+                                .format(index))
+            state = GameState.load(entry['snapshot'])
+        elif state is None:
+            problems.append('The log must start with a snapshot')
+            return problems
+        else:
+            valid, errors = state.validate_move(entry['pid'], entry['move'])
+            if not valid:
+                problems.append('Move {} is invalid: {}'
+                                .format(index, ', '.join(errors)))
+                return problems
+            state.apply_move(entry['pid'], entry['move'])
+    return problems
@@ -0,0 +1,400 @@
+"""
+Win probabilities estimated by Monte-Carlo playouts.
+
+Plays a position to the end many times with randomized moves and counts
+who wins. The order of the deck is unknown to the players, so it is
+shuffled again for every playout; the hands are kept as they are. Games
+that haven't started yet are started with new colors, deck and first player
+each time, which shows how balanced the rules and the card mix are::
+
+    python odds.py --gid 42
+    python odds.py --file snapshot.json --playouts 100000 --json
+    python odds.py --players 4 --deck 11,11,11,11,11,5 --seed 1
+
+``--file`` takes a GameState dump (``engine.GameState.dump``), a move log
+snapshot entry or a line of ``manage.py export-games``. The playouts are
+split into batches with seeds derived from ``--seed``, so a seeded run gives
+the same result with any number of processes.
+"""
+import argparse
+import array
+import collections
+import json
+import math
+import multiprocessing
+import random
+import sys
+import time
+
+import bot
+import engine
+import movelog
+
+
+BATCH_SIZE = 500
+
+COLOR_COUNT = len(engine.COLORS)
+
+
+def enemy_stacks(players):
+    """
+    Returns the indexes of counts (see play_random_move) outside of the
+    province of each player.
+    """
+    return [[stack for stack in range(players * COLOR_COUNT)
+             if stack // COLOR_COUNT != me]
+            for me in range(players)]
+
+
+def play_random_move(hand, counts, enemies, me, rng):
+    """
+    Plays a random legal move of the player at index ``me`` on its ``hand``
+    and the province ``counts`` of all players, a flat list holding the
+    count of color c of the player at index p at p * COLOR_COUNT + c.
+    ``enemies`` are the enemy_stacks of the player. Each order is chosen
+    uniformly from the legal ones, one at a time, without listing the legal
+    moves. Returns the orders as tuples of a type and indexes of counts, or
+    None if there is no legal move.
+    """
+    players = len(counts) // COLOR_COUNT
+    colors = [card for card in set(hand) if card != engine.NINJA_CODE]
+    stacks = ()
+    if engine.NINJA_CODE in hand:
+        stacks = [stack for stack, count in enumerate(counts) if count]
+    others = players - 1
+    deploys = len(colors) * others
+    total = deploys + len(stacks)
+    if not total:
+        return None
+    index = int(rng.random() * total)
+    # Few first orders leave no legal second order, so the others are only
+    # tried then
+    indexes = None
+    while True:
+        if index < deploys:
+            card = colors[index // others]
+            to = index % others
+            stack = (to + (to >= me)) * COLOR_COUNT + card
+            first, dirty, change = ('deploy', stack), stack, 1
+        else:
+            card = engine.NINJA_CODE
+            stack = stacks[index - deploys]
+            first, dirty, change = ('ninja', stack), None, -1
+        position = hand.index(card)
+        del hand[position]
+        counts[stack] += change
+        second = play_random_second(hand, counts, enemies, me, rng)
+        if second is not None:
+            return (first, second,
+                    play_random_third(counts, enemies, me, dirty, rng))
+        hand.insert(position, card)
+        counts[stack] -= change
+        if indexes is None:
+            indexes = list(range(total))
+            rng.shuffle(indexes)
+        if not indexes:
+            return None
+        index = indexes.pop()
+
+
+def play_random_second(hand, counts, enemies, me, rng):
+    players = len(counts) // COLOR_COUNT
+    colors = [card for card in set(hand) if card != engine.NINJA_CODE]
+    from_stacks = [stack for stack in enemies if counts[stack]]
+    total = len(colors) + len(from_stacks) * players
+    if not total:
+        return None
+    index = int(rng.random() * total)
+    if index < len(colors):
+        stack = me * COLOR_COUNT + colors[index]
+        hand.remove(colors[index])
+        counts[stack] += 1
+        return 'deploy', stack
+    index -= len(colors)
+    from_stack = from_stacks[index // players]
+    to_stack = (index % players) * COLOR_COUNT + from_stack % COLOR_COUNT
+    counts[from_stack] -= 1
+    counts[to_stack] += 1
+    return 'transfer', from_stack, to_stack
+
+
+def play_random_third(counts, enemies, me, dirty, rng):
+    # Like MoveValidator.third_orders, compares each enemy stack with the
+    # two biggest stacks of the player's province
+    mine = me * COLOR_COUNT
+    my_counts = counts[mine:mine + COLOR_COUNT]
+    biggest_count = max(my_counts)
+    biggest = my_counts.index(biggest_count)
+    del my_counts[biggest]
+    second_count = max(my_counts)
+    attacks = [stack for stack in enemies
+               if 0 < counts[stack] < biggest_count and stack != dirty and
+               (counts[stack] < second_count or
+                stack % COLOR_COUNT != biggest)]
+    if not attacks:
+        return None
+    stack = attacks[int(rng.random() * len(attacks))]
+    counts[stack] -= 1
+    return 'attack', stack
+
+
+def order_data(order, pids):
+    if order is None:
+        return None
+
+    def pid(stack):
+        return pids[stack // COLOR_COUNT]
+
+    data = {'type': order[0], 'to': pid(order[-1]),
+            'color': engine.COLORS[order[-1] % COLOR_COUNT]}
+    if order[0] == 'transfer':
+        data['from'] = pid(order[1])
+    return data
+
+
+def random_move(state, pid, rng=random):
+    """
+    Returns a uniformly chosen legal order at each step of a move of player
+    ``pid``, or None if there is no legal move.
+    """
+    pids = state.get_pids()
+    counts = [count for player in state.players for count in player.cards]
+    me = pids.index(pid)
+    orders = play_random_move(list(state.get_player(pid).hand), counts,
+                              enemy_stacks(len(pids))[me], me, rng)
+    if orders is None:
+        return None
+    first, second, third = [order_data(order, pids) for order in orders]
+    return {'first': first, 'second': second, 'third': third}
+
+
+def play_randomly(state, rng):
+    """
+    Plays a started ``state`` to the end with the moves random_move would
+    choose, applied to plain lists instead of going through move dicts.
+    """
+    players = len(state.players)
+    pids = state.get_pids()
+    enemies = enemy_stacks(players)
+    hands = [list(player.hand) for player in state.players]
+    counts = [count for player in state.players for count in player.cards]
+    deck = list(state.deck)
+    me = pids.index(state.current_pid)
+    last = pids.index(state.last_pid) if state.last_pid else None
+    while True:
+        hand = hands[me]
+        play_random_move(hand, counts, enemies[me], me, rng)
+        drawn = engine.HAND_SIZE - len(hand)
+        if drawn > 0 and deck:
+            hand.extend(deck[:drawn])
+            del deck[:drawn]
+        previous_last = last
+        if last is None and not deck:
+            last = me
+        if me == previous_last:
+            break
+        me = (me + 1) % players
+    for index, player in enumerate(state.players):
+        player.hand = array.array('b', hands[index])
+        player.cards = array.array(
+            'h', counts[index * COLOR_COUNT:(index + 1) * COLOR_COUNT])
+    state.deck = array.array('b', deck)
+    state.current_pid = pids[me]
+    state.last_pid = pids[last]
+    state.end()
+
+
+POLICIES = {
+    'random': random_move,
+    'bot': bot.choose_move,
+}
+
+
+def playout(state, rng, policy=random_move, deck_counts=engine.DECK_COUNTS):
+    """
+    Plays a copy of ``state`` to the end and returns it with the pid of the
+    player who started. Players without a legal move pass.
+    """
+    state = state.copy()
+    if state.state == 'setup':
+        state.start(rng, deck_counts)
+        first_pid = state.current_pid
+    else:
+        first_pid = None
+        rng.shuffle(state.deck)
+    # Building and applying move dicts took most of the time of a playout
+    if policy is random_move and state.state == 'started':
+        play_randomly(state, rng)
+    while state.state == 'started':
+        move = policy(state, state.current_pid, rng)
+        state.apply_move(state.current_pid, move)
+    return state, first_pid
+
+
+def run_batch(task):
+    """
+    Runs a batch of playouts and counts the wins by pid, by color and by
+    seat, the position in turn order after the first player. A win shared
+    by several players counts as a fraction for each of them.
+    """
+    data, count, seed, policy, deck_counts = task
+    state = engine.GameState.load(data)
+    rng = random.Random(seed)
+    wins = collections.Counter()
+    for _ in range(count):
+        final, first_pid = playout(state, rng, POLICIES[policy], deck_counts)
+        winners = final.winner_pids if final.state == 'ended' else []
+        pids = final.get_pids()
+        for pid in winners:
+            share = 1 / len(winners)
+            wins['pid', pid] += share
+            wins['color', final.get_player(pid).color] += share
+            if first_pid is not None:
+                seat = (pids.index(pid) - pids.index(first_pid)) % len(pids)
+                wins['seat', seat] += share
+    return wins
+
+
+def estimate(state, playouts, seed, processes=None, policy='random',
+             deck_counts=engine.DECK_COUNTS):
+    """
+    Returns the wins counted by run_batch over ``playouts`` playouts of
+    ``state``, run in batches by a pool of ``processes`` processes (default:
+    one per CPU).
+    """
+    data = state.dump()
+    tasks = []
+    for index, start in enumerate(range(0, playouts, BATCH_SIZE)):
+        count = min(BATCH_SIZE, playouts - start)
+        tasks.append((data, count, '{}:{}'.format(seed, index), policy,
+                      deck_counts))
+    wins = collections.Counter()
+    if processes == 1:
+        results = map(run_batch, tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(run_batch, tasks)
+    for batch_wins in results:
+        wins.update(batch_wins)
+    if processes != 1:
+        pool.close()
+        pool.join()
+    return wins
+
+
+def odds(wins, keys, playouts):
+    """
+    Returns the win probability and the half width of its 95% confidence
+    interval for each of ``keys``.
+    """
+    result = collections.OrderedDict()
+    for key in keys:
+        p = wins[key] / playouts
+        result[key] = (p, 1.96 * math.sqrt(p * (1 - p) / playouts))
+    return result
+
+
+def load_state(args):
+    if args.gid is not None:
+        # Only needs Redis when reading a game from it
+        from models import Game
+        snapshot = Game(args.gid).get_snapshot()
+        if snapshot is None:
+            raise SystemExit('No such game: {}'.format(args.gid))
+        return snapshot.to_engine()
+    if args.file is not None:
+        with open(args.file) if args.file != '-' else sys.stdin as f:
+            data = json.loads(f.readline())
+        if 'log' in data:
+            return movelog.replay(data['log'])
+        return engine.GameState.load(data.get('snapshot', data))
+    return engine.GameState([engine.PlayerState(pid)
+                             for pid in range(1, args.players + 1)])
+
+
+def parse_deck(text):
+    counts = tuple(int(count) for count in text.split(','))
+    if len(counts) != len(engine.CARDS):
+        raise argparse.ArgumentTypeError(
+            'expected {} counts'.format(len(engine.CARDS)))
+    return counts
+
+
+def print_odds(title, names, probabilities):
+    print(title)
+    for key, (p, error) in probabilities.items():
+        print('  {:<16} {:6.2f}% +- {:.2f}%'.format(names[key], 100 * p,
+                                                    100 * error))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Estimate win probabilities with random playouts.')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--gid', type=int, help='game to read from Redis')
+    source.add_argument('--file',
+                        help='JSON game state, or - for standard input')
+    source.add_argument('--players', type=int,
+                        choices=range(engine.MIN_PLAYERS,
+                                      engine.MAX_PLAYERS + 1),
+                        help='analyse a new game with this many players')
+    parser.add_argument('--playouts', type=int, default=10000,
+                        help='number of playouts (default: 10000)')
+    parser.add_argument('--processes', type=int,
+                        help='worker processes (default: one per CPU)')
+    parser.add_argument('--seed', type=int,
+                        help='seed for reproducible results (default: random)')
+    parser.add_argument('--policy', choices=sorted(POLICIES),
+                        default='random',
+                        help='how moves are chosen: uniformly at random '
+                             '(default) or by the computer player')
+    parser.add_argument('--deck', type=parse_deck, default=engine.DECK_COUNTS,
+                        help='cards of each of {} in new decks, comma '
+                             'separated (default: {})'.format(
+                                 ', '.join(engine.CARDS),
+                                 ','.join(map(str, engine.DECK_COUNTS))))
+    parser.add_argument('--json', action='store_true',
+                        help='print the probabilities as JSON')
+    args = parser.parse_args()
+
+    state = load_state(args)
+    if state.state == 'ended':
+        raise SystemExit('The game has ended')
+    seed = args.seed if args.seed is not None else random.randrange(2 ** 32)
+    started = time.perf_counter()
+    wins = estimate(state, args.playouts, seed, args.processes, args.policy,
+                    args.deck)
+    elapsed = time.perf_counter() - started
+
+    pids = state.get_pids()
+    by_pid = odds(wins, [('pid', pid) for pid in pids], args.playouts)
+    tables = [('Players', {('pid', player.pid): player.name
+                           for player in state.players}, by_pid)]
+    if state.state == 'setup':
+        tables.append(('Colors', {('color', color): name
+                                  for color, name in enumerate(engine.COLORS)},
+                       odds(wins, [('color', color)
+                                   for color in range(len(engine.COLORS))],
+                            args.playouts)))
+        tables.append(('Seats', {('seat', seat): str(seat + 1)
+                                 for seat in range(len(pids))},
+                       odds(wins, [('seat', seat)
+                                   for seat in range(len(pids))],
+                            args.playouts)))
+
+    if args.json:
+        print(json.dumps({
+            'seed': seed,
+            'playouts': args.playouts,
+            'odds': [{'pid': pid, 'probability': p, 'error': error}
+                     for (_, pid), (p, error) in by_pid.items()],
+        }))
+        return
+    for title, names, probabilities in tables:
+        print_odds(title, names, probabilities)
+    print('{} playouts in {:.2f}s ({:.0f} playouts/s), seed {}'.format(
+        args.playouts, elapsed, args.playouts / elapsed, seed))
+
+
+if __name__ == '__main__':
+    main()
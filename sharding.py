@@ -0,0 +1,78 @@
+"""
+Distribution of games over Redis shards.
+
+All keys of a game contain its gid as a hash tag, e.g. ``games:{42}:deck``,
+so they are stored together: on the shard that a consistent hash ring maps
+the tag to, or in the same slot of a Redis Cluster. The scripts of a game
+only touch the game's keys, which keeps every operation on a game atomic on
+a single shard. Keys that aren't about one game (users, leaderboard, the
+lobby list and indexes) stay on the main Redis server.
+
+Adding a shard to the ring only moves the games that now hash to it.
+"""
+import bisect
+import hashlib
+
+
+def game_key(gid, suffix=''):
+    return 'games:{{{}}}{}'.format(gid, suffix)
+
+
+def hash_tag(key):
+    """
+    Returns the part of ``key`` that determines its shard: the text between
+    the first ``{`` and the next ``}`` if it isn't empty, as in Redis Cluster,
+    or else the whole key.
+    """
+    start = key.find('{')
+    if start != -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+
+def key_gid(key):
+    """
+    Returns the gid of a game key, or None for other keys.
+    """
+    if not key.startswith('games:{'):
+        return None
+    tag = hash_tag(key)
+    return int(tag) if tag.isdigit() else None
+
+
+def hash_value(text):
+    return int(hashlib.md5(text.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing:
+    """
+    Consistent hash ring of ``nodes`` (e.g. Redis clients) named ``names``.
+
+    Each node gets ``points`` points on the ring, derived from its name so
+    that every process maps tags the same way regardless of node order.
+    """
+    def __init__(self, nodes, names, points=160):
+        self.nodes = list(nodes)
+        self.names = list(names)
+        ring = sorted((hash_value('{}#{}'.format(name, i)), index)
+                      for index, name in enumerate(names)
+                      for i in range(points))
+        self.hashes = [point for point, _ in ring]
+        self.indexes = [index for _, index in ring]
+
+    def index(self, tag):
+        """
+        Returns the index of the node of ``tag`` in ``nodes``.
+        """
+        if len(self.nodes) == 1:
+            return 0
+        i = bisect.bisect(self.hashes, hash_value(str(tag)))
+        return self.indexes[i % len(self.hashes)]
+
+    def get(self, tag):
+        return self.nodes[self.index(tag)]
+
+    def get_for_key(self, key):
+        return self.get(hash_tag(key))
@@ -1,14 +1,44 @@
+import functools
+import hashlib
 import os
 from flask import request, jsonify, redirect, url_for, Response
 from flask.views import MethodView
+from redis.exceptions import ConnectionError, TimeoutError
+from werkzeug.exceptions import Conflict, ServiceUnavailable
 
-from make_json_app import make_json_app
-from models import Game, Player, User
+from events import parse_last_event_id
+from make_json_app import make_json_app, make_json_error
+from models import (GAME_STATES, ConflictError, Game, Player, User,
+                    instrumentation, replica)
 
 app = make_json_app(__name__)
 
 app.config['DEBUG'] = bool(os.getenv('DEBUG', False))
 app.config['HOST'] = os.getenv('HOST', '127.0.0.1')
+app.config['PORT'] = int(os.getenv('PORT', 5000))
+app.config['SERVER'] = os.getenv('SERVER', 'sync')
+app.config['WORKERS'] = int(os.getenv('WORKERS', 2 * os.cpu_count() + 1))
+app.config['THREADS'] = int(os.getenv('THREADS', 8))
+
+MAX_PAGE_SIZE = 100
+MAX_BATCH_SIZE = 100
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+
+instrumentation.init_app(app)
+
+
+@app.errorhandler(ConnectionError)
+@app.errorhandler(TimeoutError)
+def redis_unavailable(ex):
+    response = make_json_error(ServiceUnavailable())
+    response.headers['Retry-After'] = str(getattr(ex, 'retry_after', 1))
+    return response
+
+
+@app.errorhandler(ConflictError)
+def game_conflict(ex):
+    return make_json_error(Conflict(str(ex)))
+
 
 def authenticate(auth):
     if not auth:
@@ -35,12 +65,155 @@ def auth_response():
     return 'Please log in', 401, headers
 
 
+def resource_etag(version, user=None):
+    """
+    Returns the ETag of a game resource at ``version``, as seen by ``user``
+    if the representation depends on who is asking.
+    """
+    if user is None:
+        return str(version)
+    digest = hashlib.sha1(user.username.encode('utf-8')).hexdigest()[:16]
+    return '{}-{}'.format(version, digest)
+
+
+def not_modified(etag):
+    if etag not in request.if_none_match:
+        return None
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def get_views(game, user=None):
+    """
+    Returns the cached views of ``game`` (see Game.get_views), or a 304
+    response if the request's If-None-Match matches the current version of
+    a resource of ``game``.
+    """
+    version = game.get_version()
+    if version is not None:
+        response = not_modified(resource_etag(version, user))
+        if response:
+            return None, response
+    return game.get_views(version), None
+
+
+def players_view(views, user):
+    """
+    Returns the public data of the players, and the color of the player of
+    ``user`` unless everyone sees the colors already.
+    """
+    players = views['players']
+    if views['game']['state'] == 'ended':
+        return players
+    players = list(players)
+    for i, player_data in enumerate(players):
+        if not player_data['bot'] and player_data['username'] == user.username:
+            players[i] = dict(player_data, color=views['colors'][i])
+    return players
+
+
+def stored_response(stored, request_id):
+    if stored['request'] != request_id:
+        response_data = {'messages': ['The Idempotency-Key was used for '
+                                      'another request']}
+        return jsonify(response_data), 422
+    if 'status' not in stored:
+        response_data = {'messages': ['A request with this Idempotency-Key '
+                                      'is in progress']}
+        return jsonify(response_data), 409
+    response = Response(stored['body'], stored['status'],
+                        mimetype=stored['mimetype'])
+    if stored['location']:
+        response.headers['Location'] = stored['location']
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(view):
+    """
+    Lets clients retry POST requests safely: the response to a request with
+    an ``Idempotency-Key`` header is stored for the user, and repeating the
+    request with the same key returns it again without doing anything. The
+    key cannot be reused for another URI or body.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return view(*args, **kwargs)
+        if not key or len(key) > MAX_IDEMPOTENCY_KEY_LENGTH:
+            return jsonify({'messages': ['Invalid Idempotency-Key']}), 400
+        user = authenticate(request.authorization)
+        if not user:
+            return auth_response()
+        request_id = '{} {} {}'.format(
+            request.method, request.path,
+            hashlib.sha256(request.get_data()).hexdigest())
+        stored = user.begin_request(key, request_id)
+        if stored is not None:
+            return stored_response(stored, request_id)
+        try:
+            response = app.make_response(view(*args, **kwargs))
+        except Exception:
+            user.abandon_request(key)
+            raise
+        # A retry may succeed after a conflict or a server error
+        if response.status_code == 409 or response.status_code >= 500:
+            user.abandon_request(key)
+        else:
+            user.finish_request(key, request_id, {
+                'status': response.status_code,
+                'body': response.get_data(as_text=True),
+                'mimetype': response.mimetype,
+                'location': response.headers.get('Location'),
+            })
+        return response
+    return wrapper
+
+
+def with_etag(response, etag):
+    response.set_etag(etag)
+    return response
+
+
+def archived_game_response(gid):
+    archive_data = Game(gid).get_archive()
+    if not archive_data:
+        return '', 404
+    game_data = {field: archive_data[field]
+                 for field in ('gid', 'name', 'state', 'owner', 'seq',
+                               'winners')}
+    return with_etag(jsonify(game_data), resource_etag(archive_data['seq']))
+
+
+def archived_players_response(gid, user):
+    archive_data = Game(gid).get_archive()
+    if not archive_data:
+        return '', 404
+    response = jsonify({'players': archive_data['players'],
+                        'seq': archive_data['seq']})
+    return with_etag(response, resource_etag(archive_data['seq'], user))
+
+
 class GameListView(MethodView):
     def get(self):
-        games = Game.get_all()
-        games_data = [game.get_data() for game in games]
+        offset = request.args.get('offset', 0, type=int)
+        limit = request.args.get('limit', MAX_PAGE_SIZE, type=int)
+        if offset < 0 or not 1 <= limit <= MAX_PAGE_SIZE:
+            response_data = {'messages': ['Invalid offset or limit']}
+            return jsonify(response_data), 400
+        filters = {name: request.args[name]
+                   for name in ('state', 'owner', 'player')
+                   if request.args.get(name)}
+        if filters.get('state', GAME_STATES[0]) not in GAME_STATES:
+            response_data = {'messages': ['Invalid state']}
+            return jsonify(response_data), 400
+        games = Game.get_all(offset, limit, client=replica, **filters)
+        games_data = Game.get_data_many(games)
         return jsonify({'games': games_data})
 
+    @idempotent
     def post(self):
         user = authenticate(request.authorization)
         if not user:
@@ -54,18 +227,12 @@ class GameListView(MethodView):
 
 class GameView(MethodView):
     def get(self, gid):
-        game = Game(gid)
-        if not game.exists():
-            return '', 404
-        game_data = game.get_data()
-        last_pid = game.get_last_pid()
-        if last_pid:
-            game_data['lastPlayer'] = last_pid
-        if game_data['state'] == 'started':
-            game_data['currentPlayer'] = game.get_current_pid()
-        if game_data['state'] == 'ended':
-            game_data['winners'] = game.get_winner_pids()
-        return jsonify(game_data)
+        views, response = get_views(Game(gid))
+        if response:
+            return response
+        if not views:
+            return archived_game_response(gid)
+        return with_etag(jsonify(views['game']), resource_etag(views['seq']))
 
     def put(self, gid):
         game = Game(gid)
@@ -83,16 +250,16 @@ class GameView(MethodView):
             if game_json['state'] != 'started':
                 errors.append('Cannot change state to {}' \
                               .format(game_json['state']))
-            if state != 'setup':
-                errors.append('Game must be in setup state')
-            if len(game.get_pids()) < 3:
-                response_data = {'messages':
-                                 ['Game must have at least 3 players']}
         if errors:
             return jsonify({'messages': errors}), 400
         if game_json['state'] == 'started' and state != 'started':
-            game.start()
-        game.set_name(game_json['name'])
+            # Checks the state and the players atomically with the start
+            errors = game.start()
+            if errors:
+                return jsonify({'messages': errors}), 400
+            game.play_bots()
+        if game_json['name'] != game.get_name():
+            game.set_name(game_json['name'])
         return '', 204
 
     def delete(self, gid):
@@ -109,37 +276,32 @@ class PlayerListView(MethodView):
         user = authenticate(request.authorization)
         if not user:
             return auth_response()
-        game = Game(gid)
-        game_state = game.get_state()
-        pids = game.get_pids()
-        players = []
-        for pid in pids:
-            player = Player(gid, pid)
-            cards = player.get_cards()
-            username = player.get_username()
-            player_data = player.get_data()
-            if (user and username == user.username) or game_state == 'ended':
-                player_data['color'] = player.get_color()
-            players.append(player_data)
-        return jsonify({'players': players})
-
+        views, response = get_views(Game(gid), user)
+        if response:
+            return response
+        if not views:
+            return archived_players_response(gid, user)
+        response = jsonify({'players': players_view(views, user),
+                            'seq': views['seq']})
+        return with_etag(response, resource_etag(views['seq'], user))
+
+    @idempotent
     def post(self, gid):
         user = authenticate(request.authorization)
         if not user:
             return auth_response()
         game = Game(gid)
-        players = game.get_players()
-        if len(players) >= 5:
-            response_data = {
-                'messages': ['There cannot be more than 5 players in a game']
-            }
-            return jsonify(response_data), 400
-        if any([p for p in players if p.get_username() == user.username]):
-            response_data = {
-                'messages': ['You are already in this game']
-            }
-            return jsonify(response_data), 400
-        player = game.create_player(user)
+        owner = game.get_owner_username()
+        if owner is None:
+            return '', 404
+        player_json = request.get_json(silent=True) or {}
+        add_bot = bool(player_json.get('bot'))
+        if add_bot and not authorize(request.authorization, User(owner)):
+            return auth_response()
+        # The limits are checked atomically with the join
+        player, errors = game.join(user.username, bot=add_bot)
+        if errors:
+            return jsonify({'messages': errors}), 400
         response_data = player.get_data()
         return (jsonify(response_data), 201,
                 {'Location': url_for('player', gid=gid, pid=player.pid)})
@@ -150,20 +312,22 @@ class PlayerView(MethodView):
         user = authenticate(request.authorization)
         if not user:
             return auth_response()
-        player = Player(gid, pid)
-        if not player.exists():
+        views, response = get_views(Game(gid), user)
+        if response:
+            return response
+        players = players_view(views, user) if views else []
+        response_data = next((player_data for player_data in players
+                              if player_data['pid'] == pid), None)
+        if not response_data:
             return '', 404
-        cards = player.get_cards()
-        response_data = player.get_data()
-        if user.username == player.get_username():
-            response_data['color'] = player.get_color()
-        return jsonify(response_data)
+        return with_etag(jsonify(response_data),
+                         resource_etag(views['seq'], user))
 
     def delete(self, gid, pid):
         game = Game(gid)
         owner = game.get_owner()
         player = Player(gid, pid)
-        user = player.get_user()
+        user = player.get_controller()
         auth = request.authorization
         if not (authorize(auth, owner) or authorize(auth, user)):
             return auth_response()
@@ -172,50 +336,114 @@ class PlayerView(MethodView):
 
 
 class MoveListView(MethodView):
+    @idempotent
     def post(self, gid, pid):
-        game = Game(gid)
-        state = game.get_state()
-        if state == 'setup':
+        snapshot = Game(gid).get_snapshot()
+        if not snapshot:
+            return '', 404
+        if snapshot.state == 'setup':
             return jsonify({'messages': ["The game hasn't started yet"]}), 400
-        if state == 'ended':
+        if snapshot.state == 'ended':
             return jsonify({'messages': ['The game has ended']}), 400
-        if not game.get_current_pid() == pid:
+        if not snapshot.current_pid == pid:
             return jsonify({'messages': ['It is not your turn']}), 400
-        player = Player(gid, pid)
-        user = player.get_user()
-        if not authorize(request.authorization, user):
+        player = snapshot.get_player(pid)
+        # The owner of the game moves for its bots
+        username = snapshot.owner if player.bot else player.username
+        if not authorize(request.authorization, User(username)):
             return auth_response()
+        player = Player(gid, pid)
         move = request.get_json()
-        valid, errors = player.validate_move(move)
-        if valid:
-            messages = player.execute_move(move)
-            return jsonify({'messages': messages})
-        else:
+        valid, errors = player.validate_move(move, snapshot)
+        if not valid:
             return jsonify({'messages': errors}), 400
+        ok, messages = player.execute_move(move, snapshot)
+        if not ok:
+            return jsonify({'messages': messages}), 400
+        Game(gid).play_bots()
+        return jsonify({'messages': messages})
+
+
+class GameMoveListView(MethodView):
+    @idempotent
+    def post(self, gid):
+        snapshot = Game(gid).get_snapshot()
+        if not snapshot:
+            return '', 404
+        if snapshot.state == 'setup':
+            return jsonify({'messages': ["The game hasn't started yet"]}), 400
+        if snapshot.state == 'ended':
+            return jsonify({'messages': ['The game has ended']}), 400
+        moves_json = (request.get_json() or {}).get('moves')
+        if not isinstance(moves_json, list) or not moves_json or \
+                not all(isinstance(move_json, dict) and
+                        isinstance(move_json.get('player'), int) and
+                        isinstance(move_json.get('move'), dict)
+                        for move_json in moves_json):
+            return jsonify({'messages': ['Invalid moves']}), 400
+        if len(moves_json) > MAX_BATCH_SIZE:
+            response_data = {'messages': ['At most {} moves can be sent at '
+                                          'once'.format(MAX_BATCH_SIZE)]}
+            return jsonify(response_data), 400
+        current_user = authenticate(request.authorization)
+        if not current_user:
+            return auth_response()
+        moves = []
+        for move_json in moves_json:
+            player = snapshot.get_player(move_json['player'])
+            if not player:
+                response_data = {'messages': ['No such player: {}'
+                                              .format(move_json['player'])]}
+                return jsonify(response_data), 400
+            # The owner of the game moves for its bots
+            username = snapshot.owner if player.bot else player.username
+            if username != current_user.username:
+                return auth_response()
+            moves.append((player.pid, move_json['move']))
+        game = Game(gid)
+        ok, results = game.execute_moves(moves, snapshot)
+        if not ok:
+            return jsonify({'moves': results}), 400
+        game.play_bots()
+        return jsonify({'moves': results})
 
 
 class HandView(MethodView):
     def get(self, gid, pid):
         player = Player(gid, pid)
-        user = player.get_user()
+        user = player.get_controller()
         if not authorize(request.authorization, user):
             return auth_response()
+        # Read before the hand, so a change in between can't be missed
+        version = Game(gid).get_version()
+        if version is not None:
+            response = not_modified(resource_etag(version))
+            if response:
+                return response
         hand =  player.get_hand()
-        return jsonify({'hand': hand})
+        response = jsonify({'hand': hand})
+        if version is not None:
+            response.set_etag(resource_etag(version))
+        return response
 
 
 class EventsView(MethodView):
     def get(self, gid):
         game = Game(gid)
-        return Response(game.event_stream(),
+        last_seq = parse_last_event_id(request.headers.get('Last-Event-ID'))
+        return Response(game.event_stream(last_seq),
                         mimetype='text/event-stream')
 
 
 class UserListView(MethodView):
     def get(self):
-        users = User.get_all()
-        users_data = [user.get_data() for user in users]
-        return jsonify({'users': users_data})
+        cursor = request.args.get('cursor', 0, type=int)
+        count = request.args.get('count', 50, type=int)
+        if cursor < 0 or not 1 <= count <= MAX_PAGE_SIZE:
+            response_data = {'messages': ['Invalid cursor or count']}
+            return jsonify(response_data), 400
+        cursor, users_data = User.scan_data(cursor, count, client=replica)
+        return jsonify({'users': users_data, 'cursor': cursor})
 
     def post(self):
         user_data = request.get_json()
@@ -228,6 +456,25 @@ class UserListView(MethodView):
                 {'Location': url_for('user', username=user.username)})
 
 
+class LeaderboardView(MethodView):
+    def get(self):
+        offset = request.args.get('offset', 0, type=int)
+        limit = request.args.get('limit', 10, type=int)
+        if offset < 0 or not 1 <= limit <= MAX_PAGE_SIZE:
+            response_data = {'messages': ['Invalid offset or limit']}
+            return jsonify(response_data), 400
+        users_data = User.get_leaderboard(offset, limit, client=replica)
+        return jsonify({'users': users_data})
+
+
+class LeaderboardUserView(MethodView):
+    def get(self, username):
+        user_data = User(username).get_leaderboard_data()
+        if not user_data:
+            return '', 404
+        return jsonify(user_data)
+
+
 class UserView(MethodView):
     def get(self, username):
         user = User(username)
@@ -241,7 +488,7 @@ class UserView(MethodView):
             return '', 404
         if not authorize(request.authorization, user):
             return auth_response()
-        user_data = get_json()
+        user_data = request.get_json()
         if user_data['username'] != user.username:
             response_data = {'messages': ['Cannot change username']}
             return jsonify(response_data), 400
@@ -252,6 +499,12 @@ class UserView(MethodView):
         return '', 204
 
 
+class MetricsView(MethodView):
+    def get(self):
+        return Response(instrumentation.metrics.render(),
+                        mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/')
 def index():
     return redirect('/static/index.html')
@@ -259,6 +512,8 @@ def index():
 
 app.add_url_rule('/games', view_func=GameListView.as_view('game_list'))
 app.add_url_rule('/games/<int:gid>', view_func=GameView.as_view('game'))
+app.add_url_rule('/games/<int:gid>/moves',
+                 view_func=GameMoveListView.as_view('game_move_list'))
 app.add_url_rule('/games/<int:gid>/players',
                  view_func=PlayerListView.as_view('player_list'))
 app.add_url_rule('/games/<int:gid>/players/<int:pid>',
@@ -271,6 +526,46 @@ app.add_url_rule('/games/<int:gid>/events',
                  view_func=EventsView.as_view('events'))
 app.add_url_rule('/users', view_func=UserListView.as_view('user_list'))
 app.add_url_rule('/users/<username>', view_func=UserView.as_view('user'))
+app.add_url_rule('/leaderboard',
+                 view_func=LeaderboardView.as_view('leaderboard'))
+app.add_url_rule('/leaderboard/<username>',
+                 view_func=LeaderboardUserView.as_view('leaderboard_user'))
+app.add_url_rule('/metrics', view_func=MetricsView.as_view('metrics'))
+
+
+def run_async(host, port):
+    import uvicorn
+    uvicorn.run('asgi:application', host=host, port=port)
+
+
+def run_prefork(host, port, workers, threads):
+    """
+    Runs the app in ``workers`` processes with ``threads`` threads each, so
+    requests use all CPUs. Each worker has its own Redis connections, event
+    listeners and metrics.
+    """
+    from gunicorn.app.base import BaseApplication
+
+    class Application(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', '{}:{}'.format(host, port))
+            self.cfg.set('workers', workers)
+            self.cfg.set('threads', threads)
+            self.cfg.set('worker_class', 'gthread')
+
+        def load(self):
+            return app
+
+    Application().run()
+
 
 if __name__ == '__main__':
-    app.run(host=app.config['HOST'], threaded=True)
+    host, port = app.config['HOST'], app.config['PORT']
+    if app.config['SERVER'] == 'async':
+        run_async(host, port)
+    elif app.config['SERVER'] == 'prefork':
+        run_prefork(host, port, app.config['WORKERS'], app.config['THREADS'])
+    elif app.config['SERVER'] == 'sync':
+        app.run(host=host, port=port, threaded=True)
+    else:
+        raise SystemExit('SERVER must be one of: sync, async, prefork')
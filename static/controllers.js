@@ -37,22 +37,29 @@ app.controller('LoginController',
 });
 
 app.controller('UsersController', function ($scope, $http) {
-    $http.get('/users').success(function (data) {
+    $http.get('/leaderboard?limit=100').success(function (data) {
         $scope.users = data.users;
     });
 });
 
-app.controller('GamesController', function ($scope, $http) {
+app.controller('GamesController', function ($scope, $http, $rootScope) {
     var update = function () {
-        $http.get('/games').success(function (data) {
+        $http.get('/games?state=setup').success(function (data) {
             $scope.games = data.games;
         });
+        if ($rootScope.username) {
+            $http.get('/games', { params: { player: $rootScope.username } }).
+                success(function (data) {
+                    $scope.myGames = data.games;
+                });
+        }
     };
 
     $scope.createGame = function (game) {
         $http.post('/games', game).success(update);
     };
 
+    $scope.$on('updateEvent', update);
     update();
 });
 
@@ -100,6 +107,11 @@ app.controller('GameLobbyController',
         });
     };
 
+    $scope.addBot = function () {
+        $http.post('/games/' + gid + '/players', { bot: true }).
+            success(update);
+    };
+
     $scope.leave = function () {
         $http.delete('/games/' + gid + '/players/' + myPid).
             success(function () {
@@ -117,8 +129,10 @@ app.controller('GameLobbyController',
     };
 
     events.addEventListener('players', update);
+    events.addEventListener('game', update);
+    events.addEventListener('reset', update);
     events.addEventListener('state', function (event) {
-        if (event.data === 'started') {
+        if (JSON.parse(event.data).state === 'started') {
             $rootScope.$apply(function () {
                 $location.path('/games/' + gid);
             });
@@ -365,14 +379,24 @@ app.controller('GameController',
 
     $scope.usernames = {};
 
+    // Sequence number of the last game event included in the scope
+    var seq = null;
+
     // TODO: break into init and update (?)
     var update = function () {
+        seq = null;
         $http.get('/games/' + gid).success(function (data) {
             $scope.game = data;
             if ($scope.game.state == 'setup') {
                 $location.path($location.path() + '/lobby');
             }
             $http.get('/games/' + gid + '/players').success(function (data) {
+                if (data.seq !== $scope.game.seq) {
+                    // Something happened between the two requests
+                    update();
+                    return;
+                }
+                seq = data.seq;
                 $scope.players = data.players;
                 data.players.forEach(function (player) {
                     $scope.usernames[player.pid] = player.username;
@@ -404,6 +428,68 @@ app.controller('GameController',
         update();
     });
 
+    // Applies the changes of someone else's moves, published in one event,
+    // so the whole game doesn't have to be fetched again
+    var applyMoves = function (data, moves) {
+        if (seq === null || data.seq <= seq) {
+            // Already included, or an update is on its way
+            return;
+        }
+        var ours = moves.some(function (move) {
+            return move.player === myPid;
+        });
+        if (data.seq !== seq + 1 || ours) {
+            // Missed an event, or our own move, which also changed our hand
+            // and the stacks we moved around before sending it
+            update();
+            return;
+        }
+        seq = data.seq;
+        moves.forEach(applyMove);
+    };
+
+    var applyMove = function (data) {
+        data.cards.forEach(function (change) {
+            $scope.players.forEach(function (player) {
+                if (player.pid === change.player) {
+                    player.cards[change.color] =
+                        (player.cards[change.color] || 0) + change.amount;
+                }
+            });
+        });
+        $scope.game.state = data.state;
+        if (data.lastPlayer) {
+            $scope.game.lastPlayer = data.lastPlayer;
+        }
+        if (data.state == 'ended') {
+            delete $scope.game.currentPlayer;
+            $scope.game.winners = data.winners;
+            $scope.players.forEach(function (player) {
+                player.color = data.colors[player.pid];
+            });
+        } else {
+            $scope.game.currentPlayer = data.currentPlayer;
+            if (myPid === data.currentPlayer) {
+                switchState(states.first1);
+            }
+        }
+    };
+
     var source = new EventSource('/games/' + gid + '/events');
-    source.addEventListener('current_player', update);
+    source.addEventListener('move', function (event) {
+        $scope.$apply(function () {
+            var data = JSON.parse(event.data);
+            applyMoves(data, [data]);
+        });
+    });
+    source.addEventListener('moves', function (event) {
+        $scope.$apply(function () {
+            var data = JSON.parse(event.data);
+            applyMoves(data, data.moves);
+        });
+    });
+    source.addEventListener('players', update);
+    source.addEventListener('state', update);
+    source.addEventListener('game', update);
+    source.addEventListener('reset', update);
 });
@@ -0,0 +1,78 @@
+"""
+The tests run against an in-process fake Redis (requires the fakeredis
+package with Lua support)::
+
+    python -m pytest
+"""
+import base64
+import itertools
+import json
+
+import fakeredis
+import pytest
+
+import connections
+
+server = fakeredis.FakeServer()
+connections.create_client = \
+    lambda url, **options: fakeredis.FakeStrictRedis(
+        server=server, decode_responses=True)
+
+# Imported only now, so the app uses the fake client
+import layouts  # noqa: E402
+import models  # noqa: E402
+from shinobi import app  # noqa: E402
+
+
+@pytest.fixture
+def redis_server():
+    return server
+
+
+@pytest.fixture(params=sorted(layouts.LAYOUTS))
+def layout(request, monkeypatch):
+    """
+    Stores the games of a test in each of the layouts in turn.
+    """
+    monkeypatch.setattr(models, 'layout', layouts.LAYOUTS[request.param](
+        models.game_redis, models.load_script))
+    return request.param
+
+
+class Client:
+    """
+    Sends JSON requests to the app as one of the users it creates.
+    """
+    # The fake Redis is shared by all tests, so usernames must be unique
+    counter = itertools.count(1)
+
+    def __init__(self):
+        app.testing = True
+        self.client = app.test_client()
+
+    def create_user(self, name):
+        username = '{}{}'.format(name, next(self.counter))
+        self.request('post', '/users', None, 201,
+                     {'username': username, 'password': username})
+        return username
+
+    def request(self, method, path, username=None, status=200, data=None,
+                headers=None):
+        headers = dict(headers or {})
+        if username is not None:
+            credentials = '{}:{}'.format(username, username).encode('utf-8')
+            token = base64.b64encode(credentials).decode('ascii')
+            headers['Authorization'] = 'Basic {}'.format(token)
+        response = getattr(self.client, method)(
+            path, headers=headers, content_type='application/json',
+            data=None if data is None else json.dumps(data))
+        assert response.status_code == status, response.data
+        # For checking the headers
+        self.response = response
+        if response.data:
+            return json.loads(response.data.decode('utf-8'))
+
+
+@pytest.fixture
+def client():
+    return Client()
@@ -0,0 +1,101 @@
+import itertools
+
+import models
+import shinobi
+
+
+def test_game_list_pages_are_bounded(client, monkeypatch):
+    monkeypatch.setattr(shinobi, 'MAX_PAGE_SIZE', 2)
+    owner = client.create_user('owner')
+    gids = [client.request('post', '/games', owner, 201, {'name': 'g'})['gid']
+            for _ in range(3)]
+    path = '/games?owner={}'.format(owner)
+    games = client.request('get', path)['games']
+    assert [game['gid'] for game in games] == gids[:2]
+    games = client.request('get', path + '&offset=2&limit=2')['games']
+    assert [game['gid'] for game in games] == gids[2:]
+    for limit in (0, 3):
+        client.request('get', path + '&limit={}'.format(limit), status=400)
+
+
+def idempotency_key(key):
+    return {'Idempotency-Key': key}
+
+
+def test_completed_request_is_replayed(client):
+    owner = client.create_user('owner')
+    headers = idempotency_key('create')
+    game = client.request('post', '/games', owner, 201, {'name': 'g'},
+                          headers)
+    assert 'Idempotent-Replayed' not in client.response.headers
+    assert client.request('post', '/games', owner, 201, {'name': 'g'},
+                          headers) == game
+    assert client.response.headers['Idempotent-Replayed'] == 'true'
+    games = client.request('get', '/games?owner={}'.format(owner))['games']
+    assert [data['gid'] for data in games] == [game['gid']]
+
+
+def test_key_is_not_reused_for_another_request(client):
+    owner = client.create_user('owner')
+    headers = idempotency_key('create')
+    client.request('post', '/games', owner, 201, {'name': 'g'}, headers)
+    client.request('post', '/games', owner, 422, {'name': 'other'}, headers)
+    gid = client.request('post', '/games', owner, 201, {'name': 'g'})['gid']
+    client.request('post', '/games/{}/players'.format(gid), owner, 422,
+                   headers=headers)
+
+
+def test_request_in_progress_conflicts(client, monkeypatch):
+    owner = client.create_user('owner')
+    headers = idempotency_key('create')
+    create = models.Game.create
+    retries = []
+
+    def create_and_retry(user, name):
+        # The client retries while the first request is still running
+        retries.append(client.request('post', '/games', owner, 409,
+                                      {'name': 'g'}, headers))
+        return create(user, name)
+
+    monkeypatch.setattr(models.Game, 'create', create_and_retry)
+    client.request('post', '/games', owner, 201, {'name': 'g'}, headers)
+    assert retries == [{'messages': [
+        'A request with this Idempotency-Key is in progress']}]
+
+
+def changing_game(monkeypatch, changes):
+    """
+    Changes the game hash ``changes`` times while a transaction reads the
+    game, as another request would.
+    """
+    get_snapshot = models.Game.get_snapshot
+    counter = itertools.count()
+
+    def get_changing_snapshot(game):
+        snapshot = get_snapshot(game)
+        if next(counter) < changes:
+            models.redis.hincrby(game.key(), 'seq', 1)
+        return snapshot
+
+    monkeypatch.setattr(models.Game, 'get_snapshot', get_changing_snapshot)
+
+
+def test_transaction_is_retried_after_a_change(client, monkeypatch):
+    owner = client.create_user('owner')
+    gid = client.request('post', '/games', owner, 201, {'name': 'g'})['gid']
+    changing_game(monkeypatch, models.TRANSACTION_RETRIES - 1)
+    client.request('post', '/games/{}/players'.format(gid), owner, 201)
+    assert len(models.Game(gid).get_pids()) == 1
+
+
+def test_game_changing_too_often_conflicts(client, monkeypatch):
+    owner = client.create_user('owner')
+    gid = client.request('post', '/games', owner, 201, {'name': 'g'})['gid']
+    path = '/games/{}/players'.format(gid)
+    headers = idempotency_key('join')
+    changing_game(monkeypatch, models.TRANSACTION_RETRIES)
+    client.request('post', path, owner, 409, headers=headers)
+    assert models.Game(gid).get_pids() == []
+    # The conflict isn't stored, so the request can be retried
+    client.request('post', path, owner, 201, headers=headers)
+    assert len(models.Game(gid).get_pids()) == 1
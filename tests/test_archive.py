@@ -0,0 +1,35 @@
+from models import Game
+
+
+def start_game(client):
+    owner = client.create_user('owner')
+    gid = client.request('post', '/games', owner, 201, {'name': 'g'})['gid']
+    client.request('post', '/games/{}/players'.format(gid), owner, 201)
+    for _ in range(2):
+        client.request('post', '/games/{}/players'.format(gid), owner, 201,
+                       {'bot': True})
+    game = client.request('get', '/games/{}'.format(gid))
+    game['state'] = 'started'
+    client.request('put', '/games/{}'.format(gid), owner, 204, game)
+    return Game(gid)
+
+
+def test_archived_game_keys_are_not_orphans(client, layout, monkeypatch):
+    game = start_game(client)
+    game.redis.hset(game.key(), 'state', 'ended')
+    keys = game.get_keys(game.get_snapshot().get_pids())
+    unindex = Game.unindex
+
+    def unindex_while_deleting_orphans(self, pipe, snapshot):
+        # delete_orphans may run at any time while a game is archived
+        Game.delete_orphans()
+        unindex(self, pipe, snapshot)
+        pipe.execute()
+        Game.delete_orphans()
+
+    monkeypatch.setattr(Game, 'unindex', unindex_while_deleting_orphans)
+    assert game.archive(ttl=100)
+    assert game.gid not in Game.get_gids()
+    assert all(0 < game.redis.ttl(key) <= 100
+               for key in keys if game.redis.exists(key))
+    assert game.redis.exists(game.key())
@@ -0,0 +1,146 @@
+import json
+import random
+
+import pytest
+
+from engine import (CARD_CODES, CARDS, COLORS, GameState, MoveValidator,
+                    PlayerState)
+
+
+def positions(seed, games=3):
+    """
+    Generates the positions of a few random games, before every move.
+    """
+    rng = random.Random(seed)
+    for _ in range(games):
+        state = GameState([PlayerState(pid)
+                           for pid in range(1, rng.randint(3, 5) + 1)])
+        state.start(rng)
+        while state.state == 'started':
+            yield state
+            moves = list(state.legal_moves(state.current_pid))
+            state.apply_move(state.current_pid,
+                             rng.choice(moves) if moves else None)
+
+
+def candidate_orders(pids):
+    """
+    Returns every order of each position in a move, legal or not.
+    """
+    first = [{'type': order_type, 'to': pid, 'color': card}
+             for order_type in ('deploy', 'ninja')
+             for pid in pids for card in CARDS]
+    second = [{'type': 'deploy', 'to': pid, 'color': card}
+              for pid in pids for card in CARDS]
+    second.extend({'type': 'transfer', 'from': from_pid, 'to': to_pid,
+                   'color': card}
+                  for from_pid in pids for to_pid in pids for card in CARDS)
+    third = [None]
+    third.extend({'type': 'attack', 'to': pid, 'color': card}
+                 for pid in pids for card in CARDS)
+    return first, second, third
+
+
+def accepted_moves(state, pid):
+    """
+    Returns every move validate() accepts, trying all combinations of
+    orders. The orders that cannot start a valid move are skipped early.
+    """
+    first_orders, second_orders, third_orders = \
+        candidate_orders(state.get_pids())
+    moves = []
+    for first in first_orders:
+        if not MoveValidator(state, pid).validate_first(first)[0]:
+            continue
+        for second in second_orders:
+            validator = MoveValidator(state, pid)
+            validator.validate_first(first)
+            if not validator.validate_second(second)[0]:
+                continue
+            for third in third_orders:
+                move = {'first': first, 'second': second, 'third': third}
+                if MoveValidator(state, pid).validate(move)[0]:
+                    moves.append(move)
+    return moves
+
+
+def key(move):
+    return json.dumps(move, sort_keys=True)
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_legal_moves_are_the_moves_validate_accepts(seed):
+    for index, state in enumerate(positions(seed)):
+        # Brute force is slow, so only check some of the positions
+        if index % 7:
+            continue
+        pid = state.current_pid
+        legal = [key(move) for move in state.legal_moves(pid)]
+        assert len(legal) == len(set(legal)), 'duplicate moves'
+        assert set(legal) == {key(move)
+                              for move in accepted_moves(state, pid)}
+
+
+def test_pass_only_without_legal_move():
+    for state in positions(0, games=1):
+        pid = state.current_pid
+        assert state.validate_move(pid, None) == \
+            (False, ['You must move if you can'])
+    # Without any cards in hand there is no legal first order
+    state = GameState([PlayerState(pid, color=pid, cards=[1] * len(COLORS))
+                       for pid in (1, 2, 3)], state='started', current_pid=1)
+    assert list(state.legal_moves(1)) == []
+    assert state.validate_move(1, None) == (True, [])
+    delta = state.apply_move(1, None)
+    assert delta['orders'] == [] and delta['cards'] == []
+    assert state.current_pid == 2
+
+
+def position():
+    """
+    Returns a position where player 1 holds one card of each kind and every
+    province has one card of each color.
+    """
+    hand = [CARD_CODES[card] for card in CARDS]
+    players = [PlayerState(pid, color=pid, hand=hand if pid == 1 else (),
+                           cards=[1] * len(COLORS))
+               for pid in (1, 2, 3)]
+    players[1].cards[CARD_CODES['blue']] = 0
+    return GameState(players, state='started', current_pid=1)
+
+
+def move(first=None, second=None, third=None):
+    return {
+        'first': first or {'type': 'deploy', 'to': 2, 'color': 'red'},
+        'second': second or {'type': 'deploy', 'to': 1, 'color': 'yellow'},
+        'third': third or {'type': 'attack', 'to': 3, 'color': 'red'},
+    }
+
+
+def test_valid_base_move():
+    # The rejected moves below differ from this one in one order only
+    state = position()
+    assert state.validate_move(1, move()) == (True, ['', '', ''])
+
+
+@pytest.mark.parametrize('invalid_move, message', [
+    (move(first={'type': 'ninja', 'to': 2, 'color': 'blue'}),
+     '2 does not have a blue card'),
+    (move(first={'type': 'ninja', 'to': 2, 'color': 'ninja'}),
+     '2 does not have a ninja card'),
+    (move(first={'type': 'deploy', 'to': 2, 'color': 'ninja'}),
+     'You cannot deploy a ninja card'),
+    (move(second={'type': 'deploy', 'to': 1, 'color': 'ninja'}),
+     'You cannot deploy a ninja card'),
+    (move(second={'type': 'transfer', 'from': 2, 'to': 3, 'color': 'blue'}),
+     '2 does not have a blue card'),
+    (move(third={'type': 'attack', 'to': 1, 'color': 'green'}),
+     'You cannot attack 1 green'),
+    (move(third={'type': 'attack', 'to': 2, 'color': 'ninja'}),
+     'You cannot attack 2 ninja'),
+])
+def test_invalid_orders_are_rejected(invalid_move, message):
+    state = position()
+    valid, messages = state.validate_move(1, invalid_move)
+    assert not valid
+    assert message in messages
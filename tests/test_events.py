@@ -0,0 +1,176 @@
+import asyncio
+import itertools
+import threading
+import time
+
+import fakeredis.aioredis
+import pytest
+from redis.exceptions import ConnectionError, TimeoutError
+
+import asgi
+import models
+import sharding
+from events import AsyncEventHub, EventHub
+
+
+# Subscribing takes this long, so that events published by a subscriber that
+# doesn't wait for the subscription are lost
+SUBSCRIBE_DELAY = 0.2
+
+
+class SlowClient:
+    """
+    Wraps a Redis client whose pub/sub connections subscribe slowly.
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def pubsub(self, **kwargs):
+        pubsub = self.client.pubsub(**kwargs)
+        psubscribe = pubsub.psubscribe
+
+        def slow_psubscribe(*args, **kwargs):
+            time.sleep(SUBSCRIBE_DELAY)
+            return psubscribe(*args, **kwargs)
+
+        pubsub.psubscribe = slow_psubscribe
+        return pubsub
+
+
+class AsyncSlowClient(SlowClient):
+    def pubsub(self, **kwargs):
+        pubsub = self.client.pubsub(**kwargs)
+        psubscribe = pubsub.psubscribe
+
+        async def slow_psubscribe(*args, **kwargs):
+            await asyncio.sleep(SUBSCRIBE_DELAY)
+            return await psubscribe(*args, **kwargs)
+
+        pubsub.psubscribe = slow_psubscribe
+        return pubsub
+
+
+class DownClient:
+    def pubsub(self, **kwargs):
+        raise ConnectionError('Connection refused')
+
+
+class DroppingClient:
+    """
+    Pub/sub client whose connection drops when ``drop`` is set, and then
+    stays down.
+    """
+    def __init__(self):
+        self.drop = threading.Event()
+
+    def pubsub(self, **kwargs):
+        if self.drop.is_set():
+            raise ConnectionError('Connection refused')
+        return self
+
+    def psubscribe(self, pattern):
+        pass
+
+    def listen(self):
+        yield {'type': 'psubscribe', 'pattern': None,
+               'channel': EventHub.pattern, 'data': 1}
+        self.drop.wait()
+        raise ConnectionError('Connection lost')
+
+
+class HistoryDownHub(AsyncEventHub):
+    async def history(self, gid, after):
+        raise ConnectionError('Connection lost')
+
+
+def publish(gid, seq):
+    models.game_redis(gid).publish(
+        sharding.game_key(gid, ':state_channel'), '{{"seq": {}}}'.format(seq))
+
+
+def test_subscription_gets_events_published_right_after_it():
+    hub = EventHub(models.shards, pubsub_shards=sharding.HashRing(
+        [SlowClient(models.redis)], models.SHARD_URLS))
+    for gid in range(1, 4):
+        subscription = hub.subscribe(gid)
+        publish(gid, 1)
+        assert subscription.pop(1) == ('state', '{"seq": 1}', 1)
+        hub.unsubscribe(subscription)
+
+
+def test_subscribe_fails_while_the_shard_is_down():
+    hub = EventHub(models.shards, pubsub_shards=sharding.HashRing(
+        [DownClient()], models.SHARD_URLS), subscribe_timeout=0.1)
+    with pytest.raises(TimeoutError):
+        hub.subscribe(1)
+    assert not hub.subscriptions
+
+
+def test_async_subscription_gets_events_published_right_after_it(
+        redis_server):
+    client = fakeredis.aioredis.FakeRedis(server=redis_server,
+                                          decode_responses=True)
+    hub = AsyncEventHub(models.shards, pubsub_shards=sharding.HashRing(
+        [AsyncSlowClient(client)], models.SHARD_URLS))
+
+    async def subscribe_and_publish():
+        subscription = await hub.subscribe(1)
+        publish(1, 2)
+        return await subscription.pop(1)
+
+    assert asyncio.run(subscribe_and_publish()) == ('state', '{"seq": 2}', 2)
+
+
+def test_subscriptions_are_closed_when_their_shard_disconnects():
+    clients = [DroppingClient(), DroppingClient()]
+    pubsub_shards = sharding.HashRing(clients, ['shard1', 'shard2'])
+    hub = EventHub(models.shards, pubsub_shards=pubsub_shards,
+                   subscribe_timeout=1)
+    gids = [next(gid for gid in itertools.count(1)
+                 if pubsub_shards.index(gid) == index) for index in (0, 1)]
+    dropped, kept = [hub.subscribe(gid) for gid in gids]
+    clients[0].drop.set()
+    assert dropped.pop(1) is None
+    assert dropped.closed
+    assert not kept.closed
+    assert list(hub.subscriptions) == [gids[1]]
+    with pytest.raises(TimeoutError):
+        hub.subscribe(gids[0])
+
+
+def add_events(gid, seqs):
+    key = sharding.game_key(gid, ':events')
+    for seq in seqs:
+        models.game_redis(gid).xadd(
+            key, {'event': 'state', 'data': '{{"seq": {}}}'.format(seq)},
+            id='0-{}'.format(seq))
+
+
+def test_history_resets_clients_that_missed_trimmed_events():
+    gid = 1000
+    hub = EventHub(models.shards)
+    add_events(gid, range(5, 8))
+    assert [seq for _, _, seq in hub.history(gid, 4)] == [5, 6, 7]
+    assert hub.history(gid, 6) == [('state', '{"seq": 7}', 7)]
+    assert hub.history(gid, 7) == []
+    assert hub.history(gid, 2) == [('reset', '{"seq": 7}', 7)]
+
+
+def test_event_stream_ends_if_the_history_cannot_be_read(redis_server):
+    client = fakeredis.aioredis.FakeRedis(server=redis_server,
+                                          decode_responses=True)
+    hub = HistoryDownHub(models.shards, pubsub_shards=sharding.HashRing(
+        [client], models.SHARD_URLS))
+    application = asgi.Application(None, hub)
+    sent = []
+
+    async def receive():
+        await asyncio.sleep(60)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(application.events(1, receive, send, last_seq=1))
+    assert sent[0]['status'] == 200
+    assert sent[1:] == [{'type': 'http.response.body', 'body': b''}]
+    assert not hub.subscriptions
@@ -0,0 +1,45 @@
+import random
+
+import bot
+import movelog
+from models import Game, GameSnapshot
+
+
+def replayed(gid):
+    return movelog.replay(Game(gid).get_log()).dump()
+
+
+def stored(gid):
+    return GameSnapshot.load(gid).to_engine().dump()
+
+
+def test_log_replays_to_the_stored_game(client, layout):
+    owner = client.create_user('owner')
+    usernames = [owner, client.create_user('player')]
+    gid = client.request('post', '/games', owner, 201, {'name': 'g'})['gid']
+    for username in usernames:
+        client.request('post', '/games/{}/players'.format(gid), username, 201)
+    client.request('post', '/games/{}/players'.format(gid), owner, 201,
+                   {'bot': True})
+    game = client.request('get', '/games/{}'.format(gid))
+    game['state'] = 'started'
+    client.request('put', '/games/{}'.format(gid), owner, 204, game)
+    assert replayed(gid) == stored(gid)
+
+    rng = random.Random(gid)
+    moves = 0
+    while True:
+        snapshot = GameSnapshot.load(gid)
+        if snapshot.state == 'ended':
+            break
+        pid = snapshot.current_pid
+        player = snapshot.get_player(pid)
+        move = bot.choose_move(snapshot.to_engine(), pid, rng)
+        client.request('post', '/games/{}/players/{}/moves'.format(gid, pid),
+                       player.username, 200, move)
+        moves += 1
+        assert replayed(gid) == stored(gid)
+
+    assert moves > movelog.SNAPSHOT_INTERVAL
+    assert Game(gid).replay().dump() == stored(gid)
+    assert movelog.verify(Game(gid).get_log()) == []
@@ -0,0 +1,75 @@
+import json
+import random
+import time
+
+import engine
+import odds
+from test_engine import positions
+
+
+# Playouts of a new four player game per second and process, far below what
+# a current machine does, so the check doesn't fail on slow CI runners
+MIN_PLAYOUTS_PER_SECOND = 500
+
+
+def key(move):
+    return json.dumps(move, sort_keys=True)
+
+
+def test_random_moves_are_legal():
+    rng = random.Random(0)
+    for state in positions(1):
+        pid = state.current_pid
+        move = odds.random_move(state, pid, rng)
+        if move is None:
+            assert next(state.legal_moves(pid), None) is None
+        else:
+            assert state.validate_move(pid, move)[0], move
+
+
+def test_random_moves_cover_the_legal_moves():
+    rng = random.Random(0)
+    checked = 0
+    for state in positions(2):
+        pid = state.current_pid
+        legal = {key(move) for move in state.legal_moves(pid)}
+        # Sampling every move of bigger positions takes too long
+        if not 0 < len(legal) <= 60:
+            continue
+        checked += 1
+        sampled = {key(odds.random_move(state, pid, rng))
+                   for _ in range(50 * len(legal))}
+        assert sampled == legal
+    assert checked >= 5
+
+
+def reference_playout(state, rng):
+    # What playout does, one move dict at a time
+    state = state.copy()
+    state.start(rng)
+    while state.state == 'started':
+        pid = state.current_pid
+        state.apply_move(pid, odds.random_move(state, pid, rng))
+    return state
+
+
+def test_fast_playouts_play_the_random_moves():
+    for players in range(engine.MIN_PLAYERS, engine.MAX_PLAYERS + 1):
+        state = engine.GameState([engine.PlayerState(pid)
+                                  for pid in range(1, players + 1)])
+        for seed in range(20):
+            final, _ = odds.playout(state, random.Random(seed))
+            assert final.dump() == \
+                reference_playout(state, random.Random(seed)).dump()
+
+
+def test_playout_throughput():
+    state = engine.GameState([engine.PlayerState(pid) for pid in range(1, 5)])
+    rng = random.Random(0)
+    playouts = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < 0.5:
+        odds.playout(state, rng)
+        playouts += 1
+    rate = playouts / (time.perf_counter() - start)
+    assert rate >= MIN_PLAYOUTS_PER_SECOND, rate